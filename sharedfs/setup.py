@@ -39,13 +39,19 @@ setuptools.setup(
     ],
     entry_points={
         "nova.plugin": ["plugin=sharedfs.plugin:SharedFSPlugin"],
+        "console_scripts": [
+            "sharedfs-reconcile=sharedfs.reconcile:main",
+            "sharedfs-backfill=sharedfs.backfill:main"
+        ],
         'openstack.cli': [
             'create_filesystem=sharedfs.shell:Create_Filesystem',
             'delete_filesystem=sharedfs.shell:Delete_Filesystem',
             'list_filesystem=sharedfs.shell:List_Filesystem',
             'attachments_filesystem=sharedfs.shell:Attachments_Filesystem',
             'attach_filesystem=sharedfs.shell:Attach_Filesystem',
-            'detach_filesystem=sharedfs.shell:Detach_Filesystem'
+            'detach_filesystem=sharedfs.shell:Detach_Filesystem',
+            'bulk_attach_filesystem=sharedfs.shell:Bulk_Attach_Filesystem',
+            'bulk_detach_filesystem=sharedfs.shell:Bulk_Detach_Filesystem'
         ]
     },
     py_modules=[]
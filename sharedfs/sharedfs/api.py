@@ -12,10 +12,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License
 
+import datetime
+import hashlib
+import time
 import urllib
 
+import eventlet
 import webob
 
+from nova.api.openstack import common
 from nova.api.openstack import extensions
 from nova.api.openstack import wsgi
 from nova.api.openstack import xmlutil
@@ -24,18 +29,32 @@ from nova import exception
 from nova import flags
 from nova import log as logging
 from nova.openstack.common import cfg
-from nova.openstack.common import importutils
+from nova import utils
 from sharedfs import db as sharedfs_db
+from sharedfs import driver
+from sharedfs import jobs
+from sharedfs import reconcile
 
 FLAGS = flags.FLAGS
 
 LOG = logging.getLogger("nova.plugin.%s" % __name__)
 authorize = extensions.extension_authorizer('volume', 'shared_fs')
 
-opts = cfg.StrOpt('sharedfs_driver',
-                  default="sharedfs.driver.sharedfs_driver.SharedFSDriver",
-                  help='Driver to manage shared filesystems. '
-                       'Default is an empty do-nothing driver.'),
+opts = [
+    cfg.IntOpt('sharedfs_etag_lifetime',
+               default=300,
+               help='ETags on filesystem and attachment listings change at '
+                    'least this often (in seconds), so that changes made '
+                    'outside of nova are eventually noticed.  0 means '
+                    'only changes made through nova alter the ETag.'),
+    cfg.IntOpt('sharedfs_stale_state_timeout',
+               default=3600,
+               help='A filesystem left creating or deleting for longer '
+                    'than this (in seconds), for instance because the API '
+                    'server died part way, is treated as being in error '
+                    'so that it can be created or deleted again.  0 '
+                    'disables this.'),
+]
 FLAGS.register_opts(opts)
 
 
@@ -48,6 +67,7 @@ def make_fs_entry(elem):
     elem.set('size')
     elem.set('scope')
     elem.set('project')
+    elem.set('state')
 
 
 class SharedFSTemplate(xmlutil.TemplateBuilder):
@@ -84,6 +104,37 @@ class InstancesTemplate(xmlutil.TemplateBuilder):
         return xmlutil.MasterTemplate(root, 1)
 
 
+def make_job_entry(elem):
+    elem.set('id')
+    elem.set('action')
+    elem.set('filesystem')
+    elem.set('status')
+    elem.set('created_at')
+    elem.set('finished_at')
+    progress = xmlutil.SubTemplateElement(elem, 'progress',
+                                          selector='progress')
+    progress.set('total')
+    progress.set('completed')
+    errors = xmlutil.SubTemplateElement(elem, 'errors')
+    error = xmlutil.SubTemplateElement(errors, 'error', selector='errors')
+    error.text = xmlutil.Selector()
+
+
+class JobTemplate(xmlutil.TemplateBuilder):
+    def construct(self):
+        root = xmlutil.TemplateElement('job', selector='job')
+        make_job_entry(root)
+        return xmlutil.MasterTemplate(root, 1)
+
+
+class JobsTemplate(xmlutil.TemplateBuilder):
+    def construct(self):
+        root = xmlutil.TemplateElement('jobs')
+        elem = xmlutil.SubTemplateElement(root, 'job', selector='jobs')
+        make_job_entry(elem)
+        return xmlutil.MasterTemplate(root, 1)
+
+
 def _translate_instance_view(instance_id):
     result = {'id': instance_id}
     return {'instance_entry': result}
@@ -100,6 +151,8 @@ def _translate_fs_entry_view(fs_entry):
               'size': fs_entry.get('size'),
               'scope': fs_entry.get('scope'),
               'project': fs_entry.get('project')}
+    if fs_entry.get('state'):
+        result['state'] = fs_entry.get('state')
     return {'fs_entry': result}
 
 
@@ -109,6 +162,41 @@ def _translate_fs_entries_view(domain_entries):
                              for entry in domain_entries]}
 
 
+def _translate_job_view(job):
+    return {'job': job.to_dict()}
+
+
+def _translate_jobs_view(job_list):
+    return {'jobs': [job.to_dict() for job in job_list]}
+
+
+def _make_etag(*parts):
+    if FLAGS.sharedfs_etag_lifetime:
+        parts += (int(time.time() / FLAGS.sharedfs_etag_lifetime),)
+    return '"%s"' % hashlib.md5('/'.join(str(part)
+                                          for part in parts)).hexdigest()
+
+
+def _not_modified(req, etag):
+    """Return a 304 response if the client already has this version."""
+    header = req.headers.get('If-None-Match')
+    if not header:
+        return None
+    tags = [tag.strip() for tag in header.split(',')]
+    if etag not in tags and '*' not in tags:
+        return None
+    response = webob.Response(status_int=304)
+    response.headers['ETag'] = etag
+    return response
+
+
+def _with_etag(result, etag):
+    resp_obj = wsgi.ResponseObject(result)
+    if etag:
+        resp_obj['ETag'] = etag
+    return resp_obj
+
+
 def _has_db_support():
     # If we're using this extension on a pre-folsom
     # version of Nova then we might not have db support.
@@ -116,14 +204,52 @@ def _has_db_support():
     return hasattr(sharedfs_db, 'filesystem_list')
 
 
+def _get_active_filesystem(context, fs_name):
+    """Return the record for fs_name, which must be ready for use.
+
+    Filesystems that are still being created or deleted, or that were
+    left in error, are refused without consulting the driver.
+    """
+    fs_entry = sharedfs_db.filesystem_get(context, fs_name)
+    if not fs_entry:
+        msg = _("Filesystem %s does not exist.") % fs_name
+        raise webob.exc.HTTPNotFound(msg)
+    if fs_entry.state != sharedfs_db.STATE_ACTIVE:
+        msg = (_("Filesystem %(fs)s is not available (%(state)s).") %
+               {'fs': fs_name, 'state': fs_entry.state})
+        raise webob.exc.HTTPConflict(explanation=msg)
+    return fs_entry
+
+
+def _is_stale(fs_entry):
+    """Whether fs_entry has been creating or deleting for too long."""
+    if fs_entry.state not in (sharedfs_db.STATE_CREATING,
+                              sharedfs_db.STATE_DELETING):
+        return False
+    timeout = FLAGS.sharedfs_stale_state_timeout
+    # A record brought back from soft deletion keeps its old updated_at.
+    stamps = [t for t in (fs_entry.created_at, fs_entry.updated_at) if t]
+    if timeout <= 0 or not stamps:
+        return False
+    changed_at = max(stamps)
+    if utils.utcnow() - changed_at < datetime.timedelta(seconds=timeout):
+        return False
+    LOG.warn(_("Filesystem %(fs)s has been %(state)s since %(time)s; "
+               "treating it as failed.") %
+             {'fs': fs_entry.name, 'state': fs_entry.state,
+              'time': changed_at})
+    return True
+
+
 class SharedFSController(object):
     """Shared FileSystem controller for OpenStack API."""
 
     def __init__(self):
         LOG.debug("SharedFSController init.")
-        self.fs_driver = importutils.import_object(FLAGS.sharedfs_driver)
-        self.fs_driver.do_setup()
+        self.fs_driver = driver.get_driver()
         self.fs_driver.check_for_setup_error()
+        self.jobs = jobs.get_manager()
+        reconcile.start_periodic()
         self.has_db_support = _has_db_support()
         if not self.has_db_support:
             LOG.warn(_("The Shared Filesystem database extensions are not "
@@ -131,44 +257,164 @@ class SharedFSController(object):
                      "will not be supported."))
 
     @wsgi.serializers(xml=SharedFSsTemplate)
+    @sharedfs_db.scoped_session
     def index(self, req):
-        """Return a list of existing file shares."""
-        filesystems = self.fs_driver.list_fs()
+        """Return a list of existing file shares.
 
-        # Only return filesystems in the db.
+        Supports limit/marker pagination, filtering by scope, project,
+        name prefix and state, and sorting by name, scope or project.
+        Only active shares are listed unless another state is asked for.
+        """
         context = req.environ['nova.context']
 
+        etag = None
         if self.has_db_support:
-            db_list = sharedfs_db.filesystem_list(context)
+            generation = sharedfs_db.generation_get(
+                context, sharedfs_db.FILESYSTEMS_GENERATION)
+            etag = _make_etag(generation, req.query_string)
+            not_modified = _not_modified(req, etag)
+            if not_modified:
+                return not_modified
+
+        params = common.get_pagination_params(req)
+        # As in common.limited(), a limit of 0 means the maximum.
+        limit = min(params.get('limit') or FLAGS.osapi_max_limit,
+                    FLAGS.osapi_max_limit)
+        marker = params.get('marker')
+        filters = {}
+        for param, key in [('scope', 'scope'),
+                           ('project', 'project_id'),
+                           ('prefix', 'name')]:
+            if req.GET.get(param):
+                filters[key] = req.GET[param]
+        filters['state'] = req.GET.get('state', sharedfs_db.STATE_ACTIVE)
+        sort_key = req.GET.get('sort_key', 'name')
+        if sort_key == 'project':
+            sort_key = 'project_id'
+        sort_dir = req.GET.get('sort_dir', 'asc')
+
+        filesystems = self.fs_driver.list_fs()
+        sizes = dict((fs.get('name'), fs.get('size')) for fs in filesystems)
 
+        if self.has_db_support:
+            try:
+                db_page = sharedfs_db.filesystem_get_all(context,
+                                                         filters=filters,
+                                                         marker=marker,
+                                                         limit=limit,
+                                                         sort_key=sort_key,
+                                                         sort_dir=sort_dir)
+            except exception.InvalidInput as e:
+                raise webob.exc.HTTPBadRequest(explanation=unicode(e))
+            except exception.NotFound as e:
+                raise webob.exc.HTTPBadRequest(explanation=unicode(e))
+            page_names = [db_entry.name for db_entry in db_page]
+
+            # Only return filesystems in the db.
             fs_list = []
-            for fs in filesystems:
-                name = fs.get('name')
-                if name in db_list:
-                    db_entry = sharedfs_db.filesystem_get(context, name)
-                    fs_list.append({'name': fs.get('name'),
-                                    'size': fs.get('size'),
+            missing = []
+            for db_entry in db_page:
+                name = db_entry.name
+                if name in sizes:
+                    fs_list.append({'name': name,
+                                    'size': sizes[name],
                                     'scope': db_entry.get('scope'),
-                                    'project': db_entry.get('project_id')})
-                    db_list.remove(name)
-                else:
-                    LOG.warn(_("Found filesystem %s that is not recored "
-                             "in the database.  Ignoring.") % name)
+                                    'project': db_entry.get('project_id'),
+                                    'state': db_entry.get('state')})
+                elif db_entry.get('state') == sharedfs_db.STATE_ACTIVE:
+                    missing.append(name)
 
-            if db_list:
+            if missing:
                 LOG.warn(_("Possible database integrity issue.  The following "
                          "filesystems are recorded in the database but cannot "
-                         "be located: %s") % db_list)
+                         "be located: %s") % missing)
+
+            if (filters.keys() == ['state'] and not marker and
+                len(db_page) < limit):
+                # We have seen every active filesystem, so we can also
+                # spot filesystems that the database doesn't know about.
+                for name in sizes:
+                    if name not in page_names:
+                        if not sharedfs_db.filesystem_get(context, name):
+                            LOG.warn(_("Found filesystem %s that is not "
+                                       "recored in the database.  "
+                                       "Ignoring.") % name)
         else:
-            fs_list = [{'name': fs.get('name'), 'size': fs.get('size'),
+            names = sorted(name for name in sizes
+                           if name.startswith(filters.get('name', '')))
+            if sort_dir == 'desc':
+                names.reverse()
+            if marker is not None:
+                if marker not in names:
+                    msg = _("Marker %s not found.") % marker
+                    raise webob.exc.HTTPBadRequest(explanation=msg)
+                names = names[names.index(marker) + 1:]
+            page_names = names[:limit]
+            fs_list = [{'name': name, 'size': sizes[name],
                         'scope': 'unknown', 'project': 'unknown'}
-                       for fs in filesystems]
+                       for name in page_names]
+
+        result = _translate_fs_entries_view(fs_list)
+        if page_names and len(page_names) == limit:
+            result['fs_entries_links'] = [
+                {'rel': 'next',
+                 'href': self._next_link(req, page_names[-1])}]
+        return _with_etag(result, etag)
 
-        return _translate_fs_entries_view(fs_list)
+    def _next_link(self, req, marker):
+        params = dict(req.GET.items())
+        params['marker'] = marker
+        return "%s?%s" % (req.path_url, urllib.urlencode(params))
 
     @wsgi.serializers(xml=SharedFSTemplate)
+    @sharedfs_db.scoped_session
+    def show(self, req, id):
+        """Return a single file share."""
+        name = id
+        context = req.environ['nova.context']
+
+        scope = 'unknown'
+        project = 'unknown'
+        state = None
+        if self.has_db_support:
+            db_entry = sharedfs_db.filesystem_get(context, name)
+            if not db_entry:
+                msg = _("Filesystem %s not found.") % name
+                raise webob.exc.HTTPNotFound(msg)
+            scope = db_entry.get('scope')
+            project = db_entry.get('project_id')
+            state = db_entry.get('state')
+
+        size = None
+        if state in (None, sharedfs_db.STATE_ACTIVE):
+            fs = self.fs_driver.get_fs(name)
+            if not fs:
+                msg = _("Filesystem %s not found.") % name
+                raise webob.exc.HTTPNotFound(msg)
+            size = fs.get('size')
+
+        return _translate_fs_entry_view({'name': name,
+                                         'size': size,
+                                         'scope': scope,
+                                         'project': project,
+                                         'state': state})
+
+    @wsgi.response(202)
+    @wsgi.serializers(xml=SharedFSTemplate)
+    @sharedfs_db.scoped_session
     def update(self, req, id, body):
-        """Add new filesystem."""
+        """Add new filesystem.
+
+        The filesystem is created, and instances in its scope attached,
+        by a background job; the response includes the job so that the
+        caller can poll for completion.
+
+        The filesystem is recorded as 'creating' until the driver has
+        made it.  A filesystem left in 'error' by an earlier attempt, or
+        stuck creating or deleting for longer than
+        sharedfs_stale_state_timeout, may be created again; any other
+        existing filesystem is a conflict.
+        """
         name = id
         try:
             entry = body['fs_entry']
@@ -183,102 +429,216 @@ class SharedFSController(object):
         context = req.environ['nova.context']
         project = context.project_id
 
+        retry = False
+        state = None
+        if self.has_db_support:
+            retry = self._begin_create(context, name, scope, project)
+            state = sharedfs_db.STATE_CREATING
+
+        job = self.jobs.submit('create', name, self._create,
+                               context, name, size, scope, project, retry)
+
+        result = _translate_fs_entry_view({'name': name,
+                                           'size': size,
+                                           'scope': scope,
+                                           'project': project,
+                                           'state': state})
+        result.update(_translate_job_view(job))
+        return result
+
+    def _begin_create(self, context, name, scope, project):
+        """Record name as being created; return True for a retry."""
+        existing = sharedfs_db.filesystem_get(context, name)
+        if (existing and existing.state != sharedfs_db.STATE_ERROR and
+            not _is_stale(existing)):
+            msg = (_("Filesystem %(fs)s already exists (%(state)s).") %
+                   {'fs': name, 'state': existing.state})
+            raise webob.exc.HTTPConflict(explanation=msg)
+
+        if existing:
+            values = {'scope': scope,
+                      'project_id': project,
+                      'state': sharedfs_db.STATE_CREATING}
+            sharedfs_db.filesystem_update(context, name, values)
+            return True
+
         try:
-            if self.has_db_support:
-                sharedfs_db.filesystem_add(context, name, scope, project)
+            sharedfs_db.filesystem_add(context, name, scope, project,
+                                       state=sharedfs_db.STATE_CREATING)
+        except exception.DBError:
+            # Lost a race with another request creating the same name.
+            msg = _("Filesystem %s already exists.") % name
+            raise webob.exc.HTTPConflict(explanation=msg)
+        return False
+
+    @sharedfs_db.scoped_session
+    def _create(self, job, context, name, size, scope, project, retry):
+        if retry:
+            # Clear away whatever the failed attempt left on the backend.
+            self._remove_from_driver(name, project)
 
+        try:
             self.fs_driver.create_fs(name, project, size)
         except exception.NotAuthorized:
-            msg = _("Filesystem creation requires admin permissions.")
-            raise webob.exc.HTTPForbidden(msg)
+            self._rollback_create(context, name, project)
+            raise exception.NotAuthorized(
+                _("Filesystem creation requires admin permissions."))
+        except Exception:
+            with utils.save_and_reraise_exception():
+                self._rollback_create(context, name, project)
 
         if self.has_db_support:
+            sharedfs_db.filesystem_set_state(context, name,
+                                             sharedfs_db.STATE_ACTIVE)
+
             # Attach global or project-wide shares immediately.
-            instance_list = []
-            if scope == 'global':
-                instance_list = db.instance_get_all(context)
-            elif scope == 'project':
-                instance_list = db.instance_get_all_by_project(context,
-                                                               project)
-
-            for instance in instance_list:
-                try:
-                    fixed_ips = db.fixed_ip_get_by_instance(context,
-                                                            instance.id)
-                    for ip in fixed_ips:
-                        LOG.debug(_("attaching %(ip)s to filesystem %(fs)s.")
-                                  % {'ip': ip['address'], 'fs': name})
-                        try:
-                            self.fs_driver.attach(name, ip['address'])
-                        except exception.NotAuthorized:
-                            LOG.warning(_("Insufficient permissions to attach"
-                                       " %(instance)s to filesystem %(fs)s.") %
-                                       {'instance': instance.name, 'fs': name})
-                except exception.FixedIpNotFound:
-                    LOG.warning(_("Unable to get IP address for %s.")
-                              % instance.id)
+            self._update_scope(job, context, name, scope, project, 'attach')
 
-        return _translate_fs_entry_view({'name': name,
-                                         'size': size,
-                                         'scope': scope,
-                                         'project': project})
+    def _rollback_create(self, context, name, project):
+        """Undo a failed create, or mark it in error if that fails too."""
+        LOG.warn(_("Creation of filesystem %s failed; rolling back.") % name)
+        driver.invalidate(name)
+        removed = self._remove_from_driver(name, project)
+        if not self.has_db_support:
+            return
+        if removed:
+            sharedfs_db.filesystem_delete(context, name)
+        else:
+            sharedfs_db.filesystem_set_state(context, name,
+                                             sharedfs_db.STATE_ERROR)
 
+    def _remove_from_driver(self, name, project):
+        """Delete name from the backend if present; False on failure."""
+        try:
+            self.fs_driver.delete_fs(name, project)
+        except exception.NotFound:
+            pass
+        except Exception:
+            LOG.exception(_("Unable to remove filesystem %s from the "
+                            "backend.") % name)
+            return False
+        return True
+
+    def _update_scope(self, job, context, name, scope, project, verb):
+        """Attach or detach every instance in a share's scope.
+
+        The addresses of all the instances go to the driver as a single
+        access list update.
+        """
+        instance_list = []
+        if scope == 'global':
+            instance_list = db.instance_get_all(context)
+        elif scope == 'project':
+            instance_list = db.instance_get_all_by_project(context,
+                                                           project)
+
+        job.total = len(instance_list)
+        pairs = []
+        for instance in instance_list:
+            try:
+                fixed_ips = db.fixed_ip_get_by_instance(context,
+                                                        instance.id)
+            except exception.FixedIpNotFound:
+                LOG.warning(_("Unable to get IP address for %s.")
+                          % instance.id)
+                continue
+            pairs.extend((instance.uuid, ip['address']) for ip in fixed_ips)
+
+        addresses = [address for uuid, address in pairs]
+        if addresses:
+            LOG.debug(_("%(verb)s %(ips)s with filesystem %(fs)s.") %
+                      {'verb': verb, 'ips': addresses, 'fs': name})
+            try:
+                if verb == 'attach':
+                    self.fs_driver.update_attachments(name, addresses, [])
+                else:
+                    self.fs_driver.update_attachments(name, [], addresses)
+            except exception.NotAuthorized:
+                job.add_error(_("Insufficient permissions to %(verb)s "
+                                "%(count)d addresses with filesystem "
+                                "%(fs)s.") %
+                              {'verb': verb, 'count': len(addresses),
+                               'fs': name})
+                return
+            if verb == 'attach':
+                sharedfs_db.attachment_add_many(context, name, pairs)
+            else:
+                sharedfs_db.attachment_delete_many(context, name, addresses)
+        job.completed = job.total
+
+        if instance_list:
+            sharedfs_db.attachments_changed(context, name)
+
+    @wsgi.response(202)
+    @sharedfs_db.scoped_session
     def delete(self, req, id):
-        """Delete the filesystem identified by id."""
+        """Delete the filesystem identified by id.
+
+        Instances are detached and the filesystem removed by a
+        background job, which is returned to the caller.  A delete that
+        failed part way may simply be repeated, as may a create that has
+        been stuck for longer than sharedfs_stale_state_timeout.
+        """
         name = id
+        context = req.environ['nova.context']
 
+        fs_entry = None
         if self.has_db_support:
-            # Unattach global or project-wide shares immediately.
-            context = req.environ['nova.context']
             fs_entry = sharedfs_db.filesystem_get(context, name)
             if not fs_entry:
                 msg = _("Filesystem %s not found.") % name
                 raise webob.exc.HTTPNotFound(msg)
-            scope = fs_entry.scope
+            if (fs_entry.state == sharedfs_db.STATE_CREATING and
+                not _is_stale(fs_entry)):
+                msg = _("Filesystem %s is still being created.") % name
+                raise webob.exc.HTTPConflict(explanation=msg)
+            sharedfs_db.filesystem_set_state(context, name,
+                                             sharedfs_db.STATE_DELETING)
+
+        job = self.jobs.submit('delete', name, self._delete,
+                               context, name, fs_entry)
+        return _translate_job_view(job)
+
+    @sharedfs_db.scoped_session
+    def _delete(self, job, context, name, fs_entry):
+        try:
+            self._delete_fs(job, context, name, fs_entry)
+        except Exception:
+            with utils.save_and_reraise_exception():
+                driver.invalidate(name)
+                if fs_entry:
+                    sharedfs_db.filesystem_set_state(context, name,
+                                                     sharedfs_db.STATE_ERROR)
+
+    def _delete_fs(self, job, context, name, fs_entry):
+        project = context.project_id
+        if fs_entry:
+            # Unattach global or project-wide shares immediately.
             project = fs_entry.project_id
-            instance_list = []
-            if scope == 'global':
-                instance_list = db.instance_get_all(context)
-            elif scope == 'project':
-                instance_list = db.instance_get_all_by_project(context,
-                                                               project)
-
-            for instance in instance_list:
-                try:
-                    fixed_ips = db.fixed_ip_get_by_instance(context,
-                                                            instance.id)
-                    for ip in fixed_ips:
-                        LOG.debug(_("unattaching %(ip)s from fs %(fs)s.") %
-                                  {'ip': ip['address'], 'fs': name})
-                        try:
-                            self.fs_driver.unattach(name, ip['address'])
-                        except exception.NotAuthorized:
-                            LOG.warning(_("Insufficient permission to unattach"
-                                     " %(instance)s from filesystem %(fs)s.") %
-                                          {'instance': instance.name,
-                                           'fs': name})
-                except exception.FixedIpNotFound:
-                    LOG.warning(_("Unable to get IP address for %s.")
-                              % instance.id)
-
-            sharedfs_db.filesystem_delete(context, name)
+            self._update_scope(job, context, name, fs_entry.scope, project,
+                               'unattach')
 
         try:
             self.fs_driver.delete_fs(name, project)
-        except exception.NotAuthorized:
-            msg = _("Filesystem deletion requires admin permissions.")
-            raise webob.exc.HTTPForbidden(msg)
         except exception.NotFound:
-            msg = _("Filesystem %s does not exist.") % name
-            raise webob.exc.HTTPNotFound(msg)
+            if not fs_entry:
+                raise exception.NotFound(
+                    _("Filesystem %s does not exist.") % name)
+            # Already gone, most likely removed by an earlier attempt.
+            LOG.info(_("Filesystem %s was already removed from the "
+                       "backend.") % name)
+        except exception.NotAuthorized:
+            raise exception.NotAuthorized(
+                _("Filesystem deletion requires admin permissions."))
 
-        return webob.Response(status_int=202)
+        if fs_entry:
+            sharedfs_db.filesystem_delete(context, name)
 
 
 class SharedFSAttachmentController(object):
     """Shared FileSystem instance attachment controller for OpenStack API."""
     def __init__(self):
-        self.fs_driver = importutils.import_object(FLAGS.sharedfs_driver)
+        self.fs_driver = driver.get_driver()
         self.has_db_support = _has_db_support()
         if not self.has_db_support:
             LOG.warn(_("The Shared Filesystem database extensions are not "
@@ -286,34 +646,37 @@ class SharedFSAttachmentController(object):
                      "will not be supported."))
 
     @wsgi.serializers(xml=InstancesTemplate)
+    @sharedfs_db.scoped_session
     def index(self, req, filesystem_id):
-        """Return a list of attachments to the specified file share."""
+        """Return a list of attachments to the specified file share.
+
+        This is answered from the attachments recorded in the database;
+        the backend is not consulted.
+        """
         fs_name = filesystem_id
 
         context = req.environ['nova.context']
-        try:
-            ips = self.fs_driver.list_attachments(fs_name)
-        except KeyError:
-            msg = _("Filesystem %s does not exist.") % fs_name
-            raise webob.exc.HTTPNotFound(msg)
 
-        if 'localhost' in ips:
-            ips.remove('localhost')
+        generations = sharedfs_db.generation_get_many(context,
+                [sharedfs_db.FILESYSTEMS_GENERATION,
+                 sharedfs_db.attachments_generation_key(fs_name)])
+        etag = _make_etag(fs_name, *sorted(generations.items()))
+        not_modified = _not_modified(req, etag)
+        if not_modified:
+            return not_modified
+
+        _get_active_filesystem(context, fs_name)
 
         instances = []
-        for ip in ips:
-            try:
-                fixed_ip = db.fixed_ip_get_by_address(context, ip)
-                instance_id = fixed_ip.instance_id
-                instance = db.instance_get(context, instance_id)
-                instances.append(instance.uuid)
-            except exception.InstanceNotFound:
-                LOG.warning(_("Attached to a most-likely defunct "
-                            "instance with IP address %s") % ip)
+        for instance_uuid, address in \
+                sharedfs_db.attachment_get_all_by_filesystem(context, fs_name):
+            if instance_uuid not in instances:
+                instances.append(instance_uuid)
 
-        return _translate_instances_view(instances)
+        return _with_etag(_translate_instances_view(instances), etag)
 
     @wsgi.serializers(xml=InstanceTemplate)
+    @sharedfs_db.scoped_session
     def update(self, req, filesystem_id, id, body):
         """Attach an instance to a filesystem."""
         fs_name = filesystem_id
@@ -324,6 +687,7 @@ class SharedFSAttachmentController(object):
             raise webob.exc.HTTPUnprocessableEntity()
 
         context = req.environ['nova.context']
+        _get_active_filesystem(context, fs_name)
 
         instance = db.instance_get_by_uuid(context, instance_uuid)
         if not instance:
@@ -339,23 +703,33 @@ class SharedFSAttachmentController(object):
                      instance_id)
             raise webob.exc.HTTPNotFound(msg)
 
-        for ip in fixed_ips:
-            LOG.debug(_("attaching ip %(ip)s to filesystem %(fs)s.") %
-                      {'ip': ip['address'], 'fs': fs_name})
-            try:
-                self.fs_driver.attach(fs_name, ip['address'])
-            except exception.NotAuthorized:
-                msg = _("Filesystem attachment not permitted.")
-                raise webob.exc.HTTPForbidden(msg)
+        try:
+            for ip in fixed_ips:
+                LOG.debug(_("attaching ip %(ip)s to filesystem %(fs)s.") %
+                          {'ip': ip['address'], 'fs': fs_name})
+                try:
+                    self.fs_driver.attach(fs_name, ip['address'])
+                except exception.NotAuthorized:
+                    msg = _("Filesystem attachment not permitted.")
+                    raise webob.exc.HTTPForbidden(msg)
+                sharedfs_db.attachment_add_many(context, fs_name,
+                        [(instance_uuid, ip['address'])])
+        except Exception:
+            with utils.save_and_reraise_exception():
+                driver.invalidate(fs_name)
+        finally:
+            sharedfs_db.attachments_changed(context, fs_name)
 
         return _translate_instance_view(instance_uuid)
 
+    @sharedfs_db.scoped_session
     def delete(self, req, filesystem_id, id):
         """Detach an instance from a filesystem."""
         fs_name = filesystem_id
         instance_uuid = id
 
         context = req.environ['nova.context']
+        _get_active_filesystem(context, fs_name)
 
         instance = db.instance_get_by_uuid(context, instance_uuid)
         if not instance:
@@ -371,16 +745,121 @@ class SharedFSAttachmentController(object):
                      instance_id)
             raise webob.exc.HTTPNotFound(msg)
 
-        for ip in ips:
-            LOG.debug(_("unattaching ip %(ip)s from filesystem %(fs)s.") %
-                      {'ip': ip, 'fs': fs_name})
+        try:
+            for ip in ips:
+                LOG.debug(_("unattaching ip %(ip)s from filesystem %(fs)s.") %
+                          {'ip': ip, 'fs': fs_name})
+                try:
+                    self.fs_driver.unattach(fs_name, ip['address'])
+                except exception.NotAuthorized:
+                    msg = _("Filesystem detachment not permitted.")
+                    raise webob.exc.HTTPForbidden(msg)
+                sharedfs_db.attachment_delete_many(context, fs_name,
+                                                   [ip['address']])
+        except Exception:
+            with utils.save_and_reraise_exception():
+                driver.invalidate(fs_name)
+        finally:
+            sharedfs_db.attachments_changed(context, fs_name)
+
+        return webob.Response(status_int=202)
+
+    @sharedfs_db.scoped_session
+    def bulk(self, req, filesystem_id, body):
+        """Attach and/or detach many instances at once.
+
+        The body is {'attach': [uuid, ...], 'detach': [uuid, ...]};
+        either list may be omitted.  Addresses for all of the instances
+        are looked up in one query and applied in a single driver
+        update.  The outcome is reported separately for each instance.
+        """
+        fs_name = filesystem_id
+        try:
+            attach_uuids = list(body.get('attach') or [])
+            detach_uuids = list(body.get('detach') or [])
+        except (AttributeError, TypeError):
+            raise webob.exc.HTTPUnprocessableEntity()
+        if not (attach_uuids or detach_uuids):
+            raise webob.exc.HTTPUnprocessableEntity()
+
+        context = req.environ['nova.context']
+        _get_active_filesystem(context, fs_name)
+        addresses = sharedfs_db.fixed_ips_get_by_instance_uuids(
+            context, attach_uuids + detach_uuids)
+
+        results = []
+        applied = []
+        attach_ips = []
+        detach_ips = []
+        for action, uuids, ips in [('attach', attach_uuids, attach_ips),
+                                   ('detach', detach_uuids, detach_ips)]:
+            for uuid in uuids:
+                result = {'id': uuid, 'action': action, 'status': 'ok'}
+                if uuid not in addresses:
+                    result['status'] = 'error'
+                    result['message'] = (_("Unable to find instance %s.") %
+                                         uuid)
+                elif not addresses[uuid]:
+                    result['status'] = 'error'
+                    result['message'] = (_("Unable to get IP address for "
+                                           "instance %s.") % uuid)
+                else:
+                    ips.extend(addresses[uuid])
+                    applied.append(result)
+                results.append(result)
+
+        if applied:
+            LOG.debug(_("bulk update of filesystem %(fs)s: attaching "
+                        "%(attach)s, unattaching %(detach)s.") %
+                      {'fs': fs_name, 'attach': attach_ips,
+                       'detach': detach_ips})
             try:
-                self.fs_driver.unattach(fs_name, ip['address'])
+                self.fs_driver.update_attachments(fs_name, attach_ips,
+                                                  detach_ips)
             except exception.NotAuthorized:
-                msg = _("Filesystem detachment not permitted.")
+                msg = _("Filesystem attachment not permitted.")
                 raise webob.exc.HTTPForbidden(msg)
+            except (KeyError, exception.NotFound):
+                msg = _("Filesystem %s does not exist.") % fs_name
+                raise webob.exc.HTTPNotFound(msg)
+            except Exception as e:
+                LOG.exception(_("Bulk update of filesystem %s failed.") %
+                              fs_name)
+                driver.invalidate(fs_name)
+                for result in applied:
+                    result['status'] = 'error'
+                    result['message'] = unicode(e)
+            else:
+                sharedfs_db.attachment_add_many(context, fs_name,
+                        [(uuid, address) for uuid in attach_uuids
+                         for address in addresses.get(uuid, [])])
+                sharedfs_db.attachment_delete_many(context, fs_name,
+                                                   detach_ips)
+            finally:
+                sharedfs_db.attachments_changed(context, fs_name)
+
+        return {'results': results}
+
+
+class SharedFSJobController(object):
+    """Shared FileSystem background job controller for OpenStack API."""
 
-        return webob.Response(status_int=202)
+    def __init__(self):
+        self.jobs = jobs.get_manager()
+
+    @wsgi.serializers(xml=JobsTemplate)
+    def index(self, req, filesystem_id):
+        """Return the jobs known for the specified file share."""
+        return _translate_jobs_view(self.jobs.list(filesystem_id))
+
+    @wsgi.serializers(xml=JobTemplate)
+    def show(self, req, filesystem_id, id):
+        """Return the status and progress of a single job."""
+        job = self.jobs.get(id)
+        if not job or job.fs_name != filesystem_id:
+            msg = _("Job %s not found.") % id
+            raise webob.exc.HTTPNotFound(msg)
+        return _translate_job_view(job)
 
 
 class Shared_fs(extensions.ExtensionDescriptor):
@@ -392,6 +871,11 @@ class Shared_fs(extensions.ExtensionDescriptor):
     updated = "2012-03-01T00:00:00+00:00"
 
     def get_resources(self):
+        sharedfs_db.init_db()
+        # Attachments made before they were recorded in the database;
+        # in the background, since it asks the driver about every
+        # filesystem.
+        eventlet.spawn_n(reconcile.populate_attachments)
         resources = []
 
         res = extensions.ResourceExtension('os-shared-filesystem',
@@ -400,6 +884,13 @@ class Shared_fs(extensions.ExtensionDescriptor):
 
         res = extensions.ResourceExtension('attachments',
                          SharedFSAttachmentController(),
+                         parent={'member_name': 'filesystem',
+                                 'collection_name': 'os-shared-filesystem'},
+                         collection_actions={'bulk': 'POST'})
+        resources.append(res)
+
+        res = extensions.ResourceExtension('jobs',
+                         SharedFSJobController(),
                          parent={'member_name': 'filesystem',
                                  'collection_name': 'os-shared-filesystem'})
         resources.append(res)
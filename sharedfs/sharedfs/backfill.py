@@ -0,0 +1,184 @@
+# Copyright 2012 Andrew Bogott for the Wikimedia Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Attach existing instances to the global and project filesystems.
+
+The notifier only attaches instances as they are created, so instances
+that already existed when it was enabled, or when a filesystem's scope
+was widened, are left out.  The Backfiller reads every instance address
+from the nova database in chunks of sharedfs_backfill_chunk_size and
+works out which addresses each filesystem should allow.  It then adds
+the missing ones with one driver update per filesystem, working on up
+to sharedfs_backfill_workers filesystems at once.
+
+Unlike the reconciler, it never removes an address.
+
+Run sharedfs-backfill to backfill every active global and project
+filesystem, or those named in sharedfs_backfill_filesystems.
+"""
+
+import sys
+
+import eventlet
+
+from nova import context
+from nova import flags
+from nova import log as logging
+from nova.openstack.common import cfg
+from sharedfs import db as sharedfs_db
+from sharedfs import driver
+
+FLAGS = flags.FLAGS
+LOG = logging.getLogger("nova.plugin.%s" % __name__)
+
+backfill_opts = [
+    cfg.IntOpt('sharedfs_backfill_chunk_size',
+               default=1000,
+               help='Number of instance addresses read from the database '
+                    'at a time by sharedfs-backfill.'),
+    cfg.IntOpt('sharedfs_backfill_workers',
+               default=4,
+               help='Maximum number of filesystems backfilled at once.'),
+    cfg.BoolOpt('sharedfs_backfill_dry_run',
+                default=False,
+                help='Report which instances sharedfs-backfill would '
+                     'attach without attaching them.'),
+    cfg.ListOpt('sharedfs_backfill_filesystems',
+                default=[],
+                help='Filesystems for sharedfs-backfill to work on.  All '
+                     'active global and project filesystems if empty.'),
+]
+
+FLAGS.register_opts(backfill_opts)
+
+
+class Backfiller(object):
+    """Attaches the instances in each filesystem's scope that lack it."""
+
+    def __init__(self, fs_driver=None):
+        self.fs_driver = fs_driver or driver.get_driver()
+
+    @sharedfs_db.scoped_session
+    def run(self, ctxt, fs_names=None, dry_run=False):
+        """Backfill filesystems and return a report.
+
+        The report is a dict with a 'filesystems' list, holding the
+        addresses that were (or with dry_run, would be) attached to
+        each filesystem, and the number of instance addresses read.
+        Only active global and project filesystems are backfilled; any
+        other filesystem in fs_names is reported as skipped.
+        """
+        report = {'dry_run': dry_run, 'filesystems': [], 'skipped': [],
+                  'addresses': 0}
+
+        global_fs = []
+        project_fs = {}
+        for entry in sharedfs_db.filesystem_get_all(ctxt):
+            if fs_names and entry.name not in fs_names:
+                continue
+            active = entry.state == sharedfs_db.STATE_ACTIVE
+            if active and entry.scope == 'global':
+                global_fs.append(entry.name)
+            elif active and entry.scope == 'project':
+                project_fs.setdefault(entry.project_id,
+                                      []).append(entry.name)
+            elif fs_names:
+                report['skipped'].append(entry.name)
+        if fs_names:
+            known = set(global_fs + report['skipped'])
+            for names in project_fs.values():
+                known.update(names)
+            report['skipped'].extend(sorted(set(fs_names) - known))
+        if report['skipped']:
+            LOG.warn(_("Not backfilling %s: not active global or project "
+                       "filesystems.") % report['skipped'])
+
+        # {fs_name: {address: instance_uuid}}
+        wanted = dict((name, {}) for name in global_fs)
+        for names in project_fs.values():
+            for name in names:
+                wanted[name] = {}
+        if not wanted:
+            return report
+
+        for chunk in sharedfs_db.instance_addresses_get_chunks(
+                ctxt, FLAGS.sharedfs_backfill_chunk_size):
+            for project_id, uuid, address in chunk:
+                for name in global_fs + project_fs.get(project_id, []):
+                    wanted[name][address] = uuid
+            report['addresses'] += len(chunk)
+            LOG.info(_("Read %d instance addresses") % report['addresses'])
+
+        progress = {'done': 0, 'total': len(wanted)}
+        pool = eventlet.GreenPool(max(1, FLAGS.sharedfs_backfill_workers))
+        for name in sorted(wanted):
+            pool.spawn_n(self._backfill_fs, ctxt, name, wanted[name],
+                         dry_run, report, progress)
+        pool.waitall()
+
+        report['filesystems'].sort(key=lambda result: result['name'])
+        return report
+
+    @sharedfs_db.scoped_session
+    def _backfill_fs(self, ctxt, fs_name, wanted, dry_run, report,
+                     progress):
+        result = {'name': fs_name, 'missing': [], 'status': 'ok'}
+        report['filesystems'].append(result)
+        try:
+            actual = set(self.fs_driver.current_attachments(fs_name))
+            missing = sorted(set(wanted) - actual)
+            result['missing'] = missing
+            if not dry_run:
+                if missing:
+                    self.fs_driver.update_attachments(fs_name, missing, [])
+                sharedfs_db.attachment_add_many(ctxt, fs_name,
+                        [(uuid, address) for address, uuid in
+                         sorted(wanted.items())])
+                sharedfs_db.attachments_changed(ctxt, fs_name)
+        except Exception as e:
+            LOG.exception(_("Unable to backfill filesystem %s") % fs_name)
+            result['status'] = 'error'
+            result['message'] = unicode(e)
+
+        progress['done'] += 1
+        LOG.info(_("%(prefix)sfilesystem %(fs)s (%(done)d of %(total)d): "
+                   "%(status)s, %(count)d instance addresses added") %
+                 {'prefix': dry_run and _("Dry run: ") or '',
+                  'fs': fs_name, 'done': progress['done'],
+                  'total': progress['total'], 'status': result['status'],
+                  'count': len(result['missing'])})
+
+
+def main():
+    """Backfill from the command line and print the report."""
+    flags.parse_args(sys.argv)
+    logging.setup()
+    sharedfs_db.init_db()
+    dry_run = FLAGS.sharedfs_backfill_dry_run
+    report = Backfiller().run(context.get_admin_context(),
+                              fs_names=FLAGS.sharedfs_backfill_filesystems,
+                              dry_run=dry_run)
+
+    print("Read %d instance addresses." % report['addresses'])
+    for result in report['filesystems']:
+        line = "%s: %s; add %s" % (result['name'], result['status'],
+                                   result['missing'] or 'nothing')
+        if result.get('message'):
+            line += " (%s)" % result['message']
+        print(line)
+    for name in report['skipped']:
+        print("%s: skipped" % name)
+    if dry_run:
+        print("Dry run; nothing was changed.")
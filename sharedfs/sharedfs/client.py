@@ -14,9 +14,53 @@
 #    under the License.
 
 import logging
+import time
 import urllib
+import urlparse
 
 from novaclient import base
+from novaclient import exceptions
+
+
+class JobFailed(Exception):
+    """A background filesystem job finished with an error."""
+    pass
+
+
+class JobTimeout(Exception):
+    """A background filesystem job did not finish in time."""
+    pass
+
+
+class ConditionalGetMixin(object):
+    """Reuse the previous response for a URL when the server sends 304.
+
+    The server tags filesystem and attachment listings with an ETag;
+    sending it back in If-None-Match lets the server skip the backend
+    entirely when nothing has changed.
+    """
+
+    _etag_cache = None
+
+    def _conditional_get(self, url):
+        if self._etag_cache is None:
+            self._etag_cache = {}
+        cache = self._etag_cache
+        headers = {}
+        cached = cache.get(url)
+        if cached:
+            headers['If-None-Match'] = cached[0]
+
+        resp, body = self.api.client.get(url, headers=headers)
+        if resp.status == 304 and cached:
+            return cached[1]
+
+        etag = resp.get('etag')
+        if etag:
+            cache[url] = (etag, body)
+        else:
+            cache.pop(url, None)
+        return body
 
 
 class SharedFilesystem(base.Resource):
@@ -29,34 +73,138 @@ class SharedFilesystem(base.Resource):
         return self.manager.create_public(self.name, self.size, self.scope)
 
     def get(self):
-        entries = self.manager.fs_list()
-        for entry in entries:
-            if entry.get('name') == self.name:
-                return entry
-
-        return None
+        return self.manager.get(self.name)
 
 
-class SharedFileSystemManager(base.ManagerWithFind):
+class SharedFileSystemManager(ConditionalGetMixin, base.ManagerWithFind):
     resource_class = SharedFilesystem
 
-    def fs_list(self):
+    def get(self, name):
+        """Return a single filesystem."""
+        return self._get("/os-shared-filesystem/%s" % name, "fs_entry")
+
+    def list(self):
+        return self.fs_list()
+
+    def find(self, **kwargs):
+        """Find a single filesystem; lookups by name need one request."""
+        if kwargs.keys() == ['name']:
+            try:
+                return self.get(kwargs['name'])
+            except exceptions.NotFound:
+                msg = "No %s matching %s." % (self.resource_class.__name__,
+                                              kwargs)
+                raise exceptions.NotFound(404, msg)
+        return super(SharedFileSystemManager, self).find(**kwargs)
+
+    def fs_list(self, scope=None, project=None, prefix=None):
         """Return the list of existing filesystems."""
-        return self._list("/os-shared-filesystem", "fs_entries")
+        return list(self.fs_iter(scope=scope, project=project,
+                                 prefix=prefix))
+
+    def fs_page(self, limit=None, marker=None, scope=None, project=None,
+                prefix=None, sort_key=None, sort_dir=None):
+        """Return one page of filesystems and the marker for the next.
+
+        The returned marker is None when there are no more pages.
+        """
+        params = {'limit': limit, 'marker': marker, 'scope': scope,
+                  'project': project, 'prefix': prefix,
+                  'sort_key': sort_key, 'sort_dir': sort_dir}
+        query = urllib.urlencode(dict((k, v) for k, v in params.items()
+                                      if v is not None))
+        url = "/os-shared-filesystem"
+        if query:
+            url = "%s?%s" % (url, query)
+
+        body = self._conditional_get(url)
+        entries = [self.resource_class(self, entry, loaded=True)
+                   for entry in body['fs_entries'] if entry]
 
-    def create(self, name, size, scope):
-        """Create a shareable filesystem."""
+        next_marker = None
+        for link in body.get('fs_entries_links', []):
+            if link.get('rel') == 'next':
+                link_query = urlparse.urlparse(link['href']).query
+                next_marker = urlparse.parse_qs(link_query)['marker'][0]
+        return entries, next_marker
+
+    def fs_iter(self, page_size=None, **filters):
+        """Lazily yield filesystems, fetching pages as they are needed.
+
+        Accepts the same filter and sort arguments as fs_page.
+        """
+        marker = None
+        while True:
+            entries, marker = self.fs_page(limit=page_size, marker=marker,
+                                           **filters)
+            for entry in entries:
+                yield entry
+            if marker is None:
+                return
+
+    def create(self, name, size, scope, wait=False):
+        """Create a shareable filesystem.
+
+        The filesystem is built by a background job on the server.  If
+        wait is True, block until that job has finished.
+        """
         body = {'fs_entry':
                  {'size': size,
                   'scope': scope}}
 
         fs = self._update('/os-shared-filesystem/%s' % name,
                            body)
+        if wait and fs.get('job'):
+            SharedFSJobManager(self.api).wait(name, fs['job']['id'])
         return self.resource_class(self, fs['fs_entry'])
 
-    def delete(self, name):
-        """Delete an existing filesystem."""
-        self._delete("/os-shared-filesystem/%s" % name)
+    def delete(self, name, wait=False):
+        """Delete an existing filesystem.
+
+        If wait is True, block until the background deletion job has
+        finished.
+        """
+        resp, body = self.api.client.delete("/os-shared-filesystem/%s" %
+                                            name)
+        if wait and body and body.get('job'):
+            SharedFSJobManager(self.api).wait(name, body['job']['id'])
+
+
+class SharedFSJob(base.Resource):
+    HUMAN_ID = False
+
+    def is_finished(self):
+        return self.status in ('complete', 'error')
+
+
+class SharedFSJobManager(base.Manager):
+    resource_class = SharedFSJob
+
+    def list(self, fs_name):
+        """List the background jobs for a given filesystem."""
+        return self._list("/os-shared-filesystem/%s/jobs" % fs_name, "jobs")
+
+    def get(self, fs_name, job_id):
+        """Get the status of a single background job."""
+        return self._get("/os-shared-filesystem/%s/jobs/%s" %
+                         (fs_name, job_id), "job")
+
+    def wait(self, fs_name, job_id, poll_interval=2, timeout=None):
+        """Poll a job until it finishes and return it.
+
+        Raises JobFailed if the job ends in error and JobTimeout if it
+        has not finished after timeout seconds.
+        """
+        start = time.time()
+        while True:
+            job = self.get(fs_name, job_id)
+            if job.status == 'error':
+                raise JobFailed("; ".join(job.errors) or job.id)
+            if job.is_finished():
+                return job
+            if timeout is not None and time.time() - start > timeout:
+                raise JobTimeout(job.id)
+            time.sleep(poll_interval)
 
 
 class SharedFSAttachment(base.Resource):
@@ -69,13 +217,16 @@ class SharedFSAttachment(base.Resource):
         self.manager.create_public(fs_name, self.id)
 
 
-class SharedFSAttachmentManager(base.ManagerWithFind):
+class SharedFSAttachmentManager(ConditionalGetMixin,
+                                base.ManagerWithFind):
     resource_class = SharedFSAttachment
 
     def attachments(self, fs_name):
         """List the instance IDs attached to a given Filesystem."""
-        return self._list("/os-shared-filesystem/%s/attachments" % fs_name,
-                          "instance_entries")
+        body = self._conditional_get("/os-shared-filesystem/%s/attachments" %
+                                     fs_name)
+        return [self.resource_class(self, entry, loaded=True)
+                for entry in body['instance_entries'] if entry]
 
     def attach(self, fs_name, instance_id):
         """Attach a filesystem to an instance."""
@@ -87,3 +238,26 @@ class SharedFSAttachmentManager(base.ManagerWithFind):
         """Detach a filesystem from an instance."""
         self._delete("/os-shared-filesystem/%s/attachments/%s" %
                      (fs_name, instance_id))
+
+    def bulk_update(self, fs_name, attach_ids=None, unattach_ids=None):
+        """Attach and detach many instances in one request.
+
+        Returns a list of per-instance results, each a dict with 'id',
+        'action', 'status' ('ok' or 'error') and possibly 'message'.
+        """
+        body = {}
+        if attach_ids:
+            body['attach'] = list(attach_ids)
+        if unattach_ids:
+            body['detach'] = list(unattach_ids)
+        resp, body = self.api.client.post(
+            "/os-shared-filesystem/%s/attachments/bulk" % fs_name, body=body)
+        return body['results']
+
+    def bulk_attach(self, fs_name, instance_ids):
+        """Attach a filesystem to many instances."""
+        return self.bulk_update(fs_name, attach_ids=instance_ids)
+
+    def bulk_unattach(self, fs_name, instance_ids):
+        """Detach a filesystem from many instances."""
+        return self.bulk_update(fs_name, unattach_ids=instance_ids)
@@ -13,15 +13,28 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
+import datetime
+import functools
+import time
+
+from eventlet import corolocal
+from eventlet import greenthread
 import sqlalchemy
-from sqlalchemy import Column, String, DateTime, Boolean
+from sqlalchemy import Column, String, DateTime, Boolean, Integer
+from sqlalchemy import event
+from sqlalchemy import exc as sqla_exc
+from sqlalchemy.engine import reflection
 from sqlalchemy.ext.declarative import declarative_base
 
 import nova
+from nova import exception
 from nova import flags
 from nova import log as logging
 from nova.openstack.common import cfg
+from nova import utils
 from nova.db.sqlalchemy import models
+from nova.db.sqlalchemy import session as nova_session
 
 
 FLAGS = flags.FLAGS
@@ -34,12 +47,77 @@ opts = [
     cfg.StrOpt('sharedfs_sql_connection',
                default='sqlite:///$state_path/$sharedfs_sqlite_db',
                help='connection string for sharedfs sql database'),
+    cfg.IntOpt('sharedfs_sql_pool_size',
+               default=5,
+               help='Number of connections kept open to the sharedfs '
+                    'database.  Not used with sqlite.'),
+    cfg.IntOpt('sharedfs_sql_max_overflow',
+               default=10,
+               help='Number of connections to the sharedfs database that '
+                    'may be opened beyond sharedfs_sql_pool_size under '
+                    'load.  Not used with sqlite.'),
+    cfg.IntOpt('sharedfs_sql_pool_recycle',
+               default=3600,
+               help='Seconds after which a pooled sharedfs database '
+                    'connection is replaced.'),
+    cfg.BoolOpt('sharedfs_sql_pre_ping',
+                default=True,
+                help='Check that a pooled sharedfs database connection is '
+                     'still alive before using it.  Not used with sqlite.'),
+    cfg.BoolOpt('sharedfs_fs_cache',
+                default=True,
+                help='Keep a copy of the filesystems table in memory, '
+                     'refreshed when its generation changes.'),
+    cfg.IntOpt('sharedfs_fs_cache_ttl',
+               default=5,
+               help='Seconds for which the in-memory filesystems table is '
+                    'used without checking its generation.  Changes made '
+                    'by other processes may take this long to be seen.'),
+    cfg.IntOpt('sharedfs_purge_age',
+               default=7 * 24 * 60 * 60,
+               help='Seconds after which soft-deleted sharedfs records are '
+                    'purged.  0 disables purging.'),
+    cfg.IntOpt('sharedfs_purge_batch_size',
+               default=100,
+               help='Number of soft-deleted records purged per '
+                    'transaction.'),
+    cfg.FloatOpt('sharedfs_purge_batch_interval',
+                 default=1.0,
+                 help='Seconds to pause between purge batches, so that a '
+                      'large purge does not hold up other writers.'),
 ]
 
 FLAGS.register_opts(opts)
 
 _ENGINE = None
 _MAKER = None
+_SCHEMA_READY = False
+
+# Holds the session shared by a session_scope(), per greenthread, so that
+# background jobs started from a request get sessions of their own.
+_LOCAL = corolocal.local()
+
+# Generation keys.  'filesystems' changes whenever a filesystem is added
+# or removed; each filesystem's attachment key changes whenever an
+# instance is attached to or detached from it.
+FILESYSTEMS_GENERATION = 'filesystems'
+
+# Bumped once the attachments of filesystems attached before they were
+# recorded in the database have been filled in.
+ATTACHMENTS_POPULATED = 'attachments_populated'
+
+# Filesystem states.  Creation and deletion each touch both the database
+# and the driver; a filesystem is only 'active' once both agree that it
+# exists, and is left in 'error' if a failed step could not be undone.
+STATE_CREATING = 'creating'
+STATE_ACTIVE = 'active'
+STATE_DELETING = 'deleting'
+STATE_ERROR = 'error'
+
+# Secondary indexes on the filesystems table, by name and column.
+FILESYSTEM_INDEXES = [('filesystems_scope_idx', 'scope'),
+                      ('filesystems_project_id_idx', 'project_id'),
+                      ('filesystems_deleted_idx', 'deleted')]
 
 
 class FileSystem(models.BASE, models.NovaBase):
@@ -48,6 +126,23 @@ class FileSystem(models.BASE, models.NovaBase):
     name = sqlalchemy.Column(String(255), primary_key=True)
     scope = sqlalchemy.Column(String(255))
     project_id = sqlalchemy.Column(String(255))
+    state = sqlalchemy.Column(String(255), default=STATE_ACTIVE)
+
+
+class FileSystemAttachment(models.BASE, models.NovaBase):
+    """Records that an instance address has access to a filesystem."""
+    __tablename__ = 'filesystem_attachments'
+    id = sqlalchemy.Column(Integer, primary_key=True)
+    filesystem = sqlalchemy.Column(String(255), index=True)
+    instance_uuid = sqlalchemy.Column(String(36), index=True)
+    address = sqlalchemy.Column(String(255), index=True)
+
+
+class Generation(models.BASE, models.NovaBase):
+    """A counter that is bumped whenever the state it names changes."""
+    __tablename__ = 'sharedfs_generations'
+    key = sqlalchemy.Column(String(255), primary_key=True)
+    generation = sqlalchemy.Column(Integer, default=0)
 
 
 def get_maker(engine, autocommit=True, expire_on_commit=False):
@@ -57,8 +152,7 @@ def get_maker(engine, autocommit=True, expire_on_commit=False):
                                        expire_on_commit=expire_on_commit)
 
 
-def get_session(autocommit=True, expire_on_commit=False):
-    """Return a SQLAlchemy session."""
+def _new_session(autocommit=True, expire_on_commit=False):
     global _MAKER
 
     if _MAKER is None:
@@ -71,6 +165,59 @@ def get_session(autocommit=True, expire_on_commit=False):
     return session
 
 
+def get_session(autocommit=True, expire_on_commit=False):
+    """Return a SQLAlchemy session.
+
+    Inside a session_scope() this is the scope's session.
+    """
+    session = getattr(_LOCAL, 'session', None)
+    if session is not None:
+        return session
+    return _new_session(autocommit, expire_on_commit)
+
+
+@contextlib.contextmanager
+def session_scope():
+    """Share one session among all the db calls made in a with block.
+
+    Scopes may be nested; the outermost one owns the session and closes
+    it on exit.
+    """
+    session = getattr(_LOCAL, 'session', None)
+    if session is not None:
+        yield session
+        return
+
+    session = _new_session()
+    _LOCAL.session = session
+    try:
+        yield session
+    finally:
+        _LOCAL.session = None
+        session.close()
+
+
+def scoped_session(f):
+    """Decorator running f within a session_scope()."""
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        with session_scope():
+            return f(*args, **kwargs)
+    return wrapper
+
+
+def _save(session, model_ref):
+    """Save model_ref, leaving the session usable if that fails."""
+    try:
+        model_ref.save(session=session)
+    except Exception:
+        # Otherwise a shared session would retry the insert on every
+        # later flush.
+        if model_ref in session:
+            session.expunge(model_ref)
+        raise
+
+
 def create_table(engine):
     meta = sqlalchemy.MetaData()
     meta.bind = engine
@@ -93,32 +240,195 @@ def create_table(engine):
             String(length=255, convert_unicode=False,
                           assert_unicode=None,
                           unicode_error=None, _warn_on_bytestring=False)),
+            Column('state',
+                   String(length=255, convert_unicode=False,
+                          assert_unicode=None,
+                          unicode_error=None, _warn_on_bytestring=False)),
+            )
+
+    generations = sqlalchemy.Table('sharedfs_generations', meta,
+            Column('created_at', DateTime(timezone=False)),
+            Column('updated_at', DateTime(timezone=False)),
+            Column('deleted_at', DateTime(timezone=False)),
+            Column('deleted', Boolean(create_constraint=True, name=None)),
+            Column('key',
+                   String(length=255, convert_unicode=False,
+                          assert_unicode=None,
+                          unicode_error=None, _warn_on_bytestring=False),
+                   primary_key=True, nullable=False),
+            Column('generation', Integer()),
+            )
+
+    attachments = sqlalchemy.Table('filesystem_attachments', meta,
+            Column('created_at', DateTime(timezone=False)),
+            Column('updated_at', DateTime(timezone=False)),
+            Column('deleted_at', DateTime(timezone=False)),
+            Column('deleted', Boolean(create_constraint=True, name=None)),
+            Column('id', Integer(), primary_key=True, nullable=False),
+            Column('filesystem',
+                   String(length=255, convert_unicode=False,
+                          assert_unicode=None,
+                          unicode_error=None, _warn_on_bytestring=False),
+                   index=True),
+            Column('instance_uuid',
+                   String(length=36, convert_unicode=False,
+                          assert_unicode=None,
+                          unicode_error=None, _warn_on_bytestring=False),
+                   index=True),
+            Column('address',
+                   String(length=255, convert_unicode=False,
+                          assert_unicode=None,
+                          unicode_error=None, _warn_on_bytestring=False),
+                   index=True),
             )
-    # create filesystems table
+
+    # create filesystems, generations and attachments tables
+    for table in (filesystems, generations, attachments):
+        try:
+            table.create(engine, checkfirst=True)
+        except Exception:
+            LOG.error(_("Table |%s| not created!"), repr(table))
+            raise
+
+    upgrade_table(engine)
+
+
+def upgrade_table(engine):
+    """Bring a filesystems table from an older release up to date."""
+    meta = sqlalchemy.MetaData()
+    meta.bind = engine
+    filesystems = sqlalchemy.Table('filesystems', meta, autoload=True)
+
+    if 'state' not in filesystems.c:
+        LOG.info(_("Adding state column to the filesystems table"))
+        engine.execute('ALTER TABLE filesystems ADD COLUMN state '
+                       'VARCHAR(255)')
+        # Everything created before states existed is assumed usable.
+        engine.execute(
+            sqlalchemy.text('UPDATE filesystems SET state = :state'),
+            state=STATE_ACTIVE)
+
+    inspector = reflection.Inspector.from_engine(engine)
+    existing = set(index['name']
+                   for index in inspector.get_indexes('filesystems'))
+    for name, column in FILESYSTEM_INDEXES:
+        if name in existing:
+            continue
+        LOG.info(_("Adding index %s to the filesystems table") % name)
+        try:
+            sqlalchemy.Index(name, filesystems.c[column]).create(engine)
+        except Exception:
+            # Most likely created by another process in the meantime.
+            LOG.warn(_("Unable to create index %s; it may already "
+                       "exist.") % name)
+
+
+def _ping_listener(dbapi_conn, connection_rec, connection_proxy):
+    """Make sure a pooled connection is still usable before handing it out.
+
+    If it isn't, the pool discards it and tries another.
+    """
     try:
-        filesystems.create(engine, checkfirst=True)
-    except Exception:
-        LOG.error(_("Table |%s| not created!"), repr(filesystems))
-        raise
+        dbapi_conn.cursor().execute('select 1')
+    except Exception as e:
+        LOG.warn(_("Got database connection error %s; reconnecting.") % e)
+        raise sqla_exc.DisconnectionError(e)
 
 
 def get_engine():
     global _ENGINE
     if _ENGINE:
         return _ENGINE
-    models = [FileSystem]
-    engine = sqlalchemy.create_engine(FLAGS.sharedfs_sql_connection,
-                                      echo=False)
-    for model in models:
-        model.metadata.create_all(engine)
+
+    connection = FLAGS.sharedfs_sql_connection
+    engine_args = {'echo': False,
+                   'pool_recycle': FLAGS.sharedfs_sql_pool_recycle}
+    is_sqlite = connection.startswith('sqlite')
+    if not is_sqlite:
+        engine_args['pool_size'] = FLAGS.sharedfs_sql_pool_size
+        engine_args['max_overflow'] = FLAGS.sharedfs_sql_max_overflow
+
+    engine = sqlalchemy.create_engine(connection, **engine_args)
+    if FLAGS.sharedfs_sql_pre_ping and not is_sqlite:
+        event.listen(engine, 'checkout', _ping_listener)
     _ENGINE = engine
-    create_table(_ENGINE)
     return _ENGINE
 
 
+def init_db():
+    """Create or upgrade the sharedfs tables.
+
+    Services call this once at startup, so that requests never have to.
+    """
+    global _SCHEMA_READY
+    if _SCHEMA_READY:
+        return
+    create_table(get_engine())
+    _SCHEMA_READY = True
+
+
+class _FileSystemCache(object):
+    """Process-local copy of the filesystems table.
+
+    The copy is tagged with the FILESYSTEMS_GENERATION it was loaded at.
+    Readers check the generation, at most once per sharedfs_fs_cache_ttl
+    seconds, and reload the table when another process has changed it.
+    Writes made by this process invalidate the copy straight away.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.generation = None
+        self.checked_at = 0
+
+    def get(self, context):
+        """Return a dict of filesystem records by name."""
+        now = time.time()
+        if (self.generation is not None and
+            now - self.checked_at < FLAGS.sharedfs_fs_cache_ttl):
+            return self.records
+
+        # Read the generation before the table: if the table changes in
+        # between, the next check sees a newer generation and reloads.
+        generation = generation_get(context, FILESYSTEMS_GENERATION)
+        if generation != self.generation:
+            records = _filesystem_load_all(context)
+            self.records = dict((record.name, record) for record in records)
+            self.generation = generation
+        self.checked_at = now
+        return self.records
+
+    def invalidate(self):
+        self.generation = None
+
+
+_FS_CACHE = _FileSystemCache()
+
+
+def _filesystem_load_all(context):
+    session = get_session()
+    return session.query(FileSystem).filter_by(deleted=False).all()
+
+
+def _cached_filesystems(context):
+    """Return the cached filesystem records, or None if not caching."""
+    if not FLAGS.sharedfs_fs_cache:
+        return None
+    return _FS_CACHE.get(context)
+
+
+def filesystem_cache_invalidate():
+    """Make the next read in this process reload the filesystems table."""
+    _FS_CACHE.invalidate()
+
+
 def filesystem_list(context):
+    records = _cached_filesystems(context)
+    if records is not None:
+        return sorted(records)
+
     session = get_session()
-    records = session.query(FileSystem).all()
+    records = session.query(FileSystem).filter_by(deleted=False).all()
     fs_names = []
     for record in records:
         fs_names.append(record.name)
@@ -126,23 +436,517 @@ def filesystem_list(context):
     return fs_names
 
 
+def _like_prefix(prefix):
+    """Return a LIKE pattern matching strings that start with prefix."""
+    for char in ('\\', '%', '_'):
+        prefix = prefix.replace(char, '\\' + char)
+    return prefix + '%'
+
+
+def filesystem_get_all(context, filters=None, marker=None, limit=None,
+                       sort_key='name', sort_dir='asc'):
+    """Return filesystem records, filtered, sorted and paginated.
+
+    filters may contain 'scope', 'project_id', 'state' and 'name', the
+    last being matched as a prefix.  marker is the name of the final record
+    of the previous page.  Records are ordered by sort_key and then by
+    name.
+    """
+    if sort_key not in ('name', 'scope', 'project_id'):
+        raise exception.InvalidInput(reason=_("Invalid sort key %s") %
+                                            sort_key)
+    if sort_dir not in ('asc', 'desc'):
+        raise exception.InvalidInput(reason=_("Invalid sort direction %s") %
+                                            sort_dir)
+
+    filters = filters or {}
+    records = _cached_filesystems(context)
+    if records is not None:
+        return _filesystem_select(records, filters, marker, limit,
+                                  sort_key, sort_dir)
+
+    session = get_session()
+    query = session.query(FileSystem).filter_by(deleted=False)
+    if filters.get('scope'):
+        query = query.filter_by(scope=filters['scope'])
+    if filters.get('project_id'):
+        query = query.filter_by(project_id=filters['project_id'])
+    if filters.get('state'):
+        query = query.filter_by(state=filters['state'])
+    if filters.get('name'):
+        query = query.filter(FileSystem.name.like(
+                                 _like_prefix(filters['name']), escape='\\'))
+
+    sort_column = getattr(FileSystem, sort_key)
+    if sort_dir == 'asc':
+        after = lambda column, value: column > value
+        query = query.order_by(sort_column.asc(), FileSystem.name.asc())
+    else:
+        after = lambda column, value: column < value
+        query = query.order_by(sort_column.desc(), FileSystem.name.desc())
+
+    if marker is not None:
+        marker_ref = session.query(FileSystem).\
+                             filter_by(name=marker).\
+                             filter_by(deleted=False).\
+                             first()
+        if not marker_ref:
+            raise exception.NotFound(_("Marker %s not found.") % marker)
+        if sort_key == 'name':
+            query = query.filter(after(FileSystem.name, marker))
+        else:
+            value = getattr(marker_ref, sort_key)
+            query = query.filter(sqlalchemy.or_(
+                after(sort_column, value),
+                sqlalchemy.and_(sort_column == value,
+                                after(FileSystem.name, marker))))
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query.all()
+
+
+def _filesystem_select(records, filters, marker, limit, sort_key, sort_dir):
+    """filesystem_get_all() over in-memory records."""
+    selected = []
+    for record in records.values():
+        if filters.get('name') and \
+           not record.name.startswith(filters['name']):
+            continue
+        if any(filters.get(key) and record[key] != filters[key]
+               for key in ('scope', 'project_id', 'state')):
+            continue
+        selected.append(record)
+
+    sort_value = lambda record: (record[sort_key], record.name)
+    selected.sort(key=sort_value, reverse=(sort_dir == 'desc'))
+
+    if marker is not None:
+        if marker not in records:
+            raise exception.NotFound(_("Marker %s not found.") % marker)
+        marker_value = sort_value(records[marker])
+        if sort_dir == 'asc':
+            selected = [r for r in selected if sort_value(r) > marker_value]
+        else:
+            selected = [r for r in selected if sort_value(r) < marker_value]
+
+    if limit is not None:
+        selected = selected[:limit]
+    return selected
+
+
+def filesystem_names_get_for_project(context, project_id):
+    """Return the active filesystems every instance of a project uses.
+
+    That is all global filesystems plus the project's own project-scope
+    filesystems, taken from the in-memory copy of the table or else
+    fetched in a single query.
+    """
+    records = _cached_filesystems(context)
+    if records is not None:
+        return sorted(name for name, record in records.items()
+                      if record.state == STATE_ACTIVE and
+                         (record.scope == 'global' or
+                          (record.scope == 'project' and
+                           record.project_id == project_id)))
+
+    in_project = sqlalchemy.and_(FileSystem.scope == 'project',
+                                 FileSystem.project_id == project_id)
+    session = get_session()
+    query = session.query(FileSystem.name).\
+                    filter(sqlalchemy.or_(FileSystem.scope == 'global',
+                                          in_project)).\
+                    filter_by(state=STATE_ACTIVE).\
+                    filter_by(deleted=False)
+    return [row.name for row in query.order_by(FileSystem.name).all()]
+
+
 def filesystem_get(context, fs_name):
+    records = _cached_filesystems(context)
+    if records is not None:
+        return records.get(fs_name)
+
+    session = get_session()
+    with session.begin(subtransactions=True):
+        return session.query(FileSystem).\
+                       filter_by(name=fs_name).\
+                       filter_by(deleted=False).\
+                       first()
+
+
+def filesystem_add(context, fs_name, scope, project_id,
+                   state=STATE_ACTIVE):
+    return filesystem_add_many(context, [{'name': fs_name,
+                                          'scope': scope,
+                                          'project_id': project_id,
+                                          'state': state}])[0]
+
+
+def filesystem_add_many(context, values_list):
+    """Add several filesystem records in one transaction.
+
+    Each item of values_list is a dict with 'name', 'scope',
+    'project_id' and optionally 'state'.  A soft-deleted record with the
+    same name is brought back to life rather than conflicting.  If any
+    name is in use, nothing is added and DBError is raised.
+    """
+    if not values_list:
+        return []
+    names = [values['name'] for values in values_list]
     session = get_session()
-    with session.begin():
-        return session.query(FileSystem).filter_by(name=fs_name).first()
+    with session.begin(subtransactions=True):
+        deleted = dict((fs_ref.name, fs_ref) for fs_ref in
+                       session.query(FileSystem).
+                               filter(FileSystem.name.in_(names)).
+                               filter_by(deleted=True).
+                               all())
+        fs_refs = []
+        for values in values_list:
+            fs_ref = deleted.get(values['name'])
+            if fs_ref is None:
+                fs_ref = FileSystem()
+            else:
+                fs_ref.update({'deleted': False,
+                               'deleted_at': None,
+                               'created_at': utils.utcnow()})
+            fs_ref.update(dict({'state': STATE_ACTIVE}, **values))
+            session.add(fs_ref)
+            fs_refs.append(fs_ref)
+        session.flush()
+    _filesystems_changed(context)
+    return fs_refs
 
 
-def filesystem_add(context, fs_name, scope, project_id):
+def filesystem_update(context, fs_name, values):
+    """Update the record for fs_name, raising NotFound if it is gone."""
     session = get_session()
-    fs_ref = FileSystem()
-    fs_ref.update({'name': fs_name,
-                   'scope': scope,
-                   'project_id': project_id})
-    fs_ref.save(session=session)
-    return fs_ref
+    with session.begin(subtransactions=True):
+        updated = session.query(FileSystem).\
+                          filter_by(name=fs_name).\
+                          filter_by(deleted=False).\
+                          update(values, synchronize_session=False)
+    if not updated:
+        raise exception.NotFound(_("Filesystem %s not found.") % fs_name)
+    _filesystems_changed(context)
+
+
+def filesystem_set_state(context, fs_name, state):
+    filesystem_update(context, fs_name, {'state': state})
+
+
+def _soft_delete(query):
+    return query.filter_by(deleted=False).\
+                 update({'deleted': True, 'deleted_at': utils.utcnow()},
+                        synchronize_session=False)
 
 
 def filesystem_delete(context, fs_name):
+    filesystem_delete_many(context, [fs_name])
+
+
+def filesystem_delete_many(context, fs_names):
+    """Soft-delete filesystems and their attachments in one transaction."""
+    if not fs_names:
+        return
     session = get_session()
-    with session.begin():
-        session.query(FileSystem).filter_by(name=fs_name).delete()
+    with session.begin(subtransactions=True):
+        _soft_delete(session.query(FileSystem).
+                             filter(FileSystem.name.in_(fs_names)))
+        _soft_delete(session.query(FileSystemAttachment).
+                             filter(FileSystemAttachment.filesystem.in_(
+                                 fs_names)))
+    _filesystems_changed(context)
+    for fs_name in fs_names:
+        generation_bump(context, attachments_generation_key(fs_name))
+
+
+def _purge_batch(session, model, key, cutoff, batch_size):
+    """Hard-delete up to batch_size records soft-deleted before cutoff."""
+    with session.begin(subtransactions=True):
+        keys = [row[0] for row in
+                session.query(key).
+                        filter(model.deleted == True).
+                        filter(model.deleted_at < cutoff).
+                        limit(batch_size).
+                        all()]
+        if keys:
+            session.query(model).\
+                    filter(key.in_(keys)).\
+                    delete(synchronize_session=False)
+    return len(keys)
+
+
+def purge_deleted(context, age=None, batch_size=None, interval=None):
+    """Remove records that were soft-deleted more than age seconds ago.
+
+    Records are removed batch_size at a time, each batch in its own
+    transaction with a pause of interval seconds in between, so that a
+    big purge never holds long locks.  Returns the number removed.
+    """
+    if age is None:
+        age = FLAGS.sharedfs_purge_age
+    if batch_size is None:
+        batch_size = FLAGS.sharedfs_purge_batch_size
+    if interval is None:
+        interval = FLAGS.sharedfs_purge_batch_interval
+    if not age:
+        return 0
+
+    cutoff = utils.utcnow() - datetime.timedelta(seconds=age)
+    session = get_session()
+    purged = 0
+    for model, key in [(FileSystemAttachment, FileSystemAttachment.id),
+                       (FileSystem, FileSystem.name)]:
+        while True:
+            count = _purge_batch(session, model, key, cutoff, batch_size)
+            purged += count
+            if count < batch_size:
+                break
+            greenthread.sleep(interval)
+    if purged:
+        LOG.info(_("Purged %d soft-deleted sharedfs records.") % purged)
+    return purged
+
+
+def _filesystems_changed(context):
+    generation_bump(context, FILESYSTEMS_GENERATION)
+    _FS_CACHE.invalidate()
+
+
+def attachments_generation_key(fs_name):
+    return 'attachments:%s' % fs_name
+
+
+def generation_get_many(context, keys):
+    """Return a dict of the current generation for each key.
+
+    Keys that have never been bumped are at generation 0.
+    """
+    session = get_session()
+    records = session.query(Generation).\
+                      filter(Generation.key.in_(keys)).\
+                      all()
+    generations = dict((key, 0) for key in keys)
+    for record in records:
+        generations[record.key] = record.generation
+    return generations
+
+
+def generation_get(context, key):
+    return generation_get_many(context, [key])[key]
+
+
+def generation_bump(context, key):
+    """Increment the generation for key, creating it if needed."""
+    session = get_session()
+    with session.begin(subtransactions=True):
+        updated = session.query(Generation).\
+                          filter_by(key=key).\
+                          update({'generation': Generation.generation + 1},
+                                 synchronize_session=False)
+    if updated:
+        return
+
+    try:
+        gen_ref = Generation()
+        gen_ref.update({'key': key, 'generation': 1})
+        _save(session, gen_ref)
+    except Exception:
+        # Someone else created it first; count our change too.
+        with session.begin(subtransactions=True):
+            session.query(Generation).\
+                    filter_by(key=key).\
+                    update({'generation': Generation.generation + 1},
+                           synchronize_session=False)
+
+
+def attachments_changed(context, fs_name):
+    """Record that the attachments of fs_name have changed."""
+    generation_bump(context, attachments_generation_key(fs_name))
+
+
+def attachment_get_all_by_filesystem(context, fs_name):
+    """Return (instance_uuid, address) for everything attached to fs_name."""
+    session = get_session()
+    query = session.query(FileSystemAttachment.instance_uuid,
+                          FileSystemAttachment.address).\
+                    filter_by(filesystem=fs_name).\
+                    filter_by(deleted=False).\
+                    order_by(FileSystemAttachment.id)
+    return query.all()
+
+
+def attachment_get_all_by_instance(context, instance_uuid):
+    """Return (filesystem, address) for every attachment of an instance."""
+    session = get_session()
+    query = session.query(FileSystemAttachment.filesystem,
+                          FileSystemAttachment.address).\
+                    filter_by(instance_uuid=instance_uuid).\
+                    filter_by(deleted=False).\
+                    order_by(FileSystemAttachment.id)
+    return query.all()
+
+
+def attachment_add_many(context, fs_name, attachments):
+    """Record (instance_uuid, address) pairs as attached to fs_name.
+
+    Pairs that are already recorded are left alone.
+    """
+    if not attachments:
+        return
+    session = get_session()
+    with session.begin(subtransactions=True):
+        addresses = [address for uuid, address in attachments]
+        existing = set(session.query(FileSystemAttachment.instance_uuid,
+                                     FileSystemAttachment.address).
+                       filter_by(filesystem=fs_name).
+                       filter_by(deleted=False).
+                       filter(FileSystemAttachment.address.in_(addresses)).
+                       all())
+        for instance_uuid, address in set(attachments) - existing:
+            attachment_ref = FileSystemAttachment()
+            attachment_ref.update({'filesystem': fs_name,
+                                   'instance_uuid': instance_uuid,
+                                   'address': address})
+            session.add(attachment_ref)
+
+
+def attachment_delete_many(context, fs_name, addresses):
+    """Forget that addresses are attached to fs_name."""
+    if not addresses:
+        return
+    session = get_session()
+    with session.begin(subtransactions=True):
+        _soft_delete(session.query(FileSystemAttachment).
+                             filter_by(filesystem=fs_name).
+                             filter(FileSystemAttachment.address.in_(
+                                 addresses)))
+
+
+def attachment_delete_by_instance(context, instance_uuid, fs_name=None):
+    """Forget an instance's attachments, to fs_name or to everything."""
+    session = get_session()
+    with session.begin(subtransactions=True):
+        query = session.query(FileSystemAttachment).\
+                        filter_by(instance_uuid=instance_uuid)
+        if fs_name is not None:
+            query = query.filter_by(filesystem=fs_name)
+        _soft_delete(query)
+
+
+def attachment_set_all(context, fs_name, attachments):
+    """Make the recorded attachments of fs_name exactly attachments.
+
+    Only the difference is written: recorded pairs that are no longer
+    wanted, and duplicates, are soft-deleted and missing pairs added.
+    Returns whether anything changed.
+    """
+    wanted = set(attachments)
+    session = get_session()
+    with session.begin(subtransactions=True):
+        recorded = {}
+        for attachment_id, instance_uuid, address in \
+                session.query(FileSystemAttachment.id,
+                              FileSystemAttachment.instance_uuid,
+                              FileSystemAttachment.address).\
+                        filter_by(filesystem=fs_name).\
+                        filter_by(deleted=False).\
+                        all():
+            recorded.setdefault((instance_uuid, address),
+                                []).append(attachment_id)
+
+        stale_ids = []
+        for pair, attachment_ids in recorded.items():
+            if pair in wanted:
+                stale_ids.extend(attachment_ids[1:])
+            else:
+                stale_ids.extend(attachment_ids)
+        if stale_ids:
+            _soft_delete(session.query(FileSystemAttachment).
+                                 filter(FileSystemAttachment.id.in_(
+                                     stale_ids)))
+
+        added = wanted - set(recorded)
+        for instance_uuid, address in added:
+            attachment_ref = FileSystemAttachment()
+            attachment_ref.update({'filesystem': fs_name,
+                                   'instance_uuid': instance_uuid,
+                                   'address': address})
+            session.add(attachment_ref)
+    return bool(stale_ids or added)
+
+
+def fixed_ips_get_by_instance_uuids(context, instance_uuids):
+    """Map instance uuids to the addresses of their fixed IPs.
+
+    This is a single query against the nova database.  Live instances
+    without fixed IPs map to an empty list; unknown or deleted
+    instances, and for a non-admin context instances of other projects,
+    are left out of the result.
+    """
+    if not instance_uuids:
+        return {}
+
+    session = nova_session.get_session()
+    query = session.query(models.Instance.uuid, models.FixedIp.address).\
+                    outerjoin((models.FixedIp, sqlalchemy.and_(
+                        models.FixedIp.instance_id == models.Instance.id,
+                        models.FixedIp.deleted == False))).\
+                    filter(models.Instance.uuid.in_(instance_uuids)).\
+                    filter(models.Instance.deleted == False)
+    if not context.is_admin:
+        query = query.filter(
+            models.Instance.project_id == context.project_id)
+
+    addresses = {}
+    for uuid, address in query.all():
+        addresses.setdefault(uuid, [])
+        if address:
+            addresses[uuid].append(address)
+    return addresses
+
+
+def instance_addresses_get_all(context):
+    """Return (project_id, instance_uuid, address) for every fixed IP.
+
+    Covers every live instance, in a single query against the nova
+    database.
+    """
+    session = nova_session.get_session()
+    query = session.query(models.Instance.project_id,
+                          models.Instance.uuid,
+                          models.FixedIp.address).\
+                    filter(models.FixedIp.instance_id == models.Instance.id).\
+                    filter(models.FixedIp.deleted == False).\
+                    filter(models.Instance.deleted == False)
+    return query.all()
+
+
+def instance_addresses_get_chunks(context, chunk_size=1000):
+    """Yield lists of (project_id, instance_uuid, address) for fixed IPs.
+
+    Like instance_addresses_get_all, but reads at most chunk_size rows
+    per query, in fixed IP id order, so that a large cloud never has to
+    be held in memory at once.
+    """
+    session = nova_session.get_session()
+    last_id = None
+    while True:
+        query = session.query(models.FixedIp.id,
+                              models.Instance.project_id,
+                              models.Instance.uuid,
+                              models.FixedIp.address).\
+                        filter(models.FixedIp.instance_id ==
+                               models.Instance.id).\
+                        filter(models.FixedIp.deleted == False).\
+                        filter(models.Instance.deleted == False)
+        if last_id is not None:
+            query = query.filter(models.FixedIp.id > last_id)
+        rows = query.order_by(models.FixedIp.id).limit(chunk_size).all()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [row[1:] for row in rows]
+        if len(rows) < chunk_size:
+            return
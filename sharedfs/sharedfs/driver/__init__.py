@@ -19,4 +19,52 @@
 # Importing full names to not pollute the namespace and cause possible
 # collisions with use of 'from nova.network import <foo>' elsewhere.
 import nova.flags
+import nova.openstack.common.cfg
+import nova.openstack.common.importutils
 import nova.utils
+
+FLAGS = nova.flags.FLAGS
+
+driver_opts = [
+    nova.openstack.common.cfg.StrOpt('sharedfs_driver',
+               default="sharedfs.driver.sharedfs_driver.SharedFSDriver",
+               help='Driver to manage shared filesystems. '
+                    'Default is an empty do-nothing driver.'),
+]
+
+FLAGS.register_opts(driver_opts)
+
+# driver class name -> the instance shared by this process
+_DRIVERS = {}
+
+
+def get_driver():
+    """Return this process's instance of the configured driver.
+
+    The API controllers and the notifier all use the same instance, so
+    they share its cached backend state and its connections, and a
+    change made through any of them is seen by the others.
+    """
+    name = FLAGS.sharedfs_driver
+    driver = _DRIVERS.get(name)
+    if driver is None:
+        driver = nova.openstack.common.importutils.import_object(name)
+        driver.do_setup()
+        _DRIVERS[name] = driver
+    return driver
+
+
+def invalidate(fs_name=None):
+    """Drop cached backend state for fs_name, or for everything.
+
+    The API, the notifier and the reconciler call this whenever a change
+    to fs_name fails part way, since the backend may then no longer
+    match what the driver has cached.
+    """
+    for driver in _DRIVERS.values():
+        driver.invalidate(fs_name)
+
+
+def reset():
+    """Forget every driver instance; the next get_driver() makes anew."""
+    _DRIVERS.clear()
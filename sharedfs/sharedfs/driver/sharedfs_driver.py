@@ -38,6 +38,10 @@ class SharedFSDriver(object):
     def check_for_setup_error(self):
         pass
 
+    def invalidate(self, fs_name=None):
+        """Forget any cached state for fs_name, or for all filesystems."""
+        pass
+
     def create_fs(self, fs_name, tenant, size_in_g):
         pass
 
@@ -47,6 +51,10 @@ class SharedFSDriver(object):
     def list_fs(self):
         return []
 
+    def get_fs(self, fs_name):
+        """Return {'name', 'size'} for one filesystem, or None."""
+        return None
+
     def attach(self, fs_name, ip_list):
         pass
 
@@ -55,3 +63,22 @@ class SharedFSDriver(object):
 
     def list_attachments(self, fs_name):
         return []
+
+    def current_attachments(self, fs_name):
+        """Like list_attachments, but never answered from a cache.
+
+        Drivers that cache access lists should override this.
+        """
+        return self.list_attachments(fs_name)
+
+    def update_attachments(self, fs_name, attach_ips, unattach_ips):
+        """Attach and detach lists of addresses in a single update.
+
+        Drivers that can change access in one backend operation should
+        override this; by default it is an attach followed by an
+        unattach.
+        """
+        if attach_ips:
+            self.attach(fs_name, list(attach_ips))
+        if unattach_ips:
+            self.unattach(fs_name, list(unattach_ips))
@@ -12,7 +12,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import io
 import os
+import re
 import time
 from xml.etree import ElementTree
 
@@ -23,6 +25,8 @@ from nova import flags
 from nova import log as logging
 from nova.openstack.common import cfg
 from . import sharedfs_driver
+from sharedfs import locks
+from sharedfs import metrics
 from nova import utils
 from nova.volume import iscsi
 from nova.volume import volume_types
@@ -48,19 +52,215 @@ gluster_opts = [
     cfg.MultiStrOpt('gluster_bricks',
                default=[],
                help='Each entry should be in the form hostname:location. '
-                    'For example, server1:/exp1')]
+                    'For example, server1:/exp1'),
+    cfg.BoolOpt('gluster_xml_volume_info',
+                default=True,
+                help="Read volume info with 'gluster volume info --xml', "
+                     "which needs GlusterFS 3.3 or later.  If False the "
+                     "plain text output is parsed instead."),
+    cfg.IntOpt('gluster_volume_info_ttl',
+               default=30,
+               help='Seconds for which volume info read from gluster is '
+                    'reused.  Changes the driver makes itself are applied '
+                    'to the cached copy at once; changes made outside '
+                    'nova may take this long to be seen.  0 disables the '
+                    'cache.')]
 
 
 FLAGS.register_opts(gluster_opts)
 
 
+_BRICK_KEY = re.compile(r'^Brick\d+$')
+
+
+def parse_volume_info_xml(out):
+    """Parse the output of 'gluster volume info --xml'.
+
+    Returns {volume name: {'name', 'status', 'bricks', 'options'}},
+    where bricks is a list of 'host:/path' strings and options a dict.
+    The document is parsed incrementally and each volume's elements are
+    dropped once it has been read, so memory use does not grow with the
+    size of the cluster.  Raises NotFound if gluster reported that a
+    volume does not exist, or exception.Error for any other failure,
+    including output that is not XML at all.
+    """
+    volume_info = {}
+    op_ret = None
+    op_errstr = None
+    try:
+        for event, elem in ElementTree.iterparse(io.BytesIO(out)):
+            if elem.tag == 'volume':
+                bricks = []
+                for brick in elem.findall('bricks/brick'):
+                    # GlusterFS 3.4 adds a <name> child; 3.3 only has text.
+                    name = brick.findtext('name') or brick.text or ''
+                    bricks.append(name.strip())
+                options = {}
+                for option in elem.findall('options/option'):
+                    options[option.findtext('name')] = \
+                        option.findtext('value') or ''
+                name = elem.findtext('name')
+                volume_info[name] = {'name': name,
+                                     'status': elem.findtext('statusStr'),
+                                     'bricks': bricks,
+                                     'options': options}
+                elem.clear()
+            elif elem.tag == 'opRet':
+                op_ret = elem.text
+            elif elem.tag == 'opErrstr':
+                op_errstr = elem.text
+    except SyntaxError:
+        # An ElementTree.ParseError: gluster printed an error, not XML.
+        raise exception.Error(_("Glusterfs failure: %s") % out)
+
+    if op_ret not in (None, '0'):
+        if op_errstr and 'does not exist' in op_errstr:
+            raise exception.NotFound(op_errstr)
+        raise exception.Error(_("Glusterfs failure: %s") % op_errstr)
+    return volume_info
+
+
+def parse_volume_info_text(out):
+    """Parse the output of 'gluster volume info'.
+
+    Returns the same structure as parse_volume_info_xml.  Only the
+    first colon on a line separates the key from the value, so values
+    such as brick paths and quota limits may contain colons.
+    """
+    volume_info = {}
+    volume = None
+    in_options = False
+
+    for line in out.split("\n"):
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        key = key.strip()
+        value = value.strip()
+        if key == 'Volume Name':
+            volume = {'name': value, 'status': None, 'bricks': [],
+                      'options': {}}
+            volume_info[value] = volume
+            in_options = False
+        elif volume is None:
+            continue
+        elif key == 'Options Reconfigured':
+            in_options = True
+        elif in_options:
+            volume['options'][key] = value
+        elif key == 'Status':
+            volume['status'] = value
+        elif _BRICK_KEY.match(key):
+            volume['bricks'].append(value)
+
+    return volume_info
+
+
+class _PendingUpdate(object):
+    """An access list change waiting for the filesystem lock."""
+
+    def __init__(self, attach_ips, unattach_ips):
+        self.attach_ips = list(attach_ips)
+        self.unattach_ips = list(unattach_ips)
+        self.done = False
+        self.error = None
+
+
 class GlusterDriver(sharedfs_driver.SharedFSDriver):
     """Implements the Shared Filesystem driver for GlusterFS."""
 
+    def __init__(self):
+        super(GlusterDriver, self).__init__()
+        # fs_name -> info from parse_volume_info_xml, for the volumes
+        # read so far.  When _listed_at is within the TTL it holds every
+        # volume; otherwise a volume's entry is only trusted while its
+        # _fetched time is.
+        self.volume_info = {}
+        self._listed_at = None
+        self._fetched = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # fs_name -> (raw auth.allow string, parsed list)
+        self._allow_cache = {}
+        # fs_name -> [_PendingUpdate, ...] queued behind the lock
+        self._pending = {}
+        # brick host -> connected paramiko.SSHClient
+        self._ssh_clients = {}
+
     def do_setup(self):
-        self.ssh = paramiko.SSHClient()
-        self.ssh.load_system_host_keys()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        for client in self._ssh_clients.values():
+            client.close()
+        self._ssh_clients = {}
+
+    def invalidate(self, fs_name=None):
+        # _allow_cache checks itself against the raw value, so only the
+        # volume info needs to be dropped.
+        self._listed_at = None
+        if fs_name is None:
+            self.volume_info = {}
+            self._fetched = {}
+        else:
+            self.volume_info.pop(fs_name, None)
+            self._fetched.pop(fs_name, None)
+
+    def _fresh(self, fetched_at):
+        ttl = FLAGS.gluster_volume_info_ttl
+        return (ttl > 0 and fetched_at is not None and
+                time.time() - fetched_at < ttl)
+
+    def _count(self, hit):
+        if hit:
+            self.cache_hits += 1
+            metrics.incr('sharedfs.gluster.volume_info.hits')
+        else:
+            self.cache_misses += 1
+            metrics.incr('sharedfs.gluster.volume_info.misses')
+
+    def _cached_volume_info(self, fs_name):
+        """Return the info for one volume, from the cache if it is fresh.
+
+        A volume missing from a fresh listing is still looked up, since
+        another process may have created it since.  Raises NotFound if
+        gluster doesn't know about the volume.
+        """
+        if (self._fresh(self._fetched.get(fs_name)) or
+            self._fresh(self._listed_at)):
+            info = self.volume_info.get(fs_name)
+            if info is not None:
+                self._count(True)
+                return info
+
+        self._count(False)
+        info = self._get_volume_info(fs_name)
+        self._fetched[fs_name] = time.time()
+        return info
+
+    def _cache_volume(self, fs_name, info):
+        """Record info written by the driver itself."""
+        self.volume_info[fs_name] = info
+        self._fetched[fs_name] = time.time()
+
+    def _cache_option(self, fs_name, key, value):
+        """Apply a volume set made by the driver to the cached info."""
+        info = self.volume_info.get(fs_name)
+        if info is not None:
+            info['options'][key] = value
+
+    def _ssh(self, host):
+        """Return an SSH connection to host, reusing one if it is alive."""
+        client = self._ssh_clients.get(host)
+        if client is not None:
+            transport = client.get_transport()
+            if transport is not None and transport.is_active():
+                return client
+            client.close()
+
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host)
+        self._ssh_clients[host] = client
+        return client
 
     def check_for_setup_error(self):
         """Raises an error if prerequisites aren't met."""
@@ -94,24 +294,48 @@ class GlusterDriver(sharedfs_driver.SharedFSDriver):
             return '100MB'
         return '%sGB' % size_in_g
 
-    def _refresh_volume_info(self):
-        (out, err) = utils.execute('gluster', 'volume', 'info',
-                                   run_as_root=True)
+    def _volume_info(self, *volumes):
+        """Run 'gluster volume info' and return the parsed result.
+
+        Raises NotFound only if gluster says that a volume does not
+        exist; any other failure, such as glusterd being down, is
+        raised as an Error or ProcessExecutionError.
+        """
+        cmd = ['gluster', 'volume', 'info'] + list(volumes)
+        if FLAGS.gluster_xml_volume_info:
+            # gluster exits non-zero for a missing volume as well as for
+            # real failures; opRet and opErrstr tell them apart.
+            cmd.append('--xml')
+            (out, err) = utils.execute(*cmd, run_as_root=True,
+                                       check_exit_code=False)
+            return parse_volume_info_xml(out)
+
+        try:
+            (out, err) = utils.execute(*cmd, run_as_root=True)
+        except exception.ProcessExecutionError as e:
+            if 'does not exist' not in '%s %s' % (e.stdout, e.stderr):
+                raise
+            raise exception.NotFound((e.stdout or e.stderr).strip())
         if err:
-            raise exception.Error(_("Glusterfs failure: %s") % out)
+            raise exception.Error(_("Glusterfs failure: %s") % err)
+        return parse_volume_info_text(out)
 
-        self.volume_info = {}
-        volname = "unknown"
-
-        for line in out.split("\n"):
-            part = line.partition(':')
-            if not part[1]:
-                continue
-            if part[0] == 'Volume Name':
-                volname = part[2].strip()
-                self.volume_info[volname] = {}
-            else:
-                self.volume_info[volname][part[0].strip()] = part[2].strip()
+    def _refresh_volume_info(self):
+        """Fetch the info for every volume.  Only needed for listings."""
+        self.volume_info = self._volume_info()
+
+    def _get_volume_info(self, fs_name):
+        """Fetch and return the info for a single volume.
+
+        Raises NotFound only if gluster says the volume does not exist;
+        any other failure, such as glusterd being down, is raised as is.
+        """
+        info = self._volume_info(fs_name).get(fs_name)
+        if info is None:
+            raise exception.Error(_("Glusterfs did not report volume %s") %
+                                  fs_name)
+        self.volume_info[fs_name] = info
+        return info
 
     def _make_bricks(self, fs_name, tenant):
         """Create dirs for each brick and prepare a brick list for gluster."""
@@ -121,9 +345,8 @@ class GlusterDriver(sharedfs_driver.SharedFSDriver):
             parts = brick.partition(':')
             host = parts[0]
             dir = '%s/%s/%s' % (parts[2], tenant, fs_name)
-            self.ssh.connect(host)
-            stdin, stdout, stderr = self.ssh.exec_command("mkdir -p '%s'" %
-                                                          dir)
+            ssh = self._ssh(host)
+            stdin, stdout, stderr = ssh.exec_command("mkdir -p '%s'" % dir)
             out = stdout.readlines()
             err = stderr.readlines()
             if err:
@@ -150,9 +373,8 @@ class GlusterDriver(sharedfs_driver.SharedFSDriver):
             parts = brick.partition(':')
             host = parts[0]
             dir = '%s/%s/%s' % (parts[2], tenant, fs_name)
-            self.ssh.connect(host)
-            stdin, stdout, stderr = self.ssh.exec_command("rmdir '%s'" %
-                                                          dir)
+            ssh = self._ssh(host)
+            stdin, stdout, stderr = ssh.exec_command("rmdir '%s'" % dir)
             out = stdout.readlines()
             err = stderr.readlines()
             if err:
@@ -165,10 +387,19 @@ class GlusterDriver(sharedfs_driver.SharedFSDriver):
             projdir = '%s/%s' % (parts[2], tenant)
 
             # This will fail quietly if there are still subdirs.
-            stdin, stdout, stderr = self.ssh.exec_command("rmdir '%s'" %
-                                                          projdir)
+            stdin, stdout, stderr = ssh.exec_command("rmdir '%s'" % projdir)
 
     def create_fs(self, fs_name, tenant, size_in_g):
+        with locks.filesystem_lock(fs_name):
+            try:
+                info = self._create_fs(fs_name, tenant, size_in_g)
+            except Exception:
+                with utils.save_and_reraise_exception():
+                    self.invalidate(fs_name)
+            self._cache_volume(fs_name, info)
+
+    def _create_fs(self, fs_name, tenant, size_in_g):
+        """Create and start a volume and return its info."""
         bricklist = self._make_bricks(fs_name, tenant)
 
         if FLAGS.gluster_mode != 'normal':
@@ -191,57 +422,153 @@ class GlusterDriver(sharedfs_driver.SharedFSDriver):
         utils.execute('gluster', '--mode=script', 'volume', 'set', fs_name,
                       'allow', 'localhost', run_as_root=True)
 
-    def delete_fs(self, fs_name, tenant):
-        utils.execute('gluster', '--mode=script', 'volume', 'stop',
-                      fs_name, run_as_root=True)
-
-        utils.execute('gluster', '--mode=script', 'volume', 'delete',
-                      fs_name, run_as_root=True)
+        return {'name': fs_name,
+                'status': 'Started',
+                'bricks': bricklist,
+                'options': {'features.quota': 'on',
+                            'features.limit-usage':
+                                '/data:%s' % self._glustersizestr(size_in_g),
+                            'auth.allow': 'localhost'}}
 
-        bricklist = self._cleanup_bricks(fs_name, tenant)
+    def delete_fs(self, fs_name, tenant):
+        """Stop and delete a volume and remove its bricks.
+
+        Safe to repeat after a partial failure: steps that were already
+        done are skipped.  Raises NotFound if the volume was already gone.
+        """
+        with locks.filesystem_lock(fs_name):
+            try:
+                info = self._get_volume_info(fs_name)
+            except exception.NotFound:
+                # Bricks may survive a failed create or delete.
+                self._cleanup_bricks(fs_name, tenant)
+                raise
+
+            if info['status'] != 'Stopped':
+                utils.execute('gluster', '--mode=script', 'volume', 'stop',
+                              fs_name, run_as_root=True)
+
+            try:
+                utils.execute('gluster', '--mode=script', 'volume',
+                              'delete', fs_name, run_as_root=True)
+            except Exception:
+                with utils.save_and_reraise_exception():
+                    self.invalidate(fs_name)
+
+            # Gone: a fresh listing stays correct without it.
+            self.volume_info.pop(fs_name, None)
+            self._fetched.pop(fs_name, None)
+            self._cleanup_bricks(fs_name, tenant)
 
     def _get_size(self, volname):
-        rawsize = self.volume_info[volname].get('features.limit-usage',
-                                                "unknown:unknown")
+        options = self.volume_info[volname]['options']
+        rawsize = options.get('features.limit-usage', "unknown:unknown")
         return rawsize.partition(':')[2]
 
     def list_fs(self):
-        self._refresh_volume_info()
+        if self._fresh(self._listed_at):
+            self._count(True)
+        else:
+            self._count(False)
+            self._refresh_volume_info()
+            self._listed_at = time.time()
+            self._fetched = {}
         return [{'name': key,
                  'size': self._get_size(key)}
                 for key in self.volume_info.keys()]
 
+    def get_fs(self, fs_name):
+        try:
+            self._cached_volume_info(fs_name)
+        except exception.NotFound:
+            return None
+        return {'name': fs_name,
+                'size': self._get_size(fs_name)}
+
     def attach(self, fs_name, ip_list):
-        attachlist = self.list_attachments(fs_name)
-        if isinstance(ip_list, list):
-            for ip in ip_list:
-                if ip not in attachlist:
-                    attachlist.append(ip)
-        else:
-            if ip_list not in attachlist:
-                attachlist.append(ip_list)
-        newlist = ','.join(attachlist)
-        LOG.debug('attachlist: %s' % attachlist)
-        utils.execute('gluster', '--mode=script', 'volume', 'set',
-                      fs_name, 'auth.allow', newlist, run_as_root=True)
+        if not isinstance(ip_list, list):
+            ip_list = [ip_list]
+        self.update_attachments(fs_name, ip_list, [])
 
     def unattach(self, fs_name, ip_list):
-        attachlist = self.list_attachments(fs_name)
-        if isinstance(ip_list, list):
-            for item in ip_list:
-                if item in attachlist:
-                    attachlist.remove(item)
+        if not isinstance(ip_list, list):
+            ip_list = [ip_list]
+        self.update_attachments(fs_name, [], ip_list)
+
+    def update_attachments(self, fs_name, attach_ips, unattach_ips):
+        """Change auth.allow for fs_name under the filesystem lock.
+
+        Updates that queue up for the same filesystem while another is
+        in progress are applied together, in arrival order, by whichever
+        caller gets the lock next.  The others find their update done.
+        """
+        update = _PendingUpdate(attach_ips, unattach_ips)
+        self._pending.setdefault(fs_name, []).append(update)
+
+        with locks.filesystem_lock(fs_name):
+            if not update.done:
+                self._apply_pending(fs_name)
+
+        if update.error:
+            raise update.error
+
+    def _apply_pending(self, fs_name):
+        batch = self._pending.pop(fs_name, [])
+        try:
+            attachlist = self.current_attachments(fs_name)
+            for update in batch:
+                for ip in update.attach_ips:
+                    if ip not in attachlist:
+                        attachlist.append(ip)
+                for ip in update.unattach_ips:
+                    if ip in attachlist:
+                        attachlist.remove(ip)
+            newlist = ','.join(attachlist)
+            LOG.debug('attachlist: %s (%d merged updates)' %
+                      (attachlist, len(batch)))
+            utils.execute('gluster', '--mode=script', 'volume', 'set',
+                          fs_name, 'auth.allow', newlist, run_as_root=True)
+        except Exception as e:
+            self.invalidate(fs_name)
+            for update in batch:
+                update.error = e
+            raise
         else:
-            if ip_list in attachlist:
-                attachlist.remove(ip_list)
-        newlist = ','.join(attachlist)
-        utils.execute('gluster', '--mode=script', 'volume', 'set', fs_name,
-                      'auth.allow', newlist, run_as_root=True)
+            self._cache_option(fs_name, 'auth.allow', newlist)
+        finally:
+            for update in batch:
+                update.done = True
+
+    def _parse_allow_list(self, fs_name, raw):
+        """Split an auth.allow value, reusing the last parse if unchanged.
+
+        Callers are free to modify the returned list.
+        """
+        cached = self._allow_cache.get(fs_name)
+        if cached and cached[0] == raw:
+            return list(cached[1])
+
+        if raw:
+            parsed = [ip.strip() for ip in raw.split(',') if ip.strip()]
+        else:
+            parsed = []
+        self._allow_cache[fs_name] = (raw, parsed)
+        return list(parsed)
 
     def list_attachments(self, fs_name):
-        self._refresh_volume_info()
-        l = self.volume_info[fs_name].get('auth.allow')
-        if l:
-            return l.split(',')
-        else:
-            return []
+        # Only this volume is queried, so attaching and detaching cost
+        # the same however many volumes the cluster has.
+        info = self._cached_volume_info(fs_name)
+        return self._parse_allow_list(fs_name,
+                                      info['options'].get('auth.allow'))
+
+    def current_attachments(self, fs_name):
+        """Like list_attachments, but always asks gluster.
+
+        Used to read auth.allow before changing it: other processes
+        change it too, and writing back a stale copy would undo them.
+        """
+        info = self._get_volume_info(fs_name)
+        self._fetched[fs_name] = time.time()
+        return self._parse_allow_list(fs_name,
+                                      info['options'].get('auth.allow'))
@@ -0,0 +1,153 @@
+# Copyright 2012 Andrew Bogott for the Wikimedia Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Background jobs for long-running shared filesystem operations.
+
+Creating or deleting a share (and attaching or detaching every instance
+in its scope) can take far longer than an API request should.  The API
+hands that work to a JobManager, which runs it on a bounded pool of
+greenthreads and keeps a record that clients can poll.
+
+Job records live in the memory of the API process that accepted the
+request; they are pruned sharedfs_job_ttl seconds after they finish.
+"""
+
+import datetime
+
+import eventlet
+
+from nova import flags
+from nova import log as logging
+from nova.openstack.common import cfg
+from nova import utils
+
+FLAGS = flags.FLAGS
+LOG = logging.getLogger("nova.plugin.%s" % __name__)
+
+job_opts = [
+    cfg.IntOpt('sharedfs_job_workers',
+               default=4,
+               help='Maximum number of shared filesystem jobs that are '
+                    'run concurrently by each API process.'),
+    cfg.IntOpt('sharedfs_job_ttl',
+               default=3600,
+               help='Seconds to keep the record of a finished shared '
+                    'filesystem job.'),
+]
+
+FLAGS.register_opts(job_opts)
+
+_MANAGER = None
+
+
+class Job(object):
+    """Tracks the progress of a single background operation."""
+
+    def __init__(self, action, fs_name):
+        self.id = str(utils.gen_uuid())
+        self.action = action
+        self.fs_name = fs_name
+        self.status = 'queued'
+        self.total = 0
+        self.completed = 0
+        self.errors = []
+        self.created_at = utils.utcnow()
+        self.finished_at = None
+
+    def is_finished(self):
+        return self.status in ('complete', 'error')
+
+    def add_error(self, message):
+        LOG.warn(_("Job %(id)s (%(action)s %(fs)s): %(msg)s") %
+                 {'id': self.id, 'action': self.action,
+                  'fs': self.fs_name, 'msg': message})
+        self.errors.append(message)
+
+    def to_dict(self):
+        finished_at = None
+        if self.finished_at:
+            finished_at = utils.isotime(self.finished_at)
+        return {'id': self.id,
+                'action': self.action,
+                'filesystem': self.fs_name,
+                'status': self.status,
+                'progress': {'total': self.total,
+                             'completed': self.completed},
+                'errors': list(self.errors),
+                'created_at': utils.isotime(self.created_at),
+                'finished_at': finished_at}
+
+
+class JobManager(object):
+    """Runs jobs on a bounded greenthread pool and remembers the results."""
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = FLAGS.sharedfs_job_workers
+        self._pool = eventlet.GreenPool(max(1, max_workers))
+        self._jobs = {}
+
+    def submit(self, action, fs_name, func, *args, **kwargs):
+        """Queue func(job, *args, **kwargs) and return the new Job.
+
+        func may update job.total, job.completed and job.errors as it
+        goes.  Any exception it raises marks the job as failed.
+        """
+        self._prune()
+        job = Job(action, fs_name)
+        self._jobs[job.id] = job
+        self._pool.spawn_n(self._run, job, func, *args, **kwargs)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def list(self, fs_name=None):
+        jobs = [job for job in self._jobs.values()
+                if fs_name is None or job.fs_name == fs_name]
+        return sorted(jobs, key=lambda job: job.created_at)
+
+    def wait(self):
+        """Block until every queued job has finished."""
+        self._pool.waitall()
+
+    def _run(self, job, func, *args, **kwargs):
+        job.status = 'running'
+        try:
+            func(job, *args, **kwargs)
+        except Exception as e:
+            LOG.exception(_("Job %(id)s (%(action)s %(fs)s) failed.") %
+                          {'id': job.id, 'action': job.action,
+                           'fs': job.fs_name})
+            job.errors.append(unicode(e))
+            job.status = 'error'
+        else:
+            job.status = 'complete'
+        job.finished_at = utils.utcnow()
+
+    def _prune(self):
+        cutoff = utils.utcnow() - datetime.timedelta(
+            seconds=FLAGS.sharedfs_job_ttl)
+        for job_id, job in self._jobs.items():
+            if job.is_finished() and job.finished_at < cutoff:
+                del self._jobs[job_id]
+
+
+def get_manager():
+    """Return the JobManager shared by this process."""
+    global _MANAGER
+    if _MANAGER is None:
+        _MANAGER = JobManager()
+    return _MANAGER
@@ -0,0 +1,77 @@
+# Copyright 2012 Andrew Bogott for the Wikimedia Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Per-filesystem locks.
+
+Changes to a filesystem's access list are read-modify-write operations
+on the backend, so two of them running at once for the same filesystem
+can lose an update.  filesystem_lock() serializes work on one
+filesystem while leaving different filesystems free to proceed in
+parallel.
+
+Within a process the lock is a semaphore.  With sharedfs_lock_external
+set, a lock file in lock_path is held as well, so that several API or
+notifier processes on the same host also exclude each other.
+"""
+
+import contextlib
+import os
+import weakref
+
+from eventlet import semaphore
+import lockfile
+
+from nova import flags
+from nova import log as logging
+from nova.openstack.common import cfg
+
+FLAGS = flags.FLAGS
+LOG = logging.getLogger("nova.plugin.%s" % __name__)
+
+lock_opts = [
+    cfg.BoolOpt('sharedfs_lock_external',
+                default=False,
+                help='Also take a file lock in lock_path when changing a '
+                     'shared filesystem, so that processes on the same '
+                     'host do not interfere with each other.'),
+]
+
+FLAGS.register_opts(lock_opts)
+
+_semaphores = weakref.WeakValueDictionary()
+
+
+def _lock_file_path(fs_name):
+    safe_name = fs_name.replace(os.sep, '_')
+    return os.path.join(FLAGS.lock_path, 'sharedfs-%s' % safe_name)
+
+
+@contextlib.contextmanager
+def filesystem_lock(fs_name):
+    """Hold the lock for fs_name for the duration of a with block."""
+    # NOTE: As with nova.utils.synchronized, this relies on greenthreads;
+    # with native threads the semaphore lookup would be racy.
+    sem = _semaphores.get(fs_name)
+    if sem is None:
+        sem = semaphore.Semaphore()
+        _semaphores[fs_name] = sem
+
+    with sem:
+        if FLAGS.sharedfs_lock_external:
+            LOG.debug(_("Taking file lock for filesystem %s") % fs_name)
+            with lockfile.FileLock(_lock_file_path(fs_name)):
+                yield
+        else:
+            yield
@@ -0,0 +1,217 @@
+# Copyright 2012 Andrew Bogott for the Wikimedia Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Process-wide counters, gauges and histograms for the sharedfs plugin.
+
+Counters only go up; gauges report a current value, either one that was
+set or one computed by a callable each time it is read.  Histograms
+count observed values, usually durations recorded with timer(), in
+cumulative buckets.  snapshot() returns every metric by name.  With
+sharedfs_metrics_interval set, the snapshot is also logged
+periodically.
+"""
+
+import time
+
+from nova import flags
+from nova import log as logging
+from nova.openstack.common import cfg
+from nova import utils
+
+FLAGS = flags.FLAGS
+LOG = logging.getLogger("nova.plugin.%s" % __name__)
+
+metrics_opts = [
+    cfg.IntOpt('sharedfs_metrics_interval',
+               default=0,
+               help='Seconds between logging the sharedfs metrics.  0 '
+                    'disables it.'),
+]
+
+FLAGS.register_opts(metrics_opts)
+
+_METRICS = {}
+_REPORTER = None
+
+
+class Counter(object):
+    """A count of events."""
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def incr(self, amount=1):
+        self.value += amount
+
+    def read(self):
+        return self.value
+
+
+class Gauge(object):
+    """A current value, or a callable that computes it."""
+
+    def __init__(self, name, func=None):
+        self.name = name
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        if self.func is None:
+            return self.value
+        try:
+            return self.func()
+        except Exception:
+            LOG.exception(_("Unable to read gauge %s") % self.name)
+            return None
+
+
+class Histogram(object):
+    """Counts of observed values, in cumulative buckets.
+
+    The default buckets suit durations in seconds.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0, 30.0)
+
+    def __init__(self, name, buckets=None):
+        self.name = name
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def read(self):
+        """Return count, sum, min, max and {upper bound: count}."""
+        return {'count': self.count,
+                'sum': self.sum,
+                'min': self.min,
+                'max': self.max,
+                'buckets': dict(zip(self.buckets, self.counts))}
+
+
+class Timer(object):
+    """Times a with block and records the duration in a histogram.
+
+    The duration in seconds is left in elapsed, whether or not the
+    block raised.
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.elapsed = time.time() - self.start
+        self.histogram.observe(self.elapsed)
+        return False
+
+
+def _get(name, cls, *args):
+    metric = _METRICS.get(name)
+    if metric is None:
+        metric = cls(name, *args)
+        _METRICS[name] = metric
+    elif not isinstance(metric, cls):
+        raise TypeError("%s is a %s, not a %s" %
+                        (name, type(metric).__name__, cls.__name__))
+    return metric
+
+
+def counter(name):
+    """Return the Counter called name, creating it if need be."""
+    return _get(name, Counter)
+
+
+def gauge(name, func=None):
+    """Return the Gauge called name, creating it if need be.
+
+    If func is given, the gauge reads its value from func() from now on.
+    """
+    metric = _get(name, Gauge)
+    if func is not None:
+        metric.func = func
+    return metric
+
+
+def histogram(name):
+    """Return the Histogram called name, creating it if need be."""
+    return _get(name, Histogram)
+
+
+def timer(name):
+    """Return a Timer recording into the histogram called name."""
+    return Timer(histogram(name))
+
+
+def incr(name, amount=1):
+    counter(name).incr(amount)
+
+
+def snapshot():
+    """Return {name: value} for every metric."""
+    return dict((name, metric.read()) for name, metric in _METRICS.items())
+
+
+def reset():
+    """Forget every metric.  For tests."""
+    _METRICS.clear()
+
+
+def _format(value):
+    if isinstance(value, dict):
+        # Only the summary of a histogram; the buckets are too long.
+        if not value['count']:
+            return 'count=0'
+        return 'count=%d avg=%.3f max=%.3f' % (
+            value['count'], value['sum'] / value['count'], value['max'])
+    return '%s' % value
+
+
+def _report():
+    LOG.info(_("sharedfs metrics: %s") %
+             ', '.join('%s=%s' % (name, _format(value))
+                       for name, value in sorted(snapshot().items())))
+
+
+def start_reporting():
+    """Start logging the metrics periodically in this process, once."""
+    global _REPORTER
+    if _REPORTER is not None or not FLAGS.sharedfs_metrics_interval:
+        return
+    _REPORTER = utils.LoopingCall(_report)
+    _REPORTER.start(interval=FLAGS.sharedfs_metrics_interval, now=False)
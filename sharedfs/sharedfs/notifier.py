@@ -13,18 +13,46 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
+
+import eventlet
+
 from nova import context
-from nova import db
 from nova import flags
 from nova import log as logging
 from nova.openstack.common import cfg
-from nova.openstack.common import importutils
 from sharedfs import db as sharedfs_db
+from sharedfs import driver
+from sharedfs import metrics
+from sharedfs import retry
 
 LOG = logging.getLogger("nova.plugin.%s" % __name__)
 
 FLAGS = flags.FLAGS
 
+notifier_opts = [
+    cfg.IntOpt('sharedfs_notifier_workers',
+               default=4,
+               help='Maximum number of filesystems the notifier attaches '
+                    'an instance to, or detaches it from, at once.'),
+    cfg.FloatOpt('sharedfs_notifier_coalesce_window',
+                 default=0.0,
+                 help='Seconds for which the notifier holds attach and '
+                      'detach operations so that an instance deleted soon '
+                      'after it was created needs neither, and operations '
+                      'on the same filesystem are applied together.  Held '
+                      'operations are only kept in memory and are lost if '
+                      'the service stops.  0 applies every operation at '
+                      'once.'),
+    cfg.FloatOpt('sharedfs_notifier_slow_event',
+                 default=0.0,
+                 help='Log a warning, with the time spent in each stage, '
+                      'for any notification that takes longer than this '
+                      'many seconds to handle.  0 disables it.'),
+]
+
+FLAGS.register_opts(notifier_opts)
+
 NOTIFICATIONS = []
 
 
@@ -44,16 +72,61 @@ class SharedFSNotifier(object):
     """
 
     def __init__(self):
-        self.fs_driver = importutils.import_object(FLAGS.sharedfs_driver)
+        sharedfs_db.init_db()
+        self.fs_driver = driver.get_driver()
+        self.pool = eventlet.GreenPool(max(1, FLAGS.sharedfs_notifier_workers))
+        self.retry_queue = retry.get_queue()
+        # {fs_name: {instance_uuid: RetryEntry}} of held operations.
+        self.pending = {}
+        retry.start_worker(self.retry_failed)
+        metrics.start_reporting()
 
+    @sharedfs_db.scoped_session
     def notify(self, message):
+        """Attach or detach an instance on creation or deletion.
+
+        With sharedfs_notifier_coalesce_window set, the operations are
+        held for that many seconds and then applied per filesystem; see
+        _coalesce().  By default, the filesystems are handled
+        concurrently at once and a result dict is returned for each of
+        them.  Operations that fail either way are queued for a retry.
+
+        Each event is timed, in total and by stage, and counted by type
+        and outcome in the sharedfs metrics.
+        """
         event_type = message.get('event_type')
         if event_type not in ['compute.instance.delete.start',
                               'compute.instance.create.end']:
             return
 
         payload = message['payload']
+        stages = {}
+        outcome = 'error'
+        timer = metrics.timer('sharedfs.notifier.event')
+        try:
+            with timer:
+                results = self._handle(event_type, payload, stages)
+            if results is None:
+                outcome = 'held'
+            elif not results:
+                outcome = 'noop'
+            elif all(r['status'] == 'ok' for r in results):
+                outcome = 'ok'
+        finally:
+            metrics.incr('sharedfs.notifier.events.%s.%s' %
+                         (event_type, outcome))
+            slow = FLAGS.sharedfs_notifier_slow_event
+            if slow and timer.elapsed > slow:
+                LOG.warn(_("Handling %(event)s for instance %(instance)s "
+                           "took %(total).3fs: %(stages)s") %
+                         {'event': event_type,
+                          'instance': payload.get('instance_id'),
+                          'total': timer.elapsed,
+                          'stages': ', '.join('%s %.3fs' % item for item in
+                                              sorted(stages.items()))})
+        return results
 
+    def _handle(self, event_type, payload, stages):
         instance = payload['instance_id']
         tenant = payload['tenant_id']
         user = payload['user_id']
@@ -61,48 +134,295 @@ class SharedFSNotifier(object):
 
         # Find all global scope filesystems
         #  and all project-scope systems that are
-        #  associated with this project.
-        fs_list = []
-        db_fs_list = sharedfs_db.filesystem_list(ctxt)
-        for fs_name in db_fs_list:
-            fs = sharedfs_db.filesystem_get(ctxt, fs_name)
-            if not fs:
-                LOG.debug(_("Database inconsistency:  no record for FS %s") %
-                          fs_name)
-                continue
-            if fs.scope == 'global':
-                fs_list.append(fs_name)
-            elif fs.scope == 'project' and fs.project_id == tenant:
-                fs_list.append(fs_name)
+        #  associated with this project.  This is normally answered from
+        #  the in-memory copy of the filesystems table.
+        with _stage(stages, 'scope_lookup'):
+            fs_list = sharedfs_db.filesystem_names_get_for_project(ctxt,
+                                                                   tenant)
 
+        # Addresses come from the payload where nova provides them, and
+        # are otherwise looked up at most once for the whole event.
+        addresses = payload_addresses(payload)
+        looked_up = []
+
+        def instance_addresses():
+            if not looked_up:
+                with _stage(stages, 'ip_resolution'):
+                    looked_up.append(self._lookup_addresses(ctxt, instance))
+            return looked_up[0]
+
+        if event_type == 'compute.instance.create.end':
+            if fs_list:
+                addresses = addresses or instance_addresses()
+            with _stage(stages, 'driver_attach'):
+                return self._dispatch(ctxt, instance,
+                                      [(retry.ATTACH, fs_name, addresses)
+                                       for fs_name in fs_list])
+
+        # A deleted instance also loses any instance-scope filesystems
+        # it was attached to; those are only known from our records.
+        recorded = {}
+        with _stage(stages, 'attachment_lookup'):
+            for fs_name, address in \
+                    sharedfs_db.attachment_get_all_by_instance(ctxt,
+                                                               instance):
+                if fs_name not in recorded:
+                    recorded[fs_name] = []
+                    if fs_name not in fs_list:
+                        fs_list.append(fs_name)
+                recorded[fs_name].append(address)
+
+        operations = []
         for fs_name in fs_list:
-            if event_type == 'compute.instance.delete.start':
-                self.unattach(ctxt, instance, fs_name)
-            elif event_type == 'compute.instance.create.end':
-                self.attach(ctxt, instance, fs_name)
-
-    def attach(self, ctxt, instance_uuid, fs_name):
-        LOG.debug(_("attaching instance %(instance)s to filesystem %(fs)s.") %
-                  {'instance': instance_uuid, 'fs': fs_name})
-
-        instance = db.instance_get_by_uuid(ctxt, instance_uuid)
-        instance_id = instance.id
-
-        fixed_ips = db.fixed_ip_get_by_instance(ctxt, instance_id)
-        for ip in fixed_ips:
-            LOG.debug(_("auto-attaching ip %(ip)s to filesystem %(fs)s.") %
-                      {'ip': ip['address'], 'fs': fs_name})
-            self.fs_driver.attach(fs_name, ip['address'])
-
-    def unattach(self, ctxt, instance_uuid, fs_name):
-        LOG.debug(_("unattaching %(instance)s from filesystem %(fs)s.") %
-                  {'instance': instance_uuid, 'fs': fs_name})
-
-        instance = db.instance_get_by_uuid(ctxt, instance_uuid)
-        instance_id = instance.id
-
-        fixed_ips = db.fixed_ip_get_by_instance(ctxt, instance_id)
-        for ip in fixed_ips:
-            LOG.debug(_("auto unattaching %(ip)s from filesystem %(fs)s.") %
-                      {'ip': ip['address'], 'fs': fs_name})
-            self.fs_driver.unattach(fs_name, ip['address'])
+            fs_addresses = (recorded.get(fs_name) or addresses or
+                            instance_addresses())
+            operations.append((retry.DETACH, fs_name, fs_addresses))
+        with _stage(stages, 'driver_detach'):
+            return self._dispatch(ctxt, instance, operations)
+
+    def _dispatch(self, ctxt, instance_uuid, operations):
+        if not operations:
+            return []
+        if FLAGS.sharedfs_notifier_coalesce_window > 0:
+            for action, fs_name, addresses in operations:
+                self._coalesce(instance_uuid, action, fs_name, addresses)
+            return None
+        return self._run_all(ctxt, instance_uuid, operations)
+
+    def _coalesce(self, instance_uuid, action, fs_name, addresses):
+        """Hold an operation until the filesystem's window closes.
+
+        An attach and a detach of the same instance on the same
+        filesystem cancel each other out.  When the window closes, all
+        of the filesystem's remaining operations are applied as one
+        access list update by _flush().  Held operations are lost if
+        the process exits, so the window should stay short.
+        """
+        # This operation is newer than anything queued for the pair.
+        self.retry_queue.supersede(fs_name, instance_uuid)
+
+        held = self.pending.get(fs_name)
+        if held is None:
+            held = self.pending[fs_name] = {}
+            eventlet.spawn_after(FLAGS.sharedfs_notifier_coalesce_window,
+                                 self.pool.spawn_n, self._flush, fs_name)
+
+        previous = held.get(instance_uuid)
+        if previous is not None and previous.action != action:
+            LOG.debug(_("%(action)s of instance %(instance)s on filesystem "
+                        "%(fs)s cancels the held %(previous)s") %
+                      {'action': action, 'instance': instance_uuid,
+                       'fs': fs_name, 'previous': previous.action})
+            del held[instance_uuid]
+            metrics.incr('sharedfs.notifier.cancelled', 2)
+            return
+        held[instance_uuid] = retry.RetryEntry(action, fs_name,
+                                               instance_uuid, addresses)
+
+    @sharedfs_db.scoped_session
+    def _flush(self, fs_name):
+        """Apply the operations held for fs_name as one update."""
+        entries = self.pending.pop(fs_name, {}).values()
+        if not entries:
+            return
+        ctxt = context.get_admin_context()
+        try:
+            attach_ips, detach_ips = self._update_merged(ctxt, fs_name,
+                                                         entries)
+        except Exception as e:
+            LOG.exception(_("Unable to apply %(count)d operations on "
+                            "filesystem %(fs)s") %
+                          {'count': len(entries), 'fs': fs_name})
+            driver.invalidate(fs_name)
+            for entry in entries:
+                self.retry_queue.add(entry.action, fs_name,
+                                     entry.instance_uuid, entry.addresses,
+                                     error=unicode(e))
+            return
+        LOG.info(_("Applied %(count)d operations on filesystem %(fs)s: "
+                   "attached %(attach)s, detached %(detach)s") %
+                 {'count': len(entries), 'fs': fs_name,
+                  'attach': attach_ips, 'detach': detach_ips})
+
+    def _run_all(self, ctxt, instance_uuid, operations):
+        """Run (action, fs_name, addresses) operations on the pool."""
+        threads = [self.pool.spawn(self._run_one, ctxt, action,
+                                   instance_uuid, fs_name, addresses)
+                   for action, fs_name, addresses in operations]
+        results = [thread.wait() for thread in threads]
+
+        failed = [r['filesystem'] for r in results if r['status'] != 'ok']
+        if failed:
+            LOG.warn(_("Instance %(instance)s: %(failed)d of %(total)d "
+                       "filesystems failed and were queued for a retry: "
+                       "%(names)s") %
+                     {'instance': instance_uuid, 'failed': len(failed),
+                      'total': len(results), 'names': failed})
+        elif results:
+            LOG.info(_("Instance %(instance)s: updated filesystems "
+                       "%(names)s") %
+                     {'instance': instance_uuid,
+                      'names': [r['filesystem'] for r in results]})
+        return results
+
+    @sharedfs_db.scoped_session
+    def _run_one(self, ctxt, action, instance_uuid, fs_name, addresses):
+        result = {'filesystem': fs_name, 'action': action, 'status': 'ok'}
+        # This operation is newer than anything queued for the pair.
+        self.retry_queue.supersede(fs_name, instance_uuid)
+        try:
+            self._apply(ctxt, action, instance_uuid, fs_name, addresses)
+        except Exception as e:
+            LOG.exception(_("Unable to %(action)s instance %(instance)s "
+                            "on filesystem %(fs)s") %
+                          {'action': action, 'instance': instance_uuid,
+                           'fs': fs_name})
+            driver.invalidate(fs_name)
+            result['status'] = 'error'
+            result['message'] = unicode(e)
+            self.retry_queue.add(action, fs_name, instance_uuid, addresses,
+                                 error=unicode(e))
+        return result
+
+    def _apply(self, ctxt, action, instance_uuid, fs_name, addresses):
+        if action == retry.ATTACH:
+            self.attach(ctxt, instance_uuid, fs_name, addresses)
+        else:
+            self.unattach(ctxt, instance_uuid, fs_name, addresses)
+
+    def retry_failed(self):
+        """Retry the queued operations that are due.
+
+        The operations for each filesystem are merged into a single
+        access list update.  They are only removed from the queue once
+        that succeeds; those that fail again wait longer.  This is run
+        periodically by the retry worker, so it logs errors rather than
+        raising them.
+        """
+        try:
+            due = self.retry_queue.claim_due()
+        except Exception:
+            LOG.exception(_("Unable to read the sharedfs retry queue"))
+            return
+        if not due:
+            return
+
+        ctxt = context.get_admin_context()
+        threads = [self.pool.spawn(self._retry_fs, ctxt, fs_name, entries)
+                   for fs_name, entries in due.items()]
+        for thread in threads:
+            thread.wait()
+
+    @sharedfs_db.scoped_session
+    def _retry_fs(self, ctxt, fs_name, entries):
+        try:
+            attach_ips, detach_ips = self._update_merged(ctxt, fs_name,
+                                                         entries)
+        except Exception as e:
+            LOG.exception(_("Retry of %(count)d operations on filesystem "
+                            "%(fs)s failed") %
+                          {'count': len(entries), 'fs': fs_name})
+            driver.invalidate(fs_name)
+            self.retry_queue.requeue(entries, error=unicode(e))
+            return
+
+        self.retry_queue.complete(entries)
+        metrics.incr('sharedfs.retry.succeeded', len(entries))
+        LOG.info(_("Retried %(count)d operations on filesystem %(fs)s: "
+                   "attached %(attach)s, detached %(detach)s") %
+                 {'count': len(entries), 'fs': fs_name,
+                  'attach': attach_ips, 'detach': detach_ips})
+
+    def _update_merged(self, ctxt, fs_name, entries):
+        """Apply entries for fs_name as one update and record them.
+
+        Returns (attach_ips, detach_ips) as given to the driver.
+        """
+        attach_ips, detach_ips = retry.merge(entries)
+        if attach_ips or detach_ips:
+            with metrics.timer('sharedfs.driver.update_attachments'):
+                self.fs_driver.update_attachments(fs_name, attach_ips,
+                                                  detach_ips)
+        try:
+            for entry in sorted(entries, key=lambda e: e.created_at):
+                if entry.action == retry.ATTACH:
+                    sharedfs_db.attachment_add_many(ctxt, fs_name,
+                            [(entry.instance_uuid, address)
+                             for address in entry.addresses
+                             if address in attach_ips])
+                else:
+                    sharedfs_db.attachment_delete_by_instance(
+                        ctxt, entry.instance_uuid, fs_name)
+            sharedfs_db.attachments_changed(ctxt, fs_name)
+        except Exception:
+            # The reconciler fixes the records up from the driver.
+            LOG.exception(_("Unable to record attachments for "
+                            "filesystem %s") % fs_name)
+        return attach_ips, detach_ips
+
+    def _lookup_addresses(self, ctxt, instance_uuid):
+        addresses = sharedfs_db.fixed_ips_get_by_instance_uuids(
+            ctxt, [instance_uuid]).get(instance_uuid, [])
+        if not addresses:
+            LOG.warn(_("Unable to get IP address for instance %s.") %
+                     instance_uuid)
+        return addresses
+
+    def attach(self, ctxt, instance_uuid, fs_name, addresses):
+        """Attach all of an instance's addresses to fs_name at once."""
+        if not addresses:
+            return
+        LOG.debug(_("auto-attaching instance %(instance)s (%(ips)s) to "
+                    "filesystem %(fs)s.") %
+                  {'instance': instance_uuid, 'ips': addresses,
+                   'fs': fs_name})
+
+        with metrics.timer('sharedfs.driver.attach'):
+            self.fs_driver.attach(fs_name, list(addresses))
+        sharedfs_db.attachment_add_many(ctxt, fs_name,
+                [(instance_uuid, address) for address in addresses])
+        sharedfs_db.attachments_changed(ctxt, fs_name)
+
+    def unattach(self, ctxt, instance_uuid, fs_name, addresses):
+        """Detach all of an instance's addresses from fs_name at once."""
+        LOG.debug(_("auto unattaching instance %(instance)s (%(ips)s) from "
+                    "filesystem %(fs)s.") %
+                  {'instance': instance_uuid, 'ips': addresses,
+                   'fs': fs_name})
+
+        if addresses:
+            with metrics.timer('sharedfs.driver.unattach'):
+                self.fs_driver.unattach(fs_name, list(addresses))
+        sharedfs_db.attachment_delete_by_instance(ctxt, instance_uuid,
+                                                  fs_name)
+        sharedfs_db.attachments_changed(ctxt, fs_name)
+
+
+@contextlib.contextmanager
+def _stage(stages, name):
+    """Time one stage of handling an event.
+
+    The time is recorded in the stage's histogram and added to
+    stages[name].
+    """
+    timer = metrics.timer('sharedfs.notifier.stage.%s' % name)
+    try:
+        with timer:
+            yield
+    finally:
+        stages[name] = stages.get(name, 0) + timer.elapsed
+
+
+def payload_addresses(payload):
+    """Return the fixed IP addresses listed in a notification payload.
+
+    Entries of payload['fixed_ips'] may be dicts with an 'address' key
+    or plain address strings.  Returns None if the payload has none.
+    """
+    addresses = []
+    for fixed_ip in payload.get('fixed_ips') or []:
+        if isinstance(fixed_ip, dict):
+            fixed_ip = fixed_ip.get('address')
+        if fixed_ip:
+            addresses.append(fixed_ip)
+    return addresses or None
@@ -0,0 +1,291 @@
+# Copyright 2012 Andrew Bogott for the Wikimedia Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Reconcile shared filesystem access lists with the nova database.
+
+Global and project filesystems are supposed to be attached to every
+instance in their scope, but a missed notification or a backend failure
+leaves them out of step.  The Reconciler works out the expected access
+list of each filesystem from the database, compares it with what the
+driver reports, and fixes the difference with one driver update per
+filesystem:
+
+ * global and project filesystems gain any in-scope address they lack;
+ * every filesystem loses addresses that the database recorded as
+   attached to an instance that has since gone away.
+
+Any other address is left alone: hosts, wildcards and addresses of
+instances outside a filesystem's scope may have been attached by hand.
+The instances behind an address are looked up again just before it is
+removed, so an instance created during the run keeps its access.  The
+attachments recorded in the database are then replaced with the result,
+which also fills them in for filesystems attached before they were
+recorded.  Until the first reconciliation, populate_attachments() does
+that once at API startup, so that attachment listings are right straight
+after an upgrade.
+
+Set sharedfs_reconcile_interval to run it periodically in the API
+service, or run sharedfs-reconcile to run it once.  The periodic task
+also purges old soft-deleted records from the sharedfs database.
+"""
+
+import sys
+
+import eventlet
+
+from nova import context
+from nova import flags
+from nova import log as logging
+from nova.openstack.common import cfg
+from nova import utils
+from sharedfs import db as sharedfs_db
+from sharedfs import driver
+
+FLAGS = flags.FLAGS
+LOG = logging.getLogger("nova.plugin.%s" % __name__)
+
+reconcile_opts = [
+    cfg.IntOpt('sharedfs_reconcile_interval',
+               default=0,
+               help='Seconds between reconciliations of shared filesystem '
+                    'access lists with the database.  0 disables the '
+                    'periodic task.'),
+    cfg.IntOpt('sharedfs_reconcile_workers',
+               default=4,
+               help='Maximum number of filesystems reconciled at once.'),
+    cfg.BoolOpt('sharedfs_reconcile_dry_run',
+                default=False,
+                help='Report what reconciliation would change without '
+                     'changing anything.'),
+]
+
+FLAGS.register_opts(reconcile_opts)
+
+# Addresses that are always allowed and never reconciled away.
+PERMANENT_ADDRESSES = ['localhost']
+
+_PERIODIC = None
+
+
+class Reconciler(object):
+    """Brings driver access lists into line with the database."""
+
+    def __init__(self, fs_driver=None):
+        self.fs_driver = fs_driver or driver.get_driver()
+
+    @sharedfs_db.scoped_session
+    def run(self, ctxt, dry_run=False):
+        """Reconcile every filesystem and return a report.
+
+        The report is a dict with a 'filesystems' list, holding the
+        addresses that were (or with dry_run, would be) added to and
+        removed from each filesystem, plus the names of filesystems that
+        only the database ('not_in_driver') or only the driver
+        ('not_in_db') knows about.
+        """
+        db_entries = sharedfs_db.filesystem_get_all(ctxt)
+        driver_names = set(fs.get('name') for fs in self.fs_driver.list_fs())
+        db_names = set(entry.name for entry in db_entries)
+
+        instance_uuids = {}
+        project_addresses = {}
+        for project_id, uuid, address in \
+                sharedfs_db.instance_addresses_get_all(ctxt):
+            instance_uuids[address] = uuid
+            project_addresses.setdefault(project_id, set()).add(address)
+        live_addresses = set(instance_uuids)
+
+        report = {'dry_run': dry_run,
+                  'filesystems': [],
+                  'not_in_driver': sorted(db_names - driver_names),
+                  'not_in_db': sorted(driver_names - db_names)}
+        if report['not_in_driver']:
+            LOG.warn(_("Filesystems recorded in the database but unknown "
+                       "to the driver: %s") % report['not_in_driver'])
+        if report['not_in_db']:
+            LOG.warn(_("Filesystems known to the driver but not recorded "
+                       "in the database: %s") % report['not_in_db'])
+
+        pool = eventlet.GreenPool(max(1, FLAGS.sharedfs_reconcile_workers))
+        for entry in db_entries:
+            if entry.name not in driver_names:
+                continue
+            if entry.state != sharedfs_db.STATE_ACTIVE:
+                # Being created or deleted, or waiting for a retry.
+                continue
+            if entry.scope == 'global':
+                wanted = live_addresses
+            elif entry.scope == 'project':
+                wanted = project_addresses.get(entry.project_id, set())
+            else:
+                wanted = set()
+            pool.spawn_n(self._reconcile_fs, ctxt, entry.name, wanted,
+                         instance_uuids, dry_run, report)
+        pool.waitall()
+
+        report['filesystems'].sort(key=lambda result: result['name'])
+        return report
+
+    def _reconcile_fs(self, ctxt, fs_name, wanted, instance_uuids, dry_run,
+                      report):
+        result = {'name': fs_name, 'missing': [], 'extra': [],
+                  'status': 'ok'}
+        report['filesystems'].append(result)
+        try:
+            actual = set(self.fs_driver.current_attachments(fs_name))
+            missing = sorted(wanted - actual)
+            extra = self._stale_addresses(ctxt, fs_name,
+                                          actual - set(instance_uuids))
+            result['missing'] = missing
+            result['extra'] = extra
+            if missing or extra:
+                LOG.info(_("%(prefix)sfilesystem %(fs)s: add %(missing)s, "
+                           "remove %(extra)s") %
+                         {'prefix': dry_run and _("Dry run: ") or '',
+                          'fs': fs_name, 'missing': missing, 'extra': extra})
+            if dry_run:
+                return
+            if missing or extra:
+                self.fs_driver.update_attachments(fs_name, missing, extra)
+
+            attached = (actual | set(missing)) - set(extra)
+            if sharedfs_db.attachment_set_all(ctxt, fs_name,
+                    [(instance_uuids[ip], ip) for ip in attached
+                     if ip in instance_uuids]):
+                sharedfs_db.attachments_changed(ctxt, fs_name)
+        except Exception as e:
+            LOG.exception(_("Unable to reconcile filesystem %s") % fs_name)
+            driver.invalidate(fs_name)
+            result['status'] = 'error'
+            result['message'] = unicode(e)
+
+    @sharedfs_db.scoped_session
+    def populate(self, ctxt):
+        """Record the driver's attachments of every active filesystem.
+
+        Only addresses of live instances are recorded, alongside any
+        that already are.  Does nothing once it has completed for every
+        filesystem; returns whether it ran.
+        """
+        if sharedfs_db.generation_get(ctxt,
+                                      sharedfs_db.ATTACHMENTS_POPULATED):
+            return False
+
+        instance_uuids = dict((address, uuid) for project_id, uuid, address
+                              in sharedfs_db.instance_addresses_get_all(ctxt))
+        complete = True
+        for entry in sharedfs_db.filesystem_get_all(ctxt):
+            if entry.state != sharedfs_db.STATE_ACTIVE:
+                continue
+            try:
+                addresses = self.fs_driver.current_attachments(entry.name)
+            except Exception:
+                LOG.exception(_("Unable to read the attachments of "
+                                "filesystem %s") % entry.name)
+                complete = False
+                continue
+            sharedfs_db.attachment_add_many(ctxt, entry.name,
+                    [(instance_uuids[ip], ip) for ip in sorted(addresses)
+                     if ip in instance_uuids])
+            sharedfs_db.attachments_changed(ctxt, entry.name)
+
+        if complete:
+            sharedfs_db.generation_bump(ctxt,
+                                        sharedfs_db.ATTACHMENTS_POPULATED)
+        return True
+
+    def _stale_addresses(self, ctxt, fs_name, candidates):
+        """Return the candidates that only gone instances were using.
+
+        Only addresses recorded as attached to fs_name qualify, and only
+        if none of the instances they were recorded for is still alive
+        or using them now.
+        """
+        recorded = {}
+        for uuid, address in \
+                sharedfs_db.attachment_get_all_by_filesystem(ctxt, fs_name):
+            if address in candidates and address not in PERMANENT_ADDRESSES:
+                recorded.setdefault(address, set()).add(uuid)
+        if not recorded:
+            return []
+
+        uuids = set()
+        for owners in recorded.values():
+            uuids.update(owners)
+        alive = sharedfs_db.fixed_ips_get_by_instance_uuids(ctxt,
+                                                            sorted(uuids))
+        in_use = set()
+        for addresses in alive.values():
+            in_use.update(addresses)
+        return sorted(address for address, owners in recorded.items()
+                      if not owners & set(alive) and address not in in_use)
+
+
+def _periodic_reconcile():
+    ctxt = context.get_admin_context()
+    try:
+        Reconciler().run(ctxt, dry_run=FLAGS.sharedfs_reconcile_dry_run)
+    except Exception:
+        LOG.exception(_("Shared filesystem reconciliation failed."))
+
+    if FLAGS.sharedfs_reconcile_dry_run:
+        return
+    try:
+        sharedfs_db.purge_deleted(ctxt)
+    except Exception:
+        LOG.exception(_("Purging deleted shared filesystem records "
+                        "failed."))
+
+
+def populate_attachments():
+    """Fill in the recorded attachments once, logging any failure."""
+    try:
+        Reconciler().populate(context.get_admin_context())
+    except Exception:
+        LOG.exception(_("Unable to record existing shared filesystem "
+                        "attachments."))
+
+
+def start_periodic():
+    """Start the periodic reconciler in this process, once."""
+    global _PERIODIC
+    if _PERIODIC is not None or not FLAGS.sharedfs_reconcile_interval:
+        return
+    _PERIODIC = utils.LoopingCall(_periodic_reconcile)
+    _PERIODIC.start(interval=FLAGS.sharedfs_reconcile_interval, now=False)
+
+
+def main():
+    """Reconcile once from the command line and print the report."""
+    flags.parse_args(sys.argv)
+    logging.setup()
+    sharedfs_db.init_db()
+    dry_run = FLAGS.sharedfs_reconcile_dry_run
+    report = Reconciler().run(context.get_admin_context(), dry_run=dry_run)
+
+    for result in report['filesystems']:
+        line = "%s: %s; add %s; remove %s" % (result['name'],
+                                              result['status'],
+                                              result['missing'] or 'nothing',
+                                              result['extra'] or 'nothing')
+        if result.get('message'):
+            line += " (%s)" % result['message']
+        print(line)
+    for name in report['not_in_driver']:
+        print("%s: in the database only" % name)
+    for name in report['not_in_db']:
+        print("%s: known to the driver only" % name)
+    if dry_run:
+        print("Dry run; nothing was changed.")
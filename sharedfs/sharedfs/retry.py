@@ -0,0 +1,325 @@
+# Copyright 2012 Andrew Bogott for the Wikimedia Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Attach and detach operations that failed and are waiting for a retry.
+
+When the notifier cannot attach a new instance to a filesystem, or
+detach a deleted one, the operation is queued here rather than dropped.
+The queue is kept in a JSON file (sharedfs_retry_queue_path) so that it
+survives a restart.  Each service has a file of its own, and every
+change to it is made under a lock file, so processes that share one
+never lose each other's operations.
+
+A background worker picks up the operations that are due.  It applies
+all of them for one filesystem as a single access list update.  They
+stay in the file until that succeeds, so a crash during a retry loses
+nothing.  An operation that fails again waits twice as long as before,
+up to sharedfs_retry_backoff_max seconds.
+
+A fresh operation for an instance and filesystem replaces any queued
+one for the same pair.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+from eventlet import semaphore
+import lockfile
+
+from nova import flags
+from nova import log as logging
+from nova.openstack.common import cfg
+from nova import utils
+from sharedfs import metrics
+
+FLAGS = flags.FLAGS
+LOG = logging.getLogger("nova.plugin.%s" % __name__)
+
+retry_opts = [
+    cfg.StrOpt('sharedfs_retry_queue_path',
+               default='$state_path/sharedfs-retry-%(binary)s.json',
+               help='File that keeps failed shared filesystem attach and '
+                    'detach operations across restarts.  %(binary)s is '
+                    'replaced by the name of the service, so that each '
+                    'service keeps its own.  If empty, they are only kept '
+                    'in memory.'),
+    cfg.IntOpt('sharedfs_retry_interval',
+               default=10,
+               help='Seconds between runs of the worker that retries '
+                    'failed attach and detach operations.  0 disables '
+                    'the worker.'),
+    cfg.FloatOpt('sharedfs_retry_backoff_base',
+                 default=5.0,
+                 help='Seconds to wait before the first retry of a failed '
+                      'operation; the wait doubles with every failure.'),
+    cfg.FloatOpt('sharedfs_retry_backoff_max',
+                 default=600.0,
+                 help='Longest wait, in seconds, between retries of a '
+                      'failed operation.'),
+]
+
+FLAGS.register_opts(retry_opts)
+
+ATTACH = 'attach'
+DETACH = 'detach'
+
+_QUEUE = None
+_WORKER = None
+
+
+def backoff(attempts):
+    """Return the delay before the retry that follows attempts failures."""
+    delay = FLAGS.sharedfs_retry_backoff_base * 2 ** max(0, attempts - 1)
+    return min(delay, FLAGS.sharedfs_retry_backoff_max)
+
+
+class RetryEntry(object):
+    """One failed attach or detach of an instance's addresses."""
+
+    def __init__(self, action, fs_name, instance_uuid, addresses,
+                 attempts=1, created_at=None, next_attempt=None,
+                 last_error=None, id=None):
+        self.id = id or str(utils.gen_uuid())
+        self.action = action
+        self.fs_name = fs_name
+        self.instance_uuid = instance_uuid
+        self.addresses = list(addresses or [])
+        self.attempts = attempts
+        self.created_at = created_at or time.time()
+        if next_attempt is None:
+            next_attempt = self.created_at + backoff(attempts)
+        self.next_attempt = next_attempt
+        self.last_error = last_error
+
+    def __repr__(self):
+        return "<RetryEntry %s %s %s %s>" % (self.action, self.fs_name,
+                                             self.instance_uuid,
+                                             self.addresses)
+
+    def to_dict(self):
+        return {'id': self.id,
+                'action': self.action,
+                'filesystem': self.fs_name,
+                'instance_uuid': self.instance_uuid,
+                'addresses': self.addresses,
+                'attempts': self.attempts,
+                'created_at': self.created_at,
+                'next_attempt': self.next_attempt,
+                'last_error': self.last_error}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values['action'], values['filesystem'],
+                   values['instance_uuid'], values['addresses'],
+                   attempts=values.get('attempts', 1),
+                   created_at=values.get('created_at'),
+                   next_attempt=values.get('next_attempt'),
+                   last_error=values.get('last_error'),
+                   id=values.get('id'))
+
+
+def merge(entries):
+    """Combine entries for one filesystem into one access list change.
+
+    Returns (attach_ips, detach_ips).  Where entries disagree about an
+    address, the latest one wins.
+    """
+    final = {}
+    order = []
+    for entry in sorted(entries, key=lambda e: e.created_at):
+        for address in entry.addresses:
+            if address not in final:
+                order.append(address)
+            final[address] = entry.action
+    attach_ips = [ip for ip in order if final[ip] == ATTACH]
+    detach_ips = [ip for ip in order if final[ip] == DETACH]
+    return attach_ips, detach_ips
+
+
+class RetryQueue(object):
+    """Failed operations, kept in the file at path if it is set.
+
+    Every change reads the file afresh and writes it back while holding
+    a lock file, so that processes sharing it never undo each other's
+    changes.  Between changes, entries() and len() report the queue as
+    it was last read.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = []
+        self._semaphore = semaphore.Semaphore()
+        with self._locked():
+            pass
+        if self._entries:
+            LOG.info(_("Loaded %(count)d queued sharedfs operations from "
+                       "%(path)s") %
+                     {'count': len(self._entries), 'path': self.path})
+
+    def __len__(self):
+        return len(self._entries)
+
+    def entries(self):
+        return list(self._entries)
+
+    def oldest_age(self):
+        """Seconds since the oldest queued operation first failed."""
+        if not self._entries:
+            return 0
+        return time.time() - min(e.created_at for e in self._entries)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Reload the queue for a with block, then save any changes."""
+        with self._semaphore:
+            if not self.path:
+                yield
+                return
+            with lockfile.FileLock(self.path):
+                self._load()
+                before = [e.to_dict() for e in self._entries]
+                yield
+                if [e.to_dict() for e in self._entries] != before:
+                    self._save()
+
+    def add(self, action, fs_name, instance_uuid, addresses, error=None):
+        """Queue an operation that failed for the first time."""
+        entry = RetryEntry(action, fs_name, instance_uuid, addresses,
+                           last_error=error)
+        LOG.info(_("Queued %(action)s of instance %(instance)s "
+                   "(%(ips)s) on filesystem %(fs)s for a retry.") %
+                 {'action': action, 'instance': instance_uuid,
+                  'ips': entry.addresses, 'fs': fs_name})
+        with self._locked():
+            self._entries.append(entry)
+        metrics.incr('sharedfs.retry.queued')
+        return entry
+
+    def supersede(self, fs_name, instance_uuid):
+        """Drop queued operations for an instance on fs_name.
+
+        Called when a newer operation for the pair is about to run.
+        """
+        with self._locked():
+            kept = [e for e in self._entries
+                    if e.fs_name != fs_name or
+                       e.instance_uuid != instance_uuid]
+            dropped = len(self._entries) - len(kept)
+            self._entries = kept
+        if dropped:
+            LOG.debug(_("Dropped %(count)d queued operations for instance "
+                        "%(instance)s on filesystem %(fs)s") %
+                      {'count': dropped, 'instance': instance_uuid,
+                       'fs': fs_name})
+        return dropped
+
+    def claim_due(self, now=None):
+        """Return {fs_name: [entry]} of the entries that are due.
+
+        The entries stay queued until passed to complete() or requeue(),
+        but are not due again until they would be after another failure,
+        so that other processes sharing the queue leave them alone.
+        """
+        if now is None:
+            now = time.time()
+        due = {}
+        with self._locked():
+            for entry in self._entries:
+                if entry.next_attempt <= now:
+                    due.setdefault(entry.fs_name, []).append(entry)
+                    entry.next_attempt = now + backoff(entry.attempts + 1)
+        return due
+
+    def complete(self, entries):
+        """Remove claimed entries whose retry succeeded."""
+        done = set(entry.id for entry in entries)
+        with self._locked():
+            self._entries = [e for e in self._entries if e.id not in done]
+
+    def requeue(self, entries, error=None):
+        """Back off claimed entries whose retry failed.
+
+        Entries superseded in the meantime are not put back.
+        """
+        failed = set(entry.id for entry in entries)
+        now = time.time()
+        with self._locked():
+            for entry in self._entries:
+                if entry.id in failed:
+                    entry.attempts += 1
+                    entry.next_attempt = now + backoff(entry.attempts)
+                    entry.last_error = error
+        metrics.incr('sharedfs.retry.failed', len(entries))
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                values = json.load(f)
+            self._entries = [RetryEntry.from_dict(entry)
+                             for entry in values.get('entries', [])]
+        except Exception:
+            LOG.exception(_("Unable to read the sharedfs retry queue from "
+                            "%s; moving it aside.") % self.path)
+            os.rename(self.path, self.path + '.corrupt')
+            self._entries = []
+
+    def _save(self):
+        # Write a new file and rename it over the old one, so that a
+        # crash leaves either the old queue or the new one.
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'entries': [e.to_dict() for e in self._entries]},
+                          f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            LOG.exception(_("Unable to save the sharedfs retry queue to "
+                            "%s") % self.path)
+
+
+def get_queue():
+    """Return the RetryQueue shared by this process."""
+    global _QUEUE
+    if _QUEUE is None:
+        path = FLAGS.sharedfs_retry_queue_path
+        if path:
+            path = path % {'binary': os.path.basename(sys.argv[0])}
+        _QUEUE = RetryQueue(path or None)
+        metrics.gauge('sharedfs.retry.depth', _QUEUE.__len__)
+        metrics.gauge('sharedfs.retry.oldest_age', _QUEUE.oldest_age)
+    return _QUEUE
+
+
+def reset():
+    """Forget the process's queue, so that it is reloaded.  For tests."""
+    global _QUEUE
+    _QUEUE = None
+
+
+def start_worker(func):
+    """Call func every sharedfs_retry_interval seconds in this process.
+
+    Only the first call has any effect.
+    """
+    global _WORKER
+    if _WORKER is not None or not FLAGS.sharedfs_retry_interval:
+        return
+    _WORKER = utils.LoopingCall(func)
+    _WORKER.start(interval=FLAGS.sharedfs_retry_interval, now=False)
@@ -38,6 +38,24 @@ class List_Filesystem(command.OpenStackCommand, lister.Lister):
             action='store_true',
             default=False,
             help='Additional fields are listed in output')
+        parser.add_argument(
+            '--scope',
+            metavar='<scope>',
+            help='Only list filesystems with this scope')
+        parser.add_argument(
+            '--project',
+            metavar='<project>',
+            help='Only list filesystems belonging to this project')
+        parser.add_argument(
+            '--prefix',
+            metavar='<prefix>',
+            help='Only list filesystems whose names start with this')
+        parser.add_argument(
+            '--page-size',
+            metavar='<page-size>',
+            type=int,
+            default=None,
+            help='Number of filesystems to fetch per request')
         return parser
 
     def get_data(self, parsed_args):
@@ -49,7 +67,10 @@ class List_Filesystem(command.OpenStackCommand, lister.Lister):
 
         nova_client = self.app.client_manager.compute
         fsmanager = client.SharedFileSystemManager(nova_client)
-        data = fsmanager.fs_list()
+        data = fsmanager.fs_iter(page_size=parsed_args.page_size,
+                                 scope=parsed_args.scope,
+                                 project=parsed_args.project,
+                                 prefix=parsed_args.prefix)
 
         return (columns,
                 (utils.get_item_properties(
@@ -79,6 +100,11 @@ class Create_Filesystem(command.OpenStackCommand, show.ShowOne):
             'filesystem_scope',
             metavar='<filesystem-scope>',
             help='New filesystem scope (project, global, or instance)')
+        parser.add_argument(
+            '--wait',
+            action='store_true',
+            default=False,
+            help='Wait until the filesystem is ready and attached')
         return parser
 
     def get_data(self, parsed_args):
@@ -87,7 +113,8 @@ class Create_Filesystem(command.OpenStackCommand, show.ShowOne):
         fsmanager = client.SharedFileSystemManager(nova_client)
         fs = fsmanager.create(parsed_args.filesystem_name,
                            parsed_args.filesystem_size,
-                           parsed_args.filesystem_scope)
+                           parsed_args.filesystem_scope,
+                           wait=parsed_args.wait)
 
         columns = ('Name', 'Size', 'Scope', 'Project')
         return (columns,
@@ -109,6 +136,11 @@ class Delete_Filesystem(command.OpenStackCommand, command.Command):
             'filesystem_name',
             metavar='<filesystem-name>',
             help='Filesystem name')
+        parser.add_argument(
+            '--wait',
+            action='store_true',
+            default=False,
+            help='Wait until the filesystem has been removed')
         return parser
 
     def run(self, parsed_args):
@@ -116,7 +148,8 @@ class Delete_Filesystem(command.OpenStackCommand, command.Command):
 
         nova_client = self.app.client_manager.compute
         fsmanager = client.SharedFileSystemManager(nova_client)
-        fs = fsmanager.delete(parsed_args.filesystem_name)
+        fs = fsmanager.delete(parsed_args.filesystem_name,
+                              wait=parsed_args.wait)
 
 
 class Attachments_Filesystem(command.OpenStackCommand, lister.Lister):
@@ -208,3 +241,71 @@ class Detach_Filesystem(command.OpenStackCommand, command.Command):
         fsmanager = client.SharedFSAttachmentManager(nova_client)
         fsmanager.unattach(parsed_args.filesystem_name,
                            parsed_args.instance_id)
+
+
+class Bulk_Attach_Filesystem(command.OpenStackCommand, lister.Lister):
+    "Command to attach a FS to many instances at once"
+
+    api = 'compute'
+    log = logging.getLogger("nova.plugin.%s" % __name__)
+
+    def get_parser(self, prog_name):
+        parser = super(Bulk_Attach_Filesystem, self).get_parser(prog_name)
+        parser.add_argument(
+            'filesystem_name',
+            metavar='<filesystem-name>',
+            help='Filesystem name')
+        parser.add_argument(
+            'instance_ids',
+            metavar='<instance-id>',
+            nargs='+',
+            help='Instance IDs')
+        return parser
+
+    def get_data(self, parsed_args):
+        self.log.debug('v2.Bulk_Attach_Filesystem.run(%s)' % parsed_args)
+
+        nova_client = self.app.client_manager.compute
+        fsmanager = client.SharedFSAttachmentManager(nova_client)
+        results = fsmanager.bulk_attach(parsed_args.filesystem_name,
+                                        parsed_args.instance_ids)
+
+        columns = ('id', 'status', 'message')
+        return (columns,
+                ((r.get('id'), r.get('status'), r.get('message', ''))
+                 for r in results),
+                )
+
+
+class Bulk_Detach_Filesystem(command.OpenStackCommand, lister.Lister):
+    "Command to detach a FS from many instances at once"
+
+    api = 'compute'
+    log = logging.getLogger("nova.plugin.%s" % __name__)
+
+    def get_parser(self, prog_name):
+        parser = super(Bulk_Detach_Filesystem, self).get_parser(prog_name)
+        parser.add_argument(
+            'filesystem_name',
+            metavar='<filesystem-name>',
+            help='Filesystem name')
+        parser.add_argument(
+            'instance_ids',
+            metavar='<instance-id>',
+            nargs='+',
+            help='Instance IDs')
+        return parser
+
+    def get_data(self, parsed_args):
+        self.log.debug('v2.Bulk_Detach_Filesystem.run(%s)' % parsed_args)
+
+        nova_client = self.app.client_manager.compute
+        fsmanager = client.SharedFSAttachmentManager(nova_client)
+        results = fsmanager.bulk_unattach(parsed_args.filesystem_name,
+                                          parsed_args.instance_ids)
+
+        columns = ('id', 'status', 'message')
+        return (columns,
+                ((r.get('id'), r.get('status'), r.get('message', ''))
+                 for r in results),
+                )
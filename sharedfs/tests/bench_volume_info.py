@@ -0,0 +1,104 @@
+# Copyright 2012 Andrew Bogott for the Wikimedia Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compare the gluster volume info parsers on synthetic clusters.
+
+Run from the sharedfs directory with:
+
+    python -m tests.bench_volume_info [repeat]
+
+For 10, 100 and 1000 volumes it prints the best time, out of repeat
+runs, that each parser takes to read the whole cluster.
+"""
+
+import sys
+import timeit
+
+from sharedfs.driver import sharedfs_gluster_driver
+
+BRICKS_PER_VOLUME = 4
+SIZES = [10, 100, 1000]
+
+
+def _options(i):
+    return [('features.limit-usage', '/data:%dGB' % (i % 50 + 1)),
+            ('features.quota', 'on'),
+            ('auth.allow', ','.join(['localhost'] +
+                                    ['10.0.%d.%d' % (i % 250, n)
+                                     for n in range(1, 21)]))]
+
+
+def _bricks(i):
+    return ['server%d:/exp%d/project%d/vol%d' % (n, n, i, i)
+            for n in range(1, BRICKS_PER_VOLUME + 1)]
+
+
+def make_xml(count):
+    volumes = []
+    for i in range(count):
+        bricks = ''.join('<brick uuid="%d">%s<name>%s</name></brick>' %
+                         (n, brick, brick)
+                         for n, brick in enumerate(_bricks(i)))
+        options = ''.join('<option><name>%s</name><value>%s</value>'
+                          '</option>' % option for option in _options(i))
+        volumes.append('<volume><name>vol%d</name><status>1</status>'
+                       '<statusStr>Started</statusStr>'
+                       '<brickCount>%d</brickCount><bricks>%s</bricks>'
+                       '<optCount>%d</optCount><options>%s</options>'
+                       '</volume>' %
+                       (i, BRICKS_PER_VOLUME, bricks, len(_options(i)),
+                        options))
+    return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<cliOutput><opRet>0</opRet><opErrno>0</opErrno><opErrstr/>'
+            '<volInfo><volumes>%s<count>%d</count></volumes></volInfo>'
+            '</cliOutput>' % (''.join(volumes), count))
+
+
+def make_text(count):
+    lines = []
+    for i in range(count):
+        lines.extend(['', 'Volume Name: vol%d' % i, 'Type: Replicate',
+                      'Status: Started',
+                      'Number of Bricks: %d' % BRICKS_PER_VOLUME,
+                      'Transport-type: tcp', 'Bricks:'])
+        lines.extend('Brick%d: %s' % (n + 1, brick)
+                     for n, brick in enumerate(_bricks(i)))
+        lines.append('Options Reconfigured:')
+        lines.extend('%s: %s' % option for option in _options(i))
+    return '\n'.join(lines)
+
+
+def main():
+    repeat = len(sys.argv) > 1 and int(sys.argv[1]) or 5
+    print("%8s %12s %12s" % ('volumes', 'xml (ms)', 'text (ms)'))
+    for count in SIZES:
+        xml = make_xml(count)
+        text = make_text(count)
+        parsed = sharedfs_gluster_driver.parse_volume_info_xml(xml)
+        assert parsed == sharedfs_gluster_driver.parse_volume_info_text(text)
+        assert len(parsed) == count
+
+        xml_time = min(timeit.repeat(
+            lambda: sharedfs_gluster_driver.parse_volume_info_xml(xml),
+            number=1, repeat=repeat))
+        text_time = min(timeit.repeat(
+            lambda: sharedfs_gluster_driver.parse_volume_info_text(text),
+            number=1, repeat=repeat))
+        print("%8d %12.2f %12.2f" % (count, xml_time * 1000,
+                                     text_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
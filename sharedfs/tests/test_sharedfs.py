@@ -13,16 +13,29 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import os
+import sys
+import tempfile
+import time
 import UserDict
 
+import eventlet
 import webob
 
 from nova import context
 from nova import db
+from nova import exception
 from nova import test
+from nova import utils
 from nova.tests.api.openstack import fakes
 from sharedfs import api
+from sharedfs import backfill
+from sharedfs import jobs
+from sharedfs import metrics
 from sharedfs import notifier
+from sharedfs import reconcile
+from sharedfs import retry
 from sharedfs import db as sharedfs_db
 from sharedfs.driver import sharedfs_driver
 
@@ -56,15 +69,19 @@ def db_filesystem_list(context):
 
 
 class fake_fs_model(UserDict.UserDict):
-    def __init__(self, name, project_id, size, scope):
+    def __init__(self, name, project_id, size, scope, state='active'):
         self.name = name
         self.project_id = project_id
         self.size = size
         self.scope = scope
+        self.state = state
+        self.created_at = None
+        self.updated_at = None
         self.data = {'name': name,
                      'project_id': project_id,
                      'size': size,
-                     'scope': scope}
+                     'scope': scope,
+                     'state': state}
 
 
 def db_filesystem_get(context, name):
@@ -83,6 +100,31 @@ def db_filesystem_get(context, name):
     return fake_fs_model(name, project1_id, size, scope)
 
 
+def db_filesystem_get_all(context, filters=None, marker=None, limit=None,
+                          sort_key='name', sort_dir='asc'):
+    entries = [db_filesystem_get(context, name)
+               for name in db_filesystem_list(context)]
+    entries = [entry for entry in entries if entry]
+    for key, value in (filters or {}).items():
+        if key == 'name':
+            entries = [e for e in entries if e.name.startswith(value)]
+        else:
+            entries = [e for e in entries if getattr(e, key) == value]
+    entries.sort(key=lambda e: (getattr(e, sort_key), e.name),
+                 reverse=(sort_dir == 'desc'))
+    if marker is not None:
+        names = [e.name for e in entries]
+        entries = entries[names.index(marker) + 1:]
+    return entries[:limit]
+
+
+def db_filesystem_names_get_for_project(context, project_id):
+    return sorted(entry.name for entry in db_filesystem_get_all(context)
+                  if entry.scope == 'global' or
+                     (entry.scope == 'project' and
+                      entry.project_id == project_id))
+
+
 class fake_instance(object):
     def __init__(self, id, project):
         self.id = id
@@ -96,10 +138,6 @@ def db_instance_get_all(context):
             fake_instance('bogus', 'noproject')]
 
 
-def db_instance_get(context, instance_id):
-    return fake_instance(instance_id, 'bogus project')
-
-
 def db_instance_get_all_by_project(context, project_id):
     return [fake_instance(instance2_id, project2_id)]
 
@@ -135,27 +173,113 @@ def db_fixed_ip_get_by_instance(context, instanceid):
     return [fake_fixed_ip(ip, instanceid)]
 
 
-def db_fixed_ip_get_by_address(context, ip):
-    if ip == instance1_ip:
-        return fake_fixed_ip(ip, instance1_id)
-    elif ip == instance2_ip:
-        return fake_fixed_ip(ip, instance2_id)
-    else:
-        return fake_fixed_ip(ip, 'bogus')
+def stub_generations(stubs):
+    """Keep sharedfs generation counters in a dict instead of the db."""
+    generations = {}
+
+    def db_generation_get_many(context, keys):
+        return dict((key, generations.get(key, 0)) for key in keys)
+
+    def db_generation_get(context, key):
+        return generations.get(key, 0)
+
+    def db_generation_bump(context, key):
+        generations[key] = generations.get(key, 0) + 1
+
+    stubs.Set(sharedfs_db, 'generation_get_many', db_generation_get_many)
+    stubs.Set(sharedfs_db, 'generation_get', db_generation_get)
+    stubs.Set(sharedfs_db, 'generation_bump', db_generation_bump)
+    return generations
+
+
+def stub_attachments(stubs):
+    """Keep recorded attachments in a list instead of the db.
+
+    Each entry of the returned list is (filesystem, instance_uuid,
+    address).
+    """
+    attachments = []
+
+    def db_attachment_get_all_by_filesystem(context, fs_name):
+        return [(uuid, address) for name, uuid, address in attachments
+                if name == fs_name]
+
+    def db_attachment_get_all_by_instance(context, instance_uuid):
+        return [(name, address) for name, uuid, address in attachments
+                if uuid == instance_uuid]
+
+    def db_attachment_add_many(context, fs_name, pairs):
+        for uuid, address in pairs:
+            if (fs_name, uuid, address) not in attachments:
+                attachments.append((fs_name, uuid, address))
+
+    def db_attachment_delete_many(context, fs_name, addresses):
+        attachments[:] = [a for a in attachments
+                          if a[0] != fs_name or a[2] not in addresses]
+
+    def db_attachment_delete_by_instance(context, instance_uuid,
+                                         fs_name=None):
+        attachments[:] = [a for a in attachments
+                          if a[1] != instance_uuid or
+                             fs_name not in (None, a[0])]
+
+    def db_attachment_set_all(context, fs_name, pairs):
+        before = sorted(a for a in attachments if a[0] == fs_name)
+        attachments[:] = [a for a in attachments if a[0] != fs_name]
+        db_attachment_add_many(context, fs_name, pairs)
+        return sorted(a for a in attachments if a[0] == fs_name) != before
+
+    for name, func in [
+            ('attachment_get_all_by_filesystem',
+             db_attachment_get_all_by_filesystem),
+            ('attachment_get_all_by_instance',
+             db_attachment_get_all_by_instance),
+            ('attachment_add_many', db_attachment_add_many),
+            ('attachment_delete_many', db_attachment_delete_many),
+            ('attachment_delete_by_instance',
+             db_attachment_delete_by_instance),
+            ('attachment_set_all', db_attachment_set_all)]:
+        stubs.Set(sharedfs_db, name, func)
+    return attachments
 
 
 class SharedFSTest(test.TestCase):
     def setUp(self):
         super(SharedFSTest, self).setUp()
         self.fs_controller = api.SharedFSController()
+        self.generations = stub_generations(self.stubs)
+        self.attachments = stub_attachments(self.stubs)
 
-        def db_filesystem_add(context, name, scope, project):
-            pass
+        # Filesystems start out unknown; tests that need existing records
+        # stub filesystem_get with db_filesystem_get.
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get',
+                       lambda context, name: None)
+
+        self.added = []
+
+        def db_filesystem_add(context, name, scope, project, state=None):
+            self.added.append((name, state))
 
         self.stubs.Set(sharedfs_db,
                        'filesystem_add',
                        db_filesystem_add)
 
+        self.states = []
+
+        def db_filesystem_update(context, name, values):
+            if 'state' in values:
+                self.states.append((name, values['state']))
+
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_update',
+                       db_filesystem_update)
+
+        self.deleted = []
+
+        def db_filesystem_delete(context, name):
+            self.deleted.append(name)
+
         def driver_fs_create(slf, name, project_name, size):
             pass
 
@@ -179,22 +303,152 @@ class SharedFSTest(test.TestCase):
                        'list_fs',
                        driver_list_fs)
         self.stubs.Set(sharedfs_db,
-                       'filesystem_list',
-                       db_filesystem_list)
-        self.stubs.Set(sharedfs_db,
-                       'filesystem_get',
-                       db_filesystem_get)
+                       'filesystem_get_all',
+                       db_filesystem_get_all)
 
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem')
-        res_dict = self.fs_controller.index(req)
+        res_dict = self.fs_controller.index(req).obj
         fs_entries = res_dict.get('fs_entries')
 
         self.assertEqual(len(fs_entries), 3)
-        self.assertEqual(fs_entries[0].get('name'), 'instancefs')
-        self.assertEqual(fs_entries[1].get('name'), 'projectfs')
-        self.assertEqual(fs_entries[2].get('name'), 'globalfs')
-        self.assertEqual(fs_entries[0].get('size'), 1)
-        self.assertEqual(fs_entries[2].get('scope'), 'global')
+        self.assertEqual(fs_entries[0].get('name'), 'globalfs')
+        self.assertEqual(fs_entries[1].get('name'), 'instancefs')
+        self.assertEqual(fs_entries[2].get('name'), 'projectfs')
+        self.assertEqual(fs_entries[1].get('size'), 1)
+        self.assertEqual(fs_entries[0].get('scope'), 'global')
+        self.assertFalse('fs_entries_links' in res_dict)
+
+    def test_fs_list_not_modified(self):
+        self.flags(sharedfs_etag_lifetime=0)
+        listings = []
+
+        def driver_list_fs_counted(slf):
+            listings.append(1)
+            return driver_list_fs(slf)
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'list_fs',
+                       driver_list_fs_counted)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get_all',
+                       db_filesystem_get_all)
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem')
+        etag = self.fs_controller.index(req)['ETag']
+        self.assertEqual(len(listings), 1)
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem')
+        req.headers['If-None-Match'] = etag
+        res = self.fs_controller.index(req)
+        self.assertEqual(res.status_int, 304)
+        self.assertEqual(len(listings), 1)
+
+        # A different query is a different resource.
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem?scope=global')
+        req.headers['If-None-Match'] = etag
+        self.assertNotEqual(self.fs_controller.index(req)['ETag'], etag)
+        self.assertEqual(len(listings), 2)
+
+        # Any change to the filesystems table changes the ETag.
+        sharedfs_db.generation_bump(None,
+                                    sharedfs_db.FILESYSTEMS_GENERATION)
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem')
+        req.headers['If-None-Match'] = etag
+        res = self.fs_controller.index(req)
+        self.assertNotEqual(res['ETag'], etag)
+        self.assertEqual(len(listings), 3)
+
+    def test_fs_list_paginated(self):
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'list_fs',
+                       driver_list_fs)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get_all',
+                       db_filesystem_get_all)
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem?limit=2')
+        res_dict = self.fs_controller.index(req).obj
+        fs_entries = res_dict.get('fs_entries')
+        self.assertEqual([e['name'] for e in fs_entries],
+                         ['globalfs', 'instancefs'])
+        links = res_dict.get('fs_entries_links')
+        self.assertEqual(links[0]['rel'], 'next')
+        self.assertTrue('marker=instancefs' in links[0]['href'])
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem?limit=2'
+                                      '&marker=instancefs')
+        res_dict = self.fs_controller.index(req).obj
+        fs_entries = res_dict.get('fs_entries')
+        self.assertEqual([e['name'] for e in fs_entries], ['projectfs'])
+        self.assertFalse('fs_entries_links' in res_dict)
+
+        # No limit at all, rather than an empty page.
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem?limit=0')
+        res_dict = self.fs_controller.index(req).obj
+        fs_entries = res_dict.get('fs_entries')
+        self.assertEqual([e['name'] for e in fs_entries],
+                         ['globalfs', 'instancefs', 'projectfs'])
+        self.assertFalse('fs_entries_links' in res_dict)
+
+    def test_fs_list_filtered(self):
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'list_fs',
+                       driver_list_fs)
+
+        calls = []
+
+        def db_filesystem_get_all_spy(context, **kwargs):
+            calls.append(kwargs)
+            return db_filesystem_get_all(context, **kwargs)
+
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get_all',
+                       db_filesystem_get_all_spy)
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem?scope=project'
+                                      '&project=project1&prefix=proj'
+                                      '&sort_key=project&sort_dir=desc')
+        res_dict = self.fs_controller.index(req).obj
+        fs_entries = res_dict.get('fs_entries')
+        self.assertEqual([e['name'] for e in fs_entries], ['projectfs'])
+        self.assertEqual(calls[0]['filters'], {'scope': 'project',
+                                               'project_id': project1_id,
+                                               'name': 'proj',
+                                               'state': 'active'})
+        self.assertEqual(calls[0]['sort_key'], 'project_id')
+        self.assertEqual(calls[0]['sort_dir'], 'desc')
+
+    def test_fs_show(self):
+        def driver_get_fs(slf, name):
+            for fs in driver_list_fs(slf):
+                if fs['name'] == name:
+                    return fs
+            return None
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'get_fs',
+                       driver_get_fs)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get',
+                       db_filesystem_get)
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      project_fs_name)
+        res_dict = self.fs_controller.show(req, project_fs_name)
+        entry = res_dict.get('fs_entry')
+        self.assertEqual(entry.get('name'), project_fs_name)
+        self.assertEqual(entry.get('size'), 2)
+        self.assertEqual(entry.get('scope'), 'project')
+        self.assertEqual(entry.get('project'), project1_id)
+
+        # Not in the database
+        self.assertRaises(webob.exc.HTTPNotFound,
+                          self.fs_controller.show,
+                          req, 'bogus')
+        # Not known to the driver
+        self.assertRaises(webob.exc.HTTPNotFound,
+                          self.fs_controller.show,
+                          req, 'nonsense')
 
     def test_fs_create_and_attach_global(self):
         self.stubs.Set(db,
@@ -205,29 +459,29 @@ class SharedFSTest(test.TestCase):
                        'fixed_ip_get_by_instance',
                        db_fixed_ip_get_by_instance)
 
-        attachments = []
+        updates = []
 
-        def driver_attach(slf, name, ip):
-            attachments.append({'name': name, 'ip': ip})
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            updates.append((name, attach_ips, unattach_ips))
 
         self.stubs.Set(sharedfs_driver.SharedFSDriver,
-                       'attach',
-                       driver_attach)
+                       'update_attachments',
+                       driver_update_attachments)
 
         body = {'fs_entry': {'size': 11, 'scope': 'global'}}
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
                                       global_fs_name)
         res_dict = self.fs_controller.update(req, global_fs_name, body)
+        self.fs_controller.jobs.wait()
 
         res_entry = res_dict.get('fs_entry')
         self.assertEqual(res_entry.get('name'), global_fs_name)
         self.assertEqual(res_entry.get('size'), 11)
         self.assertEqual(res_entry.get('scope'), 'global')
-        self.assertEqual(len(attachments), 3)
-        self.assertEqual(attachments[0].get('name'), global_fs_name)
-        self.assertEqual(attachments[1].get('name'), global_fs_name)
-        self.assertEqual(attachments[0].get('ip'), instance1_ip)
-        self.assertEqual(attachments[1].get('ip'), instance2_ip)
+        # The whole scope is attached with a single update.
+        self.assertEqual(updates,
+                         [(global_fs_name,
+                           [instance1_ip, instance2_ip, '0.0.0.0'], [])])
 
     def test_fs_create_and_attach_project(self):
         self.stubs.Set(db,
@@ -238,27 +492,26 @@ class SharedFSTest(test.TestCase):
                        'fixed_ip_get_by_instance',
                        db_fixed_ip_get_by_instance)
 
-        attachments = []
+        updates = []
 
-        def driver_attach(slf, name, ip):
-            attachments.append({'name': name, 'ip': ip})
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            updates.append((name, attach_ips, unattach_ips))
 
         self.stubs.Set(sharedfs_driver.SharedFSDriver,
-                       'attach',
-                       driver_attach)
+                       'update_attachments',
+                       driver_update_attachments)
 
         body = {'fs_entry': {'size': 11, 'scope': 'project'}}
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s'
                                       % project_fs_name)
         res_dict = self.fs_controller.update(req, project_fs_name, body)
+        self.fs_controller.jobs.wait()
 
         res_entry = res_dict.get('fs_entry')
         self.assertEqual(res_entry.get('name'), project_fs_name)
         self.assertEqual(res_entry.get('size'), 11)
         self.assertEqual(res_entry.get('scope'), 'project')
-        self.assertEqual(len(attachments), 1)
-        self.assertEqual(attachments[0].get('name'), project_fs_name)
-        self.assertEqual(attachments[0].get('ip'), instance2_ip)
+        self.assertEqual(updates, [(project_fs_name, [instance2_ip], [])])
 
     def test_fs_delete_and_detach_project(self):
         self.stubs.Set(db,
@@ -273,14 +526,14 @@ class SharedFSTest(test.TestCase):
                        'filesystem_get',
                        db_filesystem_get)
 
-        detachments = []
+        updates = []
 
-        def driver_unattach(slf, name, ip):
-            detachments.append({'name': name, 'ip': ip})
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            updates.append((name, attach_ips, unattach_ips))
 
         self.stubs.Set(sharedfs_driver.SharedFSDriver,
-                       'unattach',
-                       driver_unattach)
+                       'update_attachments',
+                       driver_update_attachments)
 
         bogus_name = "bogus_project_name"
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
@@ -293,10 +546,9 @@ class SharedFSTest(test.TestCase):
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
                                       project_fs_name)
         res_dict = self.fs_controller.delete(req, project_fs_name)
+        self.fs_controller.jobs.wait()
 
-        self.assertEqual(len(detachments), 1)
-        self.assertEqual(detachments[0].get('name'), project_fs_name)
-        self.assertEqual(detachments[0].get('ip'), instance2_ip)
+        self.assertEqual(updates, [(project_fs_name, [], [instance2_ip])])
 
     def test_fs_delete_and_detach_global(self):
         self.stubs.Set(db,
@@ -311,56 +563,291 @@ class SharedFSTest(test.TestCase):
                        'filesystem_get',
                        db_filesystem_get)
 
-        detachments = []
+        updates = []
 
-        def driver_unattach(slf, name, ip):
-            detachments.append({'name': name, 'ip': ip})
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            updates.append((name, attach_ips, unattach_ips))
 
         self.stubs.Set(sharedfs_driver.SharedFSDriver,
-                       'unattach',
-                       driver_unattach)
+                       'update_attachments',
+                       driver_update_attachments)
 
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
                                       global_fs_name)
         res_dict = self.fs_controller.delete(req, global_fs_name)
+        self.fs_controller.jobs.wait()
 
-        self.assertEqual(len(detachments), 3)
-        self.assertEqual(detachments[0].get('name'), global_fs_name)
-        self.assertEqual(detachments[0].get('ip'), instance1_ip)
-        self.assertEqual(detachments[1].get('name'), global_fs_name)
-        self.assertEqual(detachments[1].get('ip'), instance2_ip)
+        self.assertEqual(updates,
+                         [(global_fs_name, [],
+                           [instance1_ip, instance2_ip, '0.0.0.0'])])
+
+    def test_fs_create_job(self):
+        self.stubs.Set(db,
+                       'instance_get_all',
+                       db_instance_get_all)
+
+        self.stubs.Set(db,
+                       'fixed_ip_get_by_instance',
+                       db_fixed_ip_get_by_instance)
+
+        body = {'fs_entry': {'size': 11, 'scope': 'global'}}
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      global_fs_name)
+        res_dict = self.fs_controller.update(req, global_fs_name, body)
+        job_id = res_dict['job']['id']
+        self.assertEqual(res_dict['job']['action'], 'create')
+        self.assertEqual(res_dict['job']['filesystem'], global_fs_name)
+        self.fs_controller.jobs.wait()
+
+        job_controller = api.SharedFSJobController()
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s/jobs/%s' %
+                                      (global_fs_name, job_id))
+        job = job_controller.show(req, global_fs_name, job_id)['job']
+        self.assertEqual(job['status'], 'complete')
+        self.assertEqual(job['progress']['total'], 3)
+        self.assertEqual(job['progress']['completed'], 3)
+        self.assertEqual(job['errors'], [])
+
+        self.assertRaises(webob.exc.HTTPNotFound,
+                          job_controller.show,
+                          req, project_fs_name, job_id)
+        self.assertRaises(webob.exc.HTTPNotFound,
+                          job_controller.show,
+                          req, global_fs_name, 'nosuchjob')
+
+    def test_fs_create_job_failure(self):
+        def driver_fs_create(slf, name, project_name, size):
+            raise Exception("brick failure")
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'create_fs',
+                       driver_fs_create)
+
+        body = {'fs_entry': {'size': 11, 'scope': 'instance'}}
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      instance_fs_name)
+        res_dict = self.fs_controller.update(req, instance_fs_name, body)
+        self.fs_controller.jobs.wait()
+
+        job = jobs.get_manager().get(res_dict['job']['id'])
+        self.assertEqual(job.status, 'error')
+        self.assertEqual(job.errors, ['brick failure'])
+
+        # The half-made filesystem was removed again.
+        self.assertEqual(self.added, [(instance_fs_name, 'creating')])
+        self.assertEqual(self.deleted, [instance_fs_name])
+        self.assertEqual(self.states, [])
+
+    def test_fs_create_rollback_failure(self):
+        def driver_fs_create(slf, name, project_name, size):
+            raise Exception("brick failure")
+
+        def driver_fs_delete(slf, name, tenant):
+            raise Exception("volume busy")
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'create_fs',
+                       driver_fs_create)
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'delete_fs',
+                       driver_fs_delete)
+
+        body = {'fs_entry': {'size': 11, 'scope': 'instance'}}
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      instance_fs_name)
+        self.fs_controller.update(req, instance_fs_name, body)
+        self.fs_controller.jobs.wait()
+
+        self.assertEqual(self.deleted, [])
+        self.assertEqual(self.states, [(instance_fs_name, 'error')])
+
+    def test_fs_create_conflict_and_retry(self):
+        def db_filesystem_get_error(context, name):
+            entry = db_filesystem_get(context, name)
+            if name == instance_fs_name:
+                entry.state = 'error'
+            return entry
+
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get',
+                       db_filesystem_get_error)
+
+        removed = []
+
+        def driver_fs_delete(slf, name, tenant):
+            removed.append(name)
+            raise exception.NotFound()
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'delete_fs',
+                       driver_fs_delete)
+
+        body = {'fs_entry': {'size': 11, 'scope': 'instance'}}
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      project_fs_name)
+        self.assertRaises(webob.exc.HTTPConflict,
+                          self.fs_controller.update,
+                          req, project_fs_name, body)
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      instance_fs_name)
+        res_dict = self.fs_controller.update(req, instance_fs_name, body)
+        self.fs_controller.jobs.wait()
+
+        self.assertEqual(res_dict['fs_entry']['state'], 'creating')
+        self.assertEqual(self.added, [])
+        self.assertEqual(removed, [instance_fs_name])
+        self.assertEqual(self.states, [(instance_fs_name, 'creating'),
+                                       (instance_fs_name, 'active')])
+
+    def test_fs_stale_state(self):
+        self.flags(sharedfs_stale_state_timeout=3600)
+        now = utils.utcnow()
+        updated = {}
+
+        def db_filesystem_get_stuck(context, name):
+            entry = db_filesystem_get(context, name)
+            entry.state = 'creating'
+            entry.updated_at = updated[name]
+            return entry
+
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get',
+                       db_filesystem_get_stuck)
+
+        # Recently started: still in progress.
+        updated[instance_fs_name] = now - datetime.timedelta(minutes=5)
+        body = {'fs_entry': {'size': 11, 'scope': 'instance'}}
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      instance_fs_name)
+        self.assertRaises(webob.exc.HTTPConflict,
+                          self.fs_controller.update,
+                          req, instance_fs_name, body)
+        self.assertRaises(webob.exc.HTTPConflict,
+                          self.fs_controller.delete,
+                          req, instance_fs_name)
+
+        # Left behind by an API server that died: treated as failed.
+        updated[instance_fs_name] = now - datetime.timedelta(hours=2)
+        self.fs_controller.update(req, instance_fs_name, body)
+        self.fs_controller.jobs.wait()
+        self.assertEqual(self.added, [])
+        self.assertEqual(self.states, [(instance_fs_name, 'creating'),
+                                       (instance_fs_name, 'active')])
+
+        self.states = []
+        res_dict = self.fs_controller.delete(req, instance_fs_name)
+        self.fs_controller.jobs.wait()
+        job = jobs.get_manager().get(res_dict['job']['id'])
+        self.assertEqual(job.status, 'complete')
+        self.assertEqual(self.deleted, [instance_fs_name])
+
+    def test_fs_delete_scope_failure(self):
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get',
+                       db_filesystem_get)
+
+        def db_instance_get_all(context):
+            raise exception.DBError()
+
+        self.stubs.Set(db,
+                       'instance_get_all',
+                       db_instance_get_all)
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      global_fs_name)
+        res_dict = self.fs_controller.delete(req, global_fs_name)
+        self.fs_controller.jobs.wait()
+
+        # Failing before the driver was reached still marks the error.
+        job = jobs.get_manager().get(res_dict['job']['id'])
+        self.assertEqual(job.status, 'error')
+        self.assertEqual(self.states, [(global_fs_name, 'deleting'),
+                                       (global_fs_name, 'error')])
+        self.assertEqual(self.deleted, [])
+
+    def test_fs_delete_already_removed(self):
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get',
+                       db_filesystem_get)
+
+        def driver_fs_delete(slf, name, tenant):
+            raise exception.NotFound()
 
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'delete_fs',
+                       driver_fs_delete)
 
-def driver_list_attachments(self, fs_name):
-    return ['localhost', instance1_ip, instance2_ip]
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      instance_fs_name)
+        res_dict = self.fs_controller.delete(req, instance_fs_name)
+        self.fs_controller.jobs.wait()
+
+        job = jobs.get_manager().get(res_dict['job']['id'])
+        self.assertEqual(job.status, 'complete')
+        self.assertEqual(self.states, [(instance_fs_name, 'deleting')])
+        self.assertEqual(self.deleted, [instance_fs_name])
 
 
 class SharedAttachTest(test.TestCase):
     def setUp(self):
         super(SharedAttachTest, self).setUp()
         self.attachment_controller = api.SharedFSAttachmentController()
+        self.generations = stub_generations(self.stubs)
+        self.attachments = stub_attachments(self.stubs)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get',
+                       db_filesystem_get)
 
     def test_list_attachments(self):
+        def driver_list_attachments(slf, fs_name):
+            self.fail("listing attachments should not reach the driver")
+
         self.stubs.Set(sharedfs_driver.SharedFSDriver,
                        'list_attachments',
                        driver_list_attachments)
 
-        self.stubs.Set(db,
-                       'fixed_ip_get_by_address',
-                       db_fixed_ip_get_by_address)
-
-        self.stubs.Set(db,
-                       'instance_get',
-                       db_instance_get)
+        self.attachments.extend([(global_fs_name, instance1_id, instance1_ip),
+                                 (project_fs_name, instance1_id, instance1_ip),
+                                 (global_fs_name, instance2_id, instance2_ip),
+                                 (global_fs_name, instance2_id, '10.0.0.2')])
 
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s/attachments' %
                                       global_fs_name)
-        res_dict = self.attachment_controller.index(req, global_fs_name)
+        res_dict = self.attachment_controller.index(req,
+                                                   global_fs_name).obj
         instance_entries = res_dict.get('instance_entries')
         self.assertEqual(len(instance_entries), 2)
         self.assertEqual(instance_entries[0]['id'], instance1_id)
         self.assertEqual(instance_entries[1]['id'], instance2_id)
 
+    def test_list_attachments_not_modified(self):
+        self.flags(sharedfs_etag_lifetime=0)
+        self.stubs.Set(db,
+                       'instance_get_by_uuid',
+                       db_instance_get_by_uuid)
+        self.stubs.Set(db,
+                       'fixed_ip_get_by_instance',
+                       db_fixed_ip_get_by_instance)
+
+        url = '/vw/123/os-filesystem/%s/attachments' % global_fs_name
+        req = fakes.HTTPRequest.blank(url)
+        etag = self.attachment_controller.index(req, global_fs_name)['ETag']
+
+        req = fakes.HTTPRequest.blank(url)
+        req.headers['If-None-Match'] = etag
+        res = self.attachment_controller.index(req, global_fs_name)
+        self.assertEqual(res.status_int, 304)
+
+        req = fakes.HTTPRequest.blank('%s/%s' % (url, instance1_id))
+        self.attachment_controller.update(req, global_fs_name,
+                                          instance1_id, None)
+
+        req = fakes.HTTPRequest.blank(url)
+        req.headers['If-None-Match'] = etag
+        res = self.attachment_controller.index(req, global_fs_name)
+        self.assertNotEqual(res['ETag'], etag)
+
     def test_attach(self):
         self.stubs.Set(db,
                        'instance_get_by_uuid',
@@ -398,6 +885,8 @@ class SharedAttachTest(test.TestCase):
         self.assertEqual(len(attachments), 1)
         self.assertEqual(attachments[0].get('name'), global_fs_name)
         self.assertEqual(attachments[0].get('ip'), instance1_ip)
+        self.assertEqual(self.attachments,
+                         [(global_fs_name, instance1_id, instance1_ip)])
 
     def test_unattach(self):
         self.stubs.Set(db,
@@ -426,6 +915,8 @@ class SharedAttachTest(test.TestCase):
                           global_fs_name,
                           fake_instance_name)
 
+        self.attachments.extend([(global_fs_name, instance1_id, instance1_ip),
+                                 (global_fs_name, instance2_id, instance2_ip)])
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s/attachments/%s'
                                       % (global_fs_name, instance1_id))
         self.attachment_controller.delete(req, global_fs_name, instance1_id)
@@ -433,26 +924,149 @@ class SharedAttachTest(test.TestCase):
         self.assertEqual(len(unattachments), 1)
         self.assertEqual(unattachments[0].get('name'), global_fs_name)
         self.assertEqual(unattachments[0].get('ip'), instance1_ip)
+        self.assertEqual(self.attachments,
+                         [(global_fs_name, instance2_id, instance2_ip)])
+
+    def test_bulk_update(self):
+        def db_fixed_ips_get_by_instance_uuids(context, uuids):
+            self.assertEqual(uuids, [instance1_id, 'noips',
+                                     instance2_id, 'fakefake'])
+            return {instance1_id: [instance1_ip],
+                    instance2_id: [instance2_ip],
+                    'noips': []}
+
+        self.stubs.Set(sharedfs_db,
+                       'fixed_ips_get_by_instance_uuids',
+                       db_fixed_ips_get_by_instance_uuids)
+
+        updates = []
+
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            updates.append((name, attach_ips, unattach_ips))
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'update_attachments',
+                       driver_update_attachments)
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s/'
+                                      'attachments/bulk' % global_fs_name)
+        body = {'attach': [instance1_id, 'noips'],
+                'detach': [instance2_id, 'fakefake']}
+        res_dict = self.attachment_controller.bulk(req, global_fs_name, body)
+
+        self.assertEqual(updates, [(global_fs_name, [instance1_ip],
+                                    [instance2_ip])])
+        results = res_dict['results']
+        self.assertEqual([(r['id'], r['action'], r['status'])
+                          for r in results],
+                         [(instance1_id, 'attach', 'ok'),
+                          ('noips', 'attach', 'error'),
+                          (instance2_id, 'detach', 'ok'),
+                          ('fakefake', 'detach', 'error')])
+        self.assertEqual(self.generations.get(
+            sharedfs_db.attachments_generation_key(global_fs_name)), 1)
+
+        self.assertRaises(webob.exc.HTTPUnprocessableEntity,
+                          self.attachment_controller.bulk,
+                          req, global_fs_name, {})
+
+    def test_bulk_update_failure_invalidates(self):
+        def db_fixed_ips_get_by_instance_uuids(context, uuids):
+            return {instance1_id: [instance1_ip]}
+
+        self.stubs.Set(sharedfs_db,
+                       'fixed_ips_get_by_instance_uuids',
+                       db_fixed_ips_get_by_instance_uuids)
+
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            raise exception.ProcessExecutionError()
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'update_attachments',
+                       driver_update_attachments)
+
+        invalidated = []
+
+        def driver_invalidate(slf, fs_name=None):
+            invalidated.append(fs_name)
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'invalidate',
+                       driver_invalidate)
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s/'
+                                      'attachments/bulk' % global_fs_name)
+        body = {'attach': [instance1_id]}
+        res_dict = self.attachment_controller.bulk(req, global_fs_name, body)
+
+        self.assertEqual([r['status'] for r in res_dict['results']],
+                         ['error'])
+        self.assertEqual(invalidated, [global_fs_name])
+        self.assertEqual(self.attachments, [])
+
+    def test_bulk_update_other_project(self):
+        admin = context.get_admin_context()
+        own = db.instance_create(admin, {'project_id': 'fake'})
+        other = db.instance_create(admin, {'project_id': 'otherproject'})
+        for instance, address in [(own, '10.1.0.1'), (other, '10.1.0.2')]:
+            db.fixed_ip_create(admin, {'address': address,
+                                       'instance_id': instance['id']})
+
+        updates = []
+
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            updates.append((name, attach_ips, unattach_ips))
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'update_attachments',
+                       driver_update_attachments)
+
+        # The request is made by a member of project 'fake'.
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s/'
+                                      'attachments/bulk' % global_fs_name)
+        body = {'attach': [own['uuid']], 'detach': [other['uuid']]}
+        res_dict = self.attachment_controller.bulk(req, global_fs_name, body)
+
+        self.assertEqual(updates, [(global_fs_name, ['10.1.0.1'], [])])
+        results = res_dict['results']
+        self.assertEqual([(r['id'], r['status']) for r in results],
+                         [(own['uuid'], 'ok'), (other['uuid'], 'error')])
+        self.assertTrue('Unable to find' in results[1]['message'])
+
+        self.assertEqual(sharedfs_db.fixed_ips_get_by_instance_uuids(
+                             admin, [other['uuid']]),
+                         {other['uuid']: ['10.1.0.2']})
 
 
 class TestNotificationResponse(test.TestCase):
     def setUp(self):
         super(TestNotificationResponse, self).setUp()
+        self.flags(sharedfs_retry_queue_path='',
+                   sharedfs_retry_interval=0,
+                   sharedfs_retry_backoff_base=0,
+                   sharedfs_notifier_coalesce_window=0)
+        retry.reset()
+        self.stubs.Set(sharedfs_db, 'init_db', lambda: None)
         self.notifier = notifier.SharedFSNotifier()
+        self.generations = stub_generations(self.stubs)
+        self.attachments = stub_attachments(self.stubs)
+
+        self.lookups = []
+
+        def db_fixed_ips_get_by_instance_uuids(context, uuids):
+            self.lookups.append(list(uuids))
+            return dict((uuid, [ip['address'] for ip in
+                                db_fixed_ip_get_by_instance(context, uuid)])
+                        for uuid in uuids)
 
-    def testInstanceCreationNotice(self):
         self.stubs.Set(sharedfs_db,
-                       'filesystem_list',
-                       db_filesystem_list)
+                       'fixed_ips_get_by_instance_uuids',
+                       db_fixed_ips_get_by_instance_uuids)
+
+    def testInstanceCreationNotice(self):
         self.stubs.Set(sharedfs_db,
-                       'filesystem_get',
-                       db_filesystem_get)
-        self.stubs.Set(db,
-                       'instance_get_by_uuid',
-                       db_instance_get_by_uuid)
-        self.stubs.Set(db,
-                       'fixed_ip_get_by_instance',
-                       db_fixed_ip_get_by_instance)
+                       'filesystem_names_get_for_project',
+                       db_filesystem_names_get_for_project)
 
         attachments = []
 
@@ -473,8 +1087,10 @@ class TestNotificationResponse(test.TestCase):
         self.assertEqual(len(attachments), 2)
         self.assertEqual(attachments[0].get('name'), project_fs_name)
         self.assertEqual(attachments[1].get('name'), global_fs_name)
-        self.assertEqual(attachments[0].get('ip'), instance1_ip)
-        self.assertEqual(attachments[1].get('ip'), instance1_ip)
+        self.assertEqual(attachments[0].get('ip'), [instance1_ip])
+        self.assertEqual(attachments[1].get('ip'), [instance1_ip])
+        # The instance's addresses were looked up once for both shares.
+        self.assertEqual(self.lookups, [[instance1_id]])
 
         # This one should result in attachments to
         #  just the global filesystem.
@@ -486,21 +1102,26 @@ class TestNotificationResponse(test.TestCase):
         self.notifier.notify(message)
         self.assertEqual(len(attachments), 1)
         self.assertEqual(attachments[0].get('name'), global_fs_name)
-        self.assertEqual(attachments[0].get('ip'), instance2_ip)
+        self.assertEqual(attachments[0].get('ip'), [instance2_ip])
+
+        # Addresses in the payload need no lookup at all.
+        attachments = []
+        self.lookups = []
+        message = {'event_type': 'compute.instance.create.end',
+                   'payload': {'instance_id': instance1_id,
+                               'tenant_id': project1_id,
+                               'user_id': 'testuser',
+                               'fixed_ips': [{'address': '10.1.1.1'},
+                                             {'address': '10.1.1.2'}]}}
+        self.notifier.notify(message)
+        self.assertEqual(len(attachments), 2)
+        self.assertEqual(attachments[0].get('ip'), ['10.1.1.1', '10.1.1.2'])
+        self.assertEqual(self.lookups, [])
 
     def testInstanceDeletionNotice(self):
         self.stubs.Set(sharedfs_db,
-                       'filesystem_list',
-                       db_filesystem_list)
-        self.stubs.Set(sharedfs_db,
-                       'filesystem_get',
-                       db_filesystem_get)
-        self.stubs.Set(db,
-                       'instance_get_by_uuid',
-                       db_instance_get_by_uuid)
-        self.stubs.Set(db,
-                       'fixed_ip_get_by_instance',
-                       db_fixed_ip_get_by_instance)
+                       'filesystem_names_get_for_project',
+                       db_filesystem_names_get_for_project)
 
         detachments = []
 
@@ -519,19 +1140,650 @@ class TestNotificationResponse(test.TestCase):
                                'user_id': 'testuser'}}
         self.notifier.notify(message)
         self.assertEqual(len(detachments), 2)
-        self.assertEqual(detachments[0].get('name'), project_fs_name)
-        self.assertEqual(detachments[1].get('name'), global_fs_name)
-        self.assertEqual(detachments[0].get('ip'), instance1_ip)
-        self.assertEqual(detachments[1].get('ip'), instance1_ip)
+        self.assertEqual(detachments[0].get('name'), global_fs_name)
+        self.assertEqual(detachments[1].get('name'), project_fs_name)
+        self.assertEqual(detachments[0].get('ip'), [instance1_ip])
+        self.assertEqual(detachments[1].get('ip'), [instance1_ip])
 
-        # This one should result in attachments to
-        #  just the global filesystem.
+        # This one should result in detachment from the global
+        #  filesystem and from the recorded instance filesystem.
         detachments = []
+        self.attachments.append((instance_fs_name, instance2_id, '10.0.0.2'))
         message = {'event_type': 'compute.instance.delete.start',
                    'payload': {'instance_id': instance2_id,
                                'tenant_id': project2_id,
                                'user_id': 'testuser'}}
         self.notifier.notify(message)
-        self.assertEqual(len(detachments), 1)
+        self.assertEqual(len(detachments), 2)
         self.assertEqual(detachments[0].get('name'), global_fs_name)
-        self.assertEqual(detachments[0].get('ip'), instance2_ip)
+        self.assertEqual(detachments[0].get('ip'), [instance2_ip])
+        self.assertEqual(detachments[1].get('name'), instance_fs_name)
+        self.assertEqual(detachments[1].get('ip'), ['10.0.0.2'])
+        self.assertEqual(self.attachments, [])
+
+    def testConcurrentAttachWithRetry(self):
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_names_get_for_project',
+                       db_filesystem_names_get_for_project)
+
+        running = []
+        overlapped = []
+        attachments = []
+        broken = set([project_fs_name])
+        invalidated = []
+
+        def driver_invalidate(slf, fs_name=None):
+            invalidated.append(fs_name)
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'invalidate',
+                       driver_invalidate)
+
+        def driver_attach(slf, name, ip):
+            running.append(name)
+            eventlet.sleep(0)
+            overlapped.append(len(running))
+            running.remove(name)
+            if name in broken:
+                raise exception.ProcessExecutionError()
+            attachments.append(name)
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'attach',
+                       driver_attach)
+
+        message = {'event_type': 'compute.instance.create.end',
+                   'payload': {'instance_id': instance1_id,
+                               'tenant_id': project1_id,
+                               'user_id': 'testuser'}}
+        results = self.notifier.notify(message)
+
+        # Both shares were worked on at once, and the failure was kept.
+        self.assertEqual(max(overlapped), 2)
+        self.assertEqual([(r['filesystem'], r['status']) for r in results],
+                         [(global_fs_name, 'ok'),
+                          (project_fs_name, 'error')])
+        self.assertEqual(attachments, [global_fs_name])
+        queue = self.notifier.retry_queue
+        self.assertEqual(len(queue), 1)
+
+        # Whatever the driver had cached for the share is dropped.
+        self.assertEqual(invalidated, [project_fs_name])
+
+        # Still broken: the retry goes back on the queue.
+        self.notifier.retry_failed()
+        self.assertEqual([e.attempts for e in queue.entries()], [2])
+
+        broken.clear()
+        attachments = []
+        self.notifier.retry_failed()
+        self.assertEqual(attachments, [project_fs_name])
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(sorted(a[:2] for a in self.attachments),
+                         [(global_fs_name, instance1_id),
+                          (project_fs_name, instance1_id)])
+
+    def testRetriesMergedPerShare(self):
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_names_get_for_project',
+                       db_filesystem_names_get_for_project)
+        updates = []
+
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            updates.append((name, attach_ips, unattach_ips))
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'update_attachments',
+                       driver_update_attachments)
+
+        queue = self.notifier.retry_queue
+        queue.add(retry.ATTACH, global_fs_name, instance1_id, ['10.0.0.1'])
+        queue.add(retry.ATTACH, global_fs_name, instance2_id, ['10.0.0.2'])
+        queue.add(retry.DETACH, project_fs_name, 'gone', ['10.0.0.3'])
+        queue.add(retry.ATTACH, project_fs_name, instance1_id, ['10.0.0.1'])
+        self.notifier.retry_failed()
+
+        self.assertEqual(sorted(updates),
+                         [(global_fs_name, ['10.0.0.1', '10.0.0.2'], []),
+                          (project_fs_name, ['10.0.0.1'], ['10.0.0.3'])])
+        self.assertEqual(len(queue), 0)
+
+        # A newer event for the same instance and share replaces a
+        # queued operation.
+        queue.add(retry.ATTACH, global_fs_name, instance1_id, ['10.0.0.1'])
+        self.stubs.Set(sharedfs_driver.SharedFSDriver, 'unattach',
+                       lambda slf, name, ips: None)
+        message = {'event_type': 'compute.instance.delete.start',
+                   'payload': {'instance_id': instance1_id,
+                               'tenant_id': project2_id,
+                               'user_id': 'testuser'}}
+        self.notifier.notify(message)
+        self.assertEqual(len(queue), 0)
+
+    def testCoalescedChurn(self):
+        self.flags(sharedfs_notifier_coalesce_window=60)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_names_get_for_project',
+                       db_filesystem_names_get_for_project)
+        updates = []
+
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            updates.append((name, attach_ips, unattach_ips))
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'update_attachments',
+                       driver_update_attachments)
+
+        flushes = []
+
+        def spawn_after(seconds, func, *args):
+            flushes.append(args)
+
+        self.stubs.Set(eventlet, 'spawn_after', spawn_after)
+
+        def message(event_type, instance_id, tenant_id):
+            return {'event_type': event_type,
+                    'payload': {'instance_id': instance_id,
+                                'tenant_id': tenant_id,
+                                'user_id': 'testuser'}}
+
+        self.notifier.notify(message('compute.instance.create.end',
+                                     instance1_id, project1_id))
+        self.notifier.notify(message('compute.instance.create.end',
+                                     instance2_id, project2_id))
+        self.notifier.notify(message('compute.instance.delete.start',
+                                     instance1_id, project1_id))
+        self.assertEqual(updates, [])
+
+        # Instance 1 came and went within the window; only instance 2's
+        # attachment to the global filesystem is left to apply.
+        self.assertEqual(sorted(args[1] for args in flushes),
+                         [global_fs_name, project_fs_name])
+        for args in flushes:
+            args[0](*args[1:])
+        self.assertEqual(updates, [(global_fs_name, [instance2_ip], [])])
+        self.assertEqual(self.attachments,
+                         [(global_fs_name, instance2_id, instance2_ip)])
+        self.assertEqual(self.notifier.pending, {})
+
+    def testInstrumentation(self):
+        self.flags(sharedfs_notifier_slow_event=1e-9)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_names_get_for_project',
+                       db_filesystem_names_get_for_project)
+
+        def driver_attach(slf, name, ip):
+            if name == project_fs_name:
+                raise exception.ProcessExecutionError()
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'attach',
+                       driver_attach)
+        warnings = []
+        self.stubs.Set(notifier.LOG, 'warn', warnings.append)
+        metrics.reset()
+
+        message = {'event_type': 'compute.instance.create.end',
+                   'payload': {'instance_id': instance2_id,
+                               'tenant_id': project2_id,
+                               'user_id': 'testuser'}}
+        self.notifier.notify(message)
+        message['payload']['instance_id'] = instance1_id
+        message['payload']['tenant_id'] = project1_id
+        self.notifier.notify(message)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['sharedfs.notifier.event']['count'], 2)
+        self.assertEqual(snapshot['sharedfs.notifier.events.'
+                                  'compute.instance.create.end.ok'], 1)
+        self.assertEqual(snapshot['sharedfs.notifier.events.'
+                                  'compute.instance.create.end.error'], 1)
+        for stage in ['scope_lookup', 'ip_resolution', 'driver_attach']:
+            self.assertEqual(snapshot['sharedfs.notifier.stage.%s' %
+                                      stage]['count'], 2)
+        self.assertEqual(snapshot['sharedfs.driver.attach']['count'], 3)
+
+        # Nothing to detach from: the records are read, but no addresses
+        # are looked up and the event is not held.
+        self.stubs.Set(sharedfs_db, 'filesystem_names_get_for_project',
+                       lambda ctxt, project_id: [])
+        message['event_type'] = 'compute.instance.delete.start'
+        message['payload']['instance_id'] = 'unattached'
+        self.notifier.notify(message)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['sharedfs.notifier.events.'
+                                  'compute.instance.delete.start.noop'], 1)
+        self.assertEqual(snapshot['sharedfs.notifier.stage.'
+                                  'attachment_lookup']['count'], 1)
+        self.assertEqual(snapshot['sharedfs.notifier.stage.'
+                                  'ip_resolution']['count'], 2)
+
+        slow = [w for w in warnings if 'took' in w]
+        self.assertEqual(len(slow), 3)
+        self.assertTrue('scope_lookup' in slow[0])
+
+
+class RetryQueueTest(test.TestCase):
+    def setUp(self):
+        super(RetryQueueTest, self).setUp()
+        self.path = tempfile.mktemp()
+
+    def tearDown(self):
+        for path in [self.path, self.path + '.corrupt']:
+            if os.path.exists(path):
+                os.unlink(path)
+        super(RetryQueueTest, self).tearDown()
+
+    def test_queue_is_durable(self):
+        self.flags(sharedfs_retry_backoff_base=10,
+                   sharedfs_retry_backoff_max=30)
+        queue = retry.RetryQueue(self.path)
+        entry = queue.add(retry.ATTACH, global_fs_name, instance1_id,
+                          [instance1_ip], error='busy')
+        self.assertAlmostEqual(entry.next_attempt - entry.created_at, 10)
+        for attempt in range(2):
+            due = queue.claim_due(now=time.time() + 60)
+            queue.requeue(due[global_fs_name], error='busy')
+
+        # Claimed for a retry that never finished, as in a crash.
+        queue.claim_due(now=time.time() + 60)
+        loaded = retry.RetryQueue(self.path)
+        [queued] = loaded.entries()
+        self.assertEqual(queued.id, entry.id)
+        self.assertEqual(queued.addresses, [instance1_ip])
+        self.assertEqual(queued.attempts, 3)
+        self.assertEqual(retry.backoff(2), 20)
+        self.assertEqual(retry.backoff(3), 30)
+        self.assertEqual(loaded.claim_due(now=entry.created_at), {})
+
+        loaded.complete([queued])
+        self.assertEqual(len(retry.RetryQueue(self.path)), 0)
+
+    def test_queue_is_shared(self):
+        first = retry.RetryQueue(self.path)
+        second = retry.RetryQueue(self.path)
+        first.add(retry.ATTACH, global_fs_name, instance1_id, [instance1_ip])
+        second.add(retry.DETACH, global_fs_name, instance2_id,
+                   [instance2_ip])
+
+        due = first.claim_due(now=time.time() + 60)
+        self.assertEqual(sorted(e.instance_uuid for e in due[global_fs_name]),
+                         [instance1_id, instance2_id])
+        # Entries claimed by one process are left alone by the other.
+        self.assertEqual(second.claim_due(now=time.time() + 60), {})
+        first.complete(due[global_fs_name])
+        self.assertEqual(len(retry.RetryQueue(self.path)), 0)
+
+    def test_queue_path_per_service(self):
+        self.flags(sharedfs_retry_queue_path=self.path + '-%(binary)s')
+        self.stubs.Set(sys, 'argv', ['/usr/bin/nova-compute'])
+        retry.reset()
+        self.assertEqual(retry.get_queue().path, self.path + '-nova-compute')
+        retry.reset()
+
+    def test_corrupt_queue_moved_aside(self):
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        queue = retry.RetryQueue(self.path)
+        self.assertEqual(len(queue), 0)
+        self.assertTrue(os.path.exists(self.path + '.corrupt'))
+
+    def test_merge(self):
+        entries = [retry.RetryEntry(retry.ATTACH, global_fs_name, 'a',
+                                    ['1', '2'], created_at=1),
+                   retry.RetryEntry(retry.DETACH, global_fs_name, 'a',
+                                    ['2', '3'], created_at=2)]
+        self.assertEqual(retry.merge(entries), (['1'], ['2', '3']))
+
+    def test_metrics(self):
+        self.flags(sharedfs_retry_queue_path='')
+        metrics.reset()
+        retry.reset()
+        queue = retry.get_queue()
+        queue.add(retry.DETACH, global_fs_name, instance1_id, ['1'])
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['sharedfs.retry.depth'], 1)
+        self.assertEqual(snapshot['sharedfs.retry.queued'], 1)
+        self.assertTrue(snapshot['sharedfs.retry.oldest_age'] >= 0)
+        retry.reset()
+
+
+class ReconcileTest(test.TestCase):
+    def setUp(self):
+        super(ReconcileTest, self).setUp()
+        self.generations = stub_generations(self.stubs)
+        self.attachments = stub_attachments(self.stubs)
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'list_fs',
+                       driver_list_fs)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get_all',
+                       db_filesystem_get_all)
+
+        def db_instance_addresses_get_all(context):
+            return [(project1_id, instance1_id, instance1_ip),
+                    (project2_id, instance2_id, instance2_ip)]
+
+        self.stubs.Set(sharedfs_db,
+                       'instance_addresses_get_all',
+                       db_instance_addresses_get_all)
+
+        attached = {instance_fs_name: ['localhost', '10.0.0.99', '10.0.*',
+                                       instance2_ip],
+                    project_fs_name: ['localhost'],
+                    global_fs_name: ['localhost', instance2_ip]}
+
+        def driver_list_attachments(slf, fs_name):
+            return list(attached[fs_name])
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'list_attachments',
+                       driver_list_attachments)
+
+        self.updates = []
+
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            self.updates.append((name, attach_ips, unattach_ips))
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'update_attachments',
+                       driver_update_attachments)
+
+        # {instance_uuid: [address]} of the instances alive when the
+        # reconciler checks again before removing an address.
+        self.alive = {instance1_id: [instance1_ip],
+                      instance2_id: [instance2_ip]}
+
+        def db_fixed_ips_get_by_instance_uuids(context, uuids):
+            return dict((uuid, self.alive[uuid]) for uuid in uuids
+                        if uuid in self.alive)
+
+        self.stubs.Set(sharedfs_db,
+                       'fixed_ips_get_by_instance_uuids',
+                       db_fixed_ips_get_by_instance_uuids)
+
+        # 10.0.0.99 was attached to an instance that has been deleted;
+        # 10.0.* was added by hand and never recorded.
+        self.attachments.append((instance_fs_name, 'gone', '10.0.0.99'))
+
+    def test_reconcile(self):
+        ctxt = context.get_admin_context()
+        report = reconcile.Reconciler().run(ctxt)
+
+        self.assertEqual(report['not_in_driver'], [])
+        self.assertEqual(report['not_in_db'], ['bogus'])
+        results = dict((r['name'], r) for r in report['filesystems'])
+        self.assertEqual(results[instance_fs_name]['missing'], [])
+        self.assertEqual(results[instance_fs_name]['extra'], ['10.0.0.99'])
+        self.assertEqual(results[project_fs_name]['missing'],
+                         [instance1_ip])
+        self.assertEqual(results[global_fs_name]['missing'], [instance1_ip])
+
+        self.assertEqual(sorted(self.updates),
+                         [(global_fs_name, [instance1_ip], []),
+                          (instance_fs_name, [], ['10.0.0.99']),
+                          (project_fs_name, [instance1_ip], [])])
+        self.assertEqual(self.generations.get(
+            sharedfs_db.attachments_generation_key(global_fs_name)), 1)
+
+        # The recorded attachments now match the corrected access lists.
+        self.assertEqual(sorted(self.attachments),
+                         [(global_fs_name, instance1_id, instance1_ip),
+                          (global_fs_name, instance2_id, instance2_ip),
+                          (instance_fs_name, instance2_id, instance2_ip),
+                          (project_fs_name, instance1_id, instance1_ip)])
+
+        # Once everything matches, a pass records nothing.
+        attached = {instance_fs_name: [instance2_ip],
+                    project_fs_name: [instance1_ip],
+                    global_fs_name: [instance1_ip, instance2_ip]}
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'list_attachments',
+                       lambda slf, fs_name: list(attached[fs_name]))
+        self.updates = []
+        reconcile.Reconciler().run(ctxt)
+        self.assertEqual(self.updates, [])
+        self.assertEqual(self.generations.get(
+            sharedfs_db.attachments_generation_key(global_fs_name)), 1)
+
+    def test_reconcile_dry_run(self):
+        ctxt = context.get_admin_context()
+        report = reconcile.Reconciler().run(ctxt, dry_run=True)
+
+        self.assertTrue(report['dry_run'])
+        results = dict((r['name'], r) for r in report['filesystems'])
+        self.assertEqual(results[global_fs_name]['missing'], [instance1_ip])
+        self.assertEqual(results[instance_fs_name]['extra'], ['10.0.0.99'])
+        self.assertEqual(self.updates, [])
+        self.assertEqual(self.attachments,
+                         [(instance_fs_name, 'gone', '10.0.0.99')])
+
+    def test_reconcile_keeps_live_instances(self):
+        # The instance was created after the run read the instance
+        # list, so only the check just before removal knows about it.
+        self.alive['gone'] = ['10.0.0.99']
+        ctxt = context.get_admin_context()
+        report = reconcile.Reconciler().run(ctxt, dry_run=True)
+
+        results = dict((r['name'], r) for r in report['filesystems'])
+        self.assertEqual(results[instance_fs_name]['extra'], [])
+
+    def test_reconcile_keeps_unrecorded_addresses(self):
+        del self.attachments[:]
+        ctxt = context.get_admin_context()
+        report = reconcile.Reconciler().run(ctxt, dry_run=True)
+
+        for result in report['filesystems']:
+            self.assertEqual(result['extra'], [])
+
+    def test_populate(self):
+        ctxt = context.get_admin_context()
+        reconciler = reconcile.Reconciler()
+        self.assertTrue(reconciler.populate(ctxt))
+
+        self.assertEqual(sorted(self.attachments),
+                         [(global_fs_name, instance2_id, instance2_ip),
+                          (instance_fs_name, 'gone', '10.0.0.99'),
+                          (instance_fs_name, instance2_id, instance2_ip)])
+        self.assertEqual(self.updates, [])
+        self.assertEqual(self.generations.get(
+            sharedfs_db.attachments_generation_key(global_fs_name)), 1)
+
+        # Only ever once.
+        del self.attachments[:]
+        self.assertFalse(reconciler.populate(ctxt))
+        self.assertEqual(self.attachments, [])
+
+    def test_periodic_purge(self):
+        purges = []
+        self.stubs.Set(sharedfs_db, 'purge_deleted',
+                       lambda ctxt: purges.append(ctxt))
+
+        reconcile._periodic_reconcile()
+        self.assertEqual(len(purges), 1)
+
+        self.flags(sharedfs_reconcile_dry_run=True)
+        reconcile._periodic_reconcile()
+        self.assertEqual(len(purges), 1)
+
+
+class BackfillTest(test.TestCase):
+    def setUp(self):
+        super(BackfillTest, self).setUp()
+        self.generations = stub_generations(self.stubs)
+        self.attachments = stub_attachments(self.stubs)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get_all',
+                       db_filesystem_get_all)
+
+        self.chunk_sizes = []
+
+        def db_instance_addresses_get_chunks(context, chunk_size):
+            self.chunk_sizes.append(chunk_size)
+            yield [(project1_id, instance1_id, instance1_ip)]
+            yield [(project2_id, instance2_id, instance2_ip)]
+
+        self.stubs.Set(sharedfs_db,
+                       'instance_addresses_get_chunks',
+                       db_instance_addresses_get_chunks)
+
+        attached = {project_fs_name: [],
+                    global_fs_name: ['localhost', instance2_ip]}
+
+        def driver_list_attachments(slf, fs_name):
+            return list(attached[fs_name])
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'list_attachments',
+                       driver_list_attachments)
+
+        self.updates = []
+
+        def driver_update_attachments(slf, name, attach_ips, unattach_ips):
+            self.updates.append((name, attach_ips, unattach_ips))
+
+        self.stubs.Set(sharedfs_driver.SharedFSDriver,
+                       'update_attachments',
+                       driver_update_attachments)
+
+    def test_backfill(self):
+        self.flags(sharedfs_backfill_chunk_size=1)
+        ctxt = context.get_admin_context()
+        report = backfill.Backfiller().run(ctxt)
+
+        self.assertEqual(self.chunk_sizes, [1])
+        self.assertEqual(report['addresses'], 2)
+        self.assertEqual(report['skipped'], [])
+        self.assertEqual([(r['name'], r['status'], r['missing'])
+                          for r in report['filesystems']],
+                         [(global_fs_name, 'ok', [instance1_ip]),
+                          (project_fs_name, 'ok', [instance1_ip])])
+        self.assertEqual(sorted(self.updates),
+                         [(global_fs_name, [instance1_ip], []),
+                          (project_fs_name, [instance1_ip], [])])
+        self.assertEqual(sorted(self.attachments),
+                         [(global_fs_name, instance1_id, instance1_ip),
+                          (global_fs_name, instance2_id, instance2_ip),
+                          (project_fs_name, instance1_id, instance1_ip)])
+
+    def test_backfill_dry_run_and_names(self):
+        ctxt = context.get_admin_context()
+        report = backfill.Backfiller().run(
+            ctxt, fs_names=[global_fs_name, instance_fs_name, 'nosuchfs'],
+            dry_run=True)
+
+        self.assertEqual([(r['name'], r['missing'])
+                          for r in report['filesystems']],
+                         [(global_fs_name, [instance1_ip])])
+        self.assertEqual(report['skipped'], [instance_fs_name, 'nosuchfs'])
+        self.assertEqual(self.updates, [])
+        self.assertEqual(self.attachments, [])
+
+
+class PurgeTest(test.TestCase):
+    def test_purge_in_batches(self):
+        counts = [2, 2, 1, 0]
+        batches = []
+
+        def db_purge_batch(session, model, key, cutoff, batch_size):
+            batches.append(model)
+            return counts.pop(0)
+
+        self.stubs.Set(sharedfs_db, '_purge_batch', db_purge_batch)
+        self.stubs.Set(sharedfs_db, 'get_session', lambda: None)
+
+        purged = sharedfs_db.purge_deleted(context.get_admin_context(),
+                                           age=60, batch_size=2,
+                                           interval=0)
+        self.assertEqual(purged, 5)
+        self.assertEqual(batches, [sharedfs_db.FileSystemAttachment] * 3 +
+                                  [sharedfs_db.FileSystem])
+
+        self.assertEqual(sharedfs_db.purge_deleted(
+                             context.get_admin_context(), age=0), 0)
+
+
+class SessionScopeTest(test.TestCase):
+    def test_session_scope(self):
+        closed = []
+
+        class FakeSession(object):
+            def close(self):
+                closed.append(self)
+
+        self.stubs.Set(sharedfs_db, '_new_session',
+                       lambda *args: FakeSession())
+
+        with sharedfs_db.session_scope() as session:
+            self.assertTrue(sharedfs_db.get_session() is session)
+            with sharedfs_db.session_scope() as inner:
+                self.assertTrue(inner is session)
+            self.assertEqual(closed, [])
+        self.assertEqual(closed, [session])
+        self.assertFalse(sharedfs_db.get_session() is session)
+
+
+class FileSystemCacheTest(test.TestCase):
+    def setUp(self):
+        super(FileSystemCacheTest, self).setUp()
+        self.generations = stub_generations(self.stubs)
+        self.flags(sharedfs_fs_cache=True, sharedfs_fs_cache_ttl=0)
+        self.loads = 0
+
+        def db_filesystem_load_all(context):
+            self.loads += 1
+            return [db_filesystem_get(context, name)
+                    for name in (instance_fs_name, project_fs_name,
+                                 global_fs_name)]
+
+        self.stubs.Set(sharedfs_db, '_filesystem_load_all',
+                       db_filesystem_load_all)
+        sharedfs_db.filesystem_cache_invalidate()
+        self.addCleanup(sharedfs_db.filesystem_cache_invalidate)
+        self.context = context.get_admin_context()
+
+    def test_cache_follows_generation(self):
+        entry = sharedfs_db.filesystem_get(self.context, global_fs_name)
+        self.assertEqual(entry.scope, 'global')
+        self.assertEqual(sharedfs_db.filesystem_get(self.context, 'nonsense'),
+                         None)
+        self.assertEqual(self.loads, 1)
+
+        # Another process changed the table.
+        self.generations[sharedfs_db.FILESYSTEMS_GENERATION] = 7
+        sharedfs_db.filesystem_list(self.context)
+        self.assertEqual(self.loads, 2)
+
+        # Within the TTL the generation is not even checked.
+        self.flags(sharedfs_fs_cache_ttl=60)
+        sharedfs_db.filesystem_list(self.context)
+        self.generations[sharedfs_db.FILESYSTEMS_GENERATION] = 8
+        sharedfs_db.filesystem_list(self.context)
+        self.assertEqual(self.loads, 2)
+
+        # Changes made by this process are seen immediately.
+        sharedfs_db._filesystems_changed(self.context)
+        sharedfs_db.filesystem_list(self.context)
+        self.assertEqual(self.loads, 3)
+
+    def test_cached_queries(self):
+        self.assertEqual(sharedfs_db.filesystem_names_get_for_project(
+                             self.context, project1_id),
+                         [global_fs_name, project_fs_name])
+        self.assertEqual(sharedfs_db.filesystem_names_get_for_project(
+                             self.context, project2_id),
+                         [global_fs_name])
+
+        entries = sharedfs_db.filesystem_get_all(self.context,
+                                                 sort_key='scope',
+                                                 marker=global_fs_name,
+                                                 limit=1)
+        self.assertEqual([e.name for e in entries], [instance_fs_name])
+        entries = sharedfs_db.filesystem_get_all(self.context,
+                                                 filters={'name': 'proj'})
+        self.assertEqual([e.name for e in entries], [project_fs_name])
+        self.assertRaises(exception.NotFound,
+                          sharedfs_db.filesystem_get_all,
+                          self.context, marker='nonsense')
+        self.assertEqual(self.loads, 1)
@@ -15,17 +15,23 @@
 
 import UserDict
 
+import eventlet
 import webob
 
 from nova import context
 from nova import db
+from nova import exception
 from nova import flags
 from nova import test
 from . import test_sharedfs
 from nova.tests.api.openstack import fakes
 from nova import utils
 from sharedfs import api
+from sharedfs import notifier
 from sharedfs import db as sharedfs_db
+from sharedfs import driver
+from sharedfs import metrics
+from sharedfs import retry
 from sharedfs.driver import sharedfs_gluster_driver
 
 FLAGS = flags.FLAGS
@@ -35,21 +41,51 @@ class GlusterDriverTest(test.TestCase):
     def setUp(self):
         super(GlusterDriverTest, self).setUp()
 
+        def volume(name, options):
+            return {'name': name, 'status': 'Started',
+                    'bricks': ['fake:/fake'], 'options': options}
+
         def gl_refresh_volume_info(self):
             self.volume_info = {test_sharedfs.instance_fs_name:
-                                   {'features.limit-usage':
-                                    'size:9'},
+                                    volume(test_sharedfs.instance_fs_name,
+                                           {'features.limit-usage':
+                                            'size:9'}),
                                 test_sharedfs.project_fs_name:
-                                   {'features.limit-usage':
-                                    'size:8',
-                                    'auth.allow': 'a,b'},
+                                    volume(test_sharedfs.project_fs_name,
+                                           {'features.limit-usage':
+                                            'size:8',
+                                            'auth.allow': 'a,b'}),
                                 'bogus':
-                                    {'features.limit-usage':
-                                     'size:7g'}}
+                                    volume('bogus',
+                                           {'features.limit-usage':
+                                            'size:7g'})}
+
+        self.refreshes = 0
+
+        def gl_refresh_volume_info_counted(self_):
+            self.refreshes += 1
+            gl_refresh_volume_info(self_)
 
         self.stubs.Set(sharedfs_gluster_driver.GlusterDriver,
                        '_refresh_volume_info',
-                       gl_refresh_volume_info)
+                       gl_refresh_volume_info_counted)
+
+        self.volume_queries = []
+
+        def gl_get_volume_info(self_, fs_name):
+            self.volume_queries.append(fs_name)
+            volume_info = self_.volume_info
+            gl_refresh_volume_info(self_)
+            info = self_.volume_info.get(fs_name)
+            self_.volume_info = volume_info
+            if info is None:
+                raise exception.NotFound()
+            self_.volume_info[fs_name] = info
+            return info
+
+        self.stubs.Set(sharedfs_gluster_driver.GlusterDriver,
+                       '_get_volume_info',
+                       gl_get_volume_info)
 
         self.executed = []
 
@@ -78,6 +114,9 @@ class GlusterDriverTest(test.TestCase):
         self.stubs.Set(sharedfs_db,
                        'filesystem_get',
                        test_sharedfs.db_filesystem_get)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get_all',
+                       test_sharedfs.db_filesystem_get_all)
         self.stubs.Set(db,
                        'instance_get_all_by_project',
                        test_sharedfs.db_instance_get_all_by_project)
@@ -90,6 +129,9 @@ class GlusterDriverTest(test.TestCase):
         self.stubs.Set(sharedfs_db,
                        'filesystem_delete',
                        test_sharedfs.db_filesystem_delete)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_update',
+                       lambda context, name, values: None)
 
         self.old_FLAGS_sharedfs_driver = FLAGS.sharedfs_driver
         self.old_FLAGS_gluster_bricks = FLAGS.gluster_bricks
@@ -97,32 +139,47 @@ class GlusterDriverTest(test.TestCase):
         FLAGS.sharedfs_driver = (
             "sharedfs.driver.sharedfs_gluster_driver.GlusterDriver")
         FLAGS.gluster_bricks = ['fake:fake', 'example:example']
+        driver.reset()
+        self.flags(sharedfs_retry_queue_path='',
+                   sharedfs_retry_interval=0,
+                   sharedfs_notifier_coalesce_window=0)
+        retry.reset()
+        test_sharedfs.stub_generations(self.stubs)
+        self.stubs.Set(sharedfs_db, 'init_db', lambda: None)
+        self.attachments = test_sharedfs.stub_attachments(self.stubs)
         self.fs_controller = api.SharedFSController()
         self.attachment_controller = api.SharedFSAttachmentController()
+        # Setting up the controllers checks gluster with a full refresh.
+        self.refreshes = 0
 
     def tearDown(self):
         FLAGS.sharedfs_driver = self.old_FLAGS_sharedfs_driver
         FLAGS.gluster_bricks = self.old_FLAGS_gluster_bricks
+        driver.reset()
         super(GlusterDriverTest, self).tearDown()
 
     def test_gluster_list(self):
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem')
-        res_dict = self.fs_controller.index(req)
+        res_dict = self.fs_controller.index(req).obj
         fs_entries = res_dict.get('fs_entries')
 
         self.assertEqual(len(fs_entries), 2)
-        self.assertEqual(fs_entries[0].get('name'), 'projectfs')
-        self.assertEqual(fs_entries[1].get('name'), 'instancefs')
-        self.assertEqual(fs_entries[0].get('size'), '8')
-        self.assertEqual(fs_entries[1].get('scope'), 'instance')
+        self.assertEqual(fs_entries[0].get('name'), 'instancefs')
+        self.assertEqual(fs_entries[1].get('name'), 'projectfs')
+        self.assertEqual(fs_entries[1].get('size'), '8')
+        self.assertEqual(fs_entries[0].get('scope'), 'instance')
+        self.assertEqual(self.refreshes, 1)
 
     def test_gluster_create(self):
-        def db_filesystem_add(context, name, scope, project):
+        def db_filesystem_add(context, name, scope, project, state=None):
             pass
 
         self.stubs.Set(sharedfs_db,
                        'filesystem_add',
                        db_filesystem_add)
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_get',
+                       lambda context, name: None)
 
         body = {'fs_entry': {'size': 11, 'scope': 'project'}}
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s'
@@ -131,6 +188,7 @@ class GlusterDriverTest(test.TestCase):
         res_dict = self.fs_controller.update(req,
                                              test_sharedfs.project_fs_name,
                                              body)
+        self.fs_controller.jobs.wait()
         self.assertEqual(len(self.executed), 7)
         self.assertEqual(self.executed[0], 'gluster')
 
@@ -139,9 +197,39 @@ class GlusterDriverTest(test.TestCase):
                                       test_sharedfs.project_fs_name)
         res_dict = self.fs_controller.delete(req,
                                              test_sharedfs.project_fs_name)
+        self.fs_controller.jobs.wait()
         self.assertEqual(len(self.executed), 5)
         self.assertEqual(self.executed[0], 'gluster')
 
+    def test_gluster_delete_failure(self):
+        def gl_get_volume_info(self_, fs_name):
+            raise exception.ProcessExecutionError(
+                stderr='Connection failed. Please check if gluster daemon '
+                       'is operational.')
+
+        self.stubs.Set(sharedfs_gluster_driver.GlusterDriver,
+                       '_get_volume_info',
+                       gl_get_volume_info)
+        states = []
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_set_state',
+                       lambda context, name, state: states.append(state))
+        deleted = []
+        self.stubs.Set(sharedfs_db,
+                       'filesystem_delete',
+                       lambda context, name: deleted.append(name))
+
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      test_sharedfs.project_fs_name)
+        self.fs_controller.delete(req, test_sharedfs.project_fs_name)
+        self.fs_controller.jobs.wait()
+
+        # An unreachable glusterd is not a missing volume: the record
+        # stays, in the error state, and nothing was deleted.
+        self.assertEqual(states[-1], sharedfs_db.STATE_ERROR)
+        self.assertEqual(deleted, [])
+        self.assertFalse('delete' in self.executed)
+
     def test_gluster_attach(self):
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s/attachments/%s'
                                       % (test_sharedfs.project_fs_name,
@@ -153,6 +241,10 @@ class GlusterDriverTest(test.TestCase):
         self.assertEqual(res_dict['instance_entry']['id'],
                          test_sharedfs.instance1_id)
         self.assertEqual(self.executed[5], 'auth.allow')
+        # Only the target volume was queried.
+        self.assertEqual(self.refreshes, 0)
+        self.assertEqual(self.volume_queries,
+                         [test_sharedfs.project_fs_name])
 
     def test_gluster_unattach(self):
         req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s/attachments/%s'
@@ -161,3 +253,331 @@ class GlusterDriverTest(test.TestCase):
         self.attachment_controller.delete(req, test_sharedfs.project_fs_name,
                                           test_sharedfs.instance1_id)
         self.assertEqual(self.executed[5], 'auth.allow')
+        self.assertEqual(self.refreshes, 0)
+        self.assertEqual(self.volume_queries,
+                         [test_sharedfs.project_fs_name])
+
+    def test_gluster_list_attachments_cached(self):
+        driver = self.attachment_controller.fs_driver
+        attached = driver.list_attachments(test_sharedfs.project_fs_name)
+        self.assertEqual(attached, ['a', 'b'])
+
+        # Callers may modify the result without corrupting the cache.
+        attached.append('c')
+        self.assertEqual(driver.list_attachments(
+                             test_sharedfs.project_fs_name), ['a', 'b'])
+        self.assertEqual(driver.list_attachments(
+                             test_sharedfs.instance_fs_name), [])
+        self.assertRaises(exception.NotFound,
+                          driver.list_attachments, 'nosuchfs')
+        self.assertEqual(self.refreshes, 0)
+
+    def test_gluster_show(self):
+        req = fakes.HTTPRequest.blank('/vw/123/os-filesystem/%s' %
+                                      test_sharedfs.instance_fs_name)
+        res_dict = self.fs_controller.show(req,
+                                           test_sharedfs.instance_fs_name)
+        self.assertEqual(res_dict['fs_entry']['size'], '9')
+        self.assertEqual(res_dict['fs_entry']['scope'], 'instance')
+        self.assertEqual(self.volume_queries,
+                         [test_sharedfs.instance_fs_name])
+        self.assertEqual(self.refreshes, 0)
+
+        self.assertRaises(webob.exc.HTTPNotFound,
+                          self.fs_controller.show,
+                          req, test_sharedfs.global_fs_name)
+
+    def test_gluster_concurrent_updates_merged(self):
+        driver = self.attachment_controller.fs_driver
+        allowed = {test_sharedfs.project_fs_name: ['localhost'],
+                   test_sharedfs.instance_fs_name: ['localhost']}
+        volume_sets = []
+
+        def gl_list_attachments(fs_name):
+            # Give the other greenthreads a chance to queue up.
+            eventlet.sleep(0)
+            return list(allowed[fs_name])
+
+        def utils_execute(*cmd, **kwargs):
+            volume_sets.append(cmd[4])
+            allowed[cmd[4]] = cmd[6].split(',')
+
+        self.stubs.Set(driver, 'current_attachments', gl_list_attachments)
+        self.stubs.Set(utils, 'execute', utils_execute)
+
+        pool = eventlet.GreenPool()
+        pool.spawn(driver.attach, test_sharedfs.project_fs_name, '10.0.0.1')
+        pool.spawn(driver.attach, test_sharedfs.project_fs_name, '10.0.0.2')
+        pool.spawn(driver.update_attachments, test_sharedfs.project_fs_name,
+                   ['10.0.0.3'], ['localhost'])
+        pool.spawn(driver.attach, test_sharedfs.instance_fs_name,
+                   '10.0.0.4')
+        pool.waitall()
+
+        # The first update for each filesystem runs alone; the two that
+        # queued up behind it are merged into one volume set.
+        self.assertEqual(volume_sets.count(test_sharedfs.project_fs_name),
+                         2)
+        self.assertEqual(volume_sets.count(test_sharedfs.instance_fs_name),
+                         1)
+        self.assertEqual(allowed[test_sharedfs.project_fs_name],
+                         ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        self.assertEqual(allowed[test_sharedfs.instance_fs_name],
+                         ['localhost', '10.0.0.4'])
+
+    def test_gluster_merged_update_failure(self):
+        driver = self.attachment_controller.fs_driver
+
+        def gl_list_attachments(fs_name):
+            eventlet.sleep(0)
+            return []
+
+        def utils_execute(*cmd, **kwargs):
+            raise exception.ProcessExecutionError()
+
+        self.stubs.Set(driver, 'current_attachments', gl_list_attachments)
+        self.stubs.Set(utils, 'execute', utils_execute)
+
+        failures = []
+
+        def attach(ip):
+            try:
+                driver.attach(test_sharedfs.project_fs_name, ip)
+            except exception.ProcessExecutionError:
+                failures.append(ip)
+
+        pool = eventlet.GreenPool()
+        for ip in ['10.0.0.1', '10.0.0.2', '10.0.0.3']:
+            pool.spawn(attach, ip)
+        pool.waitall()
+
+        self.assertEqual(sorted(failures),
+                         ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+
+    def test_gluster_volume_info_cache(self):
+        metrics.reset()
+        fs_driver = self.fs_controller.fs_driver
+        project_fs = test_sharedfs.project_fs_name
+
+        fs_driver.list_fs()
+        fs_driver.list_fs()
+        self.assertEqual(self.refreshes, 1)
+        self.assertEqual(fs_driver.list_attachments(project_fs), ['a', 'b'])
+        self.assertEqual(self.volume_queries, [])
+
+        # The access list is read afresh before it is changed, and the
+        # change is written through to the cache.
+        fs_driver.attach(project_fs, '10.0.0.1')
+        self.assertEqual(self.volume_queries, [project_fs])
+        self.assertEqual(fs_driver.list_attachments(project_fs),
+                         ['a', 'b', '10.0.0.1'])
+
+        fs_driver.create_fs('newfs', 'newproject', 1)
+        self.assertEqual(fs_driver.list_attachments('newfs'), ['localhost'])
+        self.assertEqual(fs_driver.get_fs('newfs'),
+                         {'name': 'newfs', 'size': '1GB'})
+        self.assertTrue('newfs' in [fs['name']
+                                    for fs in fs_driver.list_fs()])
+
+        fs_driver.delete_fs(project_fs, 'project1')
+        self.assertFalse(project_fs in fs_driver.volume_info)
+        self.assertEqual(len(self.volume_queries), 2)
+
+        # Missing from a fresh listing only means gluster is asked: the
+        # volume may have been created by another process since.  Here
+        # gluster still reports the deleted volume.
+        self.assertEqual(fs_driver.list_attachments(project_fs), ['a', 'b'])
+        self.assertRaises(exception.NotFound,
+                          fs_driver.list_attachments, 'nosuchfs')
+        self.assertEqual(self.volume_queries[2:], [project_fs, 'nosuchfs'])
+        self.assertEqual(self.refreshes, 1)
+        self.assertEqual(fs_driver.cache_misses, 3)
+        self.assertEqual(metrics.snapshot()[
+                             'sharedfs.gluster.volume_info.hits'],
+                         fs_driver.cache_hits)
+
+        driver.invalidate()
+        fs_driver.list_fs()
+        self.assertEqual(self.refreshes, 2)
+
+        self.flags(gluster_volume_info_ttl=0)
+        fs_driver.list_fs()
+        fs_driver.list_attachments(project_fs)
+        self.assertEqual(self.refreshes, 3)
+        self.assertEqual(len(self.volume_queries), 5)
+
+    def test_gluster_driver_shared(self):
+        fs_driver = self.fs_controller.fs_driver
+        self.assertTrue(isinstance(fs_driver,
+                                   sharedfs_gluster_driver.GlusterDriver))
+        self.assertTrue(self.attachment_controller.fs_driver is fs_driver)
+        self.assertTrue(notifier.SharedFSNotifier().fs_driver is fs_driver)
+
+        fs_driver.list_attachments(test_sharedfs.project_fs_name)
+        self.assertTrue(test_sharedfs.project_fs_name in
+                        fs_driver.volume_info)
+        driver.invalidate(test_sharedfs.project_fs_name)
+        self.assertFalse(test_sharedfs.project_fs_name in
+                         fs_driver.volume_info)
+
+
+VOLUME_INFO_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<cliOutput>
+  <opRet>0</opRet>
+  <opErrno>0</opErrno>
+  <opErrstr/>
+  <volInfo>
+    <volumes>
+      <volume>
+        <name>projectfs</name>
+        <status>1</status>
+        <statusStr>Started</statusStr>
+        <bricks>
+          <brick uuid="1">server1:/exp1/p/projectfs<name
+            >server1:/exp1/p/projectfs</name></brick>
+          <brick>server2:/exp2/p/projectfs</brick>
+        </bricks>
+        <options>
+          <option>
+            <name>features.limit-usage</name>
+            <value>/data:10GB</value>
+          </option>
+          <option>
+            <name>auth.allow</name>
+            <value>localhost,10.0.0.1</value>
+          </option>
+        </options>
+      </volume>
+      <volume>
+        <name>instancefs</name>
+        <statusStr>Stopped</statusStr>
+        <bricks/>
+        <options/>
+      </volume>
+      <count>2</count>
+    </volumes>
+  </volInfo>
+</cliOutput>
+"""
+
+VOLUME_INFO_TEXT = """
+Volume Name: projectfs
+Type: Replicate
+Status: Started
+Number of Bricks: 2
+Transport-type: tcp
+Bricks:
+Brick1: server1:/exp1/p/projectfs
+Brick2: server2:/exp2/p/projectfs
+Options Reconfigured:
+features.limit-usage: /data:10GB
+auth.allow: localhost,10.0.0.1
+
+Volume Name: instancefs
+Type: Distribute
+Status: Stopped
+"""
+
+VOLUME_INFO_MISSING_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<cliOutput>
+  <opRet>-1</opRet>
+  <opErrno>0</opErrno>
+  <opErrstr>Volume nosuchfs does not exist</opErrstr>
+  <volInfo/>
+</cliOutput>
+"""
+
+
+class GlusterVolumeInfoParseTest(test.TestCase):
+    expected = {'projectfs': {'name': 'projectfs',
+                              'status': 'Started',
+                              'bricks': ['server1:/exp1/p/projectfs',
+                                         'server2:/exp2/p/projectfs'],
+                              'options': {'features.limit-usage':
+                                              '/data:10GB',
+                                          'auth.allow':
+                                              'localhost,10.0.0.1'}},
+                'instancefs': {'name': 'instancefs',
+                               'status': 'Stopped',
+                               'bricks': [],
+                               'options': {}}}
+
+    def test_parse_xml(self):
+        self.assertEqual(
+            sharedfs_gluster_driver.parse_volume_info_xml(VOLUME_INFO_XML),
+            self.expected)
+
+    def test_parse_xml_failure(self):
+        self.assertRaises(exception.NotFound,
+                          sharedfs_gluster_driver.parse_volume_info_xml,
+                          VOLUME_INFO_MISSING_XML)
+
+    def test_parse_text(self):
+        self.assertEqual(
+            sharedfs_gluster_driver.parse_volume_info_text(VOLUME_INFO_TEXT),
+            self.expected)
+
+    def test_volume_info_errors(self):
+        output = {}
+        calls = []
+
+        def utils_execute(*cmd, **kwargs):
+            calls.append(kwargs)
+            if 'stdout' in output or 'stderr' in output:
+                raise exception.ProcessExecutionError(**output)
+            return output['xml'], ''
+
+        self.stubs.Set(utils, 'execute', utils_execute)
+        cleaned = []
+        self.stubs.Set(sharedfs_gluster_driver.GlusterDriver,
+                       '_cleanup_bricks',
+                       lambda self_, fs_name, tenant: cleaned.append(fs_name))
+        gl_driver = sharedfs_gluster_driver.GlusterDriver()
+
+        # gluster exits non-zero either way, so the XML decides.
+        output['xml'] = ('Connection failed. Please check if gluster '
+                         'daemon is operational.\n')
+        self.assertRaises(exception.Error,
+                          gl_driver._get_volume_info, 'projectfs')
+        self.assertFalse(calls[-1]['check_exit_code'])
+        self.assertRaises(exception.Error,
+                          gl_driver.delete_fs, 'projectfs', 'project')
+        self.assertEqual(cleaned, [])
+
+        output['xml'] = VOLUME_INFO_MISSING_XML
+        self.assertRaises(exception.NotFound,
+                          gl_driver._get_volume_info, 'nosuchfs')
+        self.assertRaises(exception.NotFound,
+                          gl_driver.delete_fs, 'nosuchfs', 'project')
+        self.assertEqual(cleaned, ['nosuchfs'])
+
+        # Plain text output only has the exit code and the message.
+        self.flags(gluster_xml_volume_info=False)
+        output['stderr'] = ('Connection failed. Please check if gluster '
+                            'daemon is operational.')
+        self.assertRaises(exception.ProcessExecutionError,
+                          gl_driver._get_volume_info, 'projectfs')
+        output['stderr'] = 'Volume nosuchfs does not exist'
+        self.assertRaises(exception.NotFound,
+                          gl_driver._get_volume_info, 'nosuchfs')
+
+    def test_volume_info_command(self):
+        commands = []
+
+        def utils_execute(*cmd, **kwargs):
+            commands.append(cmd)
+            if '--xml' in cmd:
+                return VOLUME_INFO_XML, ''
+            return VOLUME_INFO_TEXT, ''
+
+        self.stubs.Set(utils, 'execute', utils_execute)
+        gl_driver = sharedfs_gluster_driver.GlusterDriver()
+
+        gl_driver._refresh_volume_info()
+        self.assertEqual(gl_driver.volume_info, self.expected)
+        self.flags(gluster_xml_volume_info=False)
+        self.assertEqual(gl_driver._get_volume_info('projectfs'),
+                         self.expected['projectfs'])
+        self.assertEqual(commands,
+                         [('gluster', 'volume', 'info', '--xml'),
+                          ('gluster', 'volume', 'info', 'projectfs')])